@@ -0,0 +1,168 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark the cold and warm start of the Cloud Function trigger handler.
+
+Every run starts a new interpreter, like a new instance, and times the import of
+main.py, the first invocation and the following (warm) invocations. Nothing is
+sent to Google Cloud: the default credentials are stubbed by credentials whose
+lookup and token refresh sleep for --metadata-ms, like calls to the metadata
+server, the tag lookup in Artifact Registry returns a fixed version, the pipeline
+template is a minimal spec and the pipeline job is not submitted. Run from the
+cloudfunction folder, with the packages of src/requirements.txt installed:
+
+    python -m benchmarks.cold_start --runs 5
+    python -m benchmarks.cold_start --runs 5 --digest  # template without a tag
+
+--src compares another version of the handler, e.g. a checkout of main.py.
+"""
+import argparse
+import base64
+import contextlib
+import datetime
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from unittest import mock
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(__file__)), "src")
+TEMPLATE = "europe-west2-kfp.pkg.dev/my-project/pipelines/training-pipeline/"
+VERSION = "sha256:" + "0" * 64
+ENV = {
+    "VERTEX_PROJECT_ID": "my-project",
+    "VERTEX_LOCATION": "europe-west2",
+    "VERTEX_PIPELINE_ROOT": "gs://my-project-pl-root",
+    "VERTEX_SA_EMAIL": "vertex-pipelines@my-project.iam.gserviceaccount.com",
+}
+PIPELINE_SPEC = {
+    "pipelineInfo": {"name": "training-pipeline"},
+    "root": {"dag": {"tasks": {}}},
+    "components": {},
+    "schemaVersion": "2.1.0",
+    "sdkVersion": "kfp-2.1.2",
+}
+
+
+def make_event(digest: bool):
+    """Pub/Sub event like the one sent by the event trigger."""
+    from cloudevents.http import CloudEvent
+
+    attributes = {
+        "template_path": TEMPLATE + (VERSION if digest else "latest"),
+        "display_name": "training-pipeline",
+        "pipeline_parameters": "{}",
+        "enable_caching": "false",
+    }
+    data = base64.b64encode(json.dumps(attributes).encode()).decode()
+    return CloudEvent(
+        {"type": "google.cloud.pubsub.topic.v1.messagePublished", "source": "test"},
+        {"message": {"data": data, "attributes": attributes}},
+    )
+
+
+def stub_credentials(delay: float):
+    """Credentials whose lookup and refresh take `delay` seconds."""
+    from google.auth import credentials
+
+    class Credentials(credentials.Credentials):
+        def refresh(self, request):
+            time.sleep(delay)
+            self.token = "token"
+            self.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+    def default(*args, **kwargs):
+        time.sleep(delay)
+        return Credentials(), ENV["VERTEX_PROJECT_ID"]
+
+    return default
+
+
+def run_instance(src: str, digest: bool, n_calls: int, delay: float) -> dict:
+    """Times of one instance, in a new interpreter (see `main`)."""
+    os.environ.update(ENV)
+    sys.path.insert(0, src)
+    start = time.perf_counter()
+    import main as handler_module
+
+    import_seconds = time.perf_counter() - start
+
+    event = make_event(digest)
+    response = mock.Mock(**{"json.return_value": {"version": f"x/{VERSION}"}})
+    calls = []
+    with contextlib.ExitStack() as stack:
+        # patching imports the Vertex AI SDK, which main.py only imports on the
+        # first invocation, so the patching is timed with the first invocation
+        start = time.perf_counter()
+        for target, kwargs in [
+            ("google.auth.default", {"new": stub_credentials(delay)}),
+            (
+                "google.cloud.aiplatform.utils.yaml_utils.load_yaml",
+                {"return_value": PIPELINE_SPEC},
+            ),
+            ("google.cloud.aiplatform.pipeline_jobs.PipelineJob.submit", {}),
+            ("requests.get", {"return_value": response}),
+        ]:
+            stack.enter_context(mock.patch(target, **kwargs))
+        for _ in range(n_calls):
+            with contextlib.redirect_stdout(io.StringIO()):
+                handler_module.cf_handler(event)
+            calls.append(time.perf_counter() - start)
+            start = time.perf_counter()
+    return {"import": import_seconds, "first": calls[0], "warm": calls[1:]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--calls", type=int, default=5, help="invocations per run")
+    parser.add_argument("--metadata-ms", type=float, default=20)
+    parser.add_argument(
+        "--digest", action="store_true", help="template path without a tag"
+    )
+    parser.add_argument("--src", default=SRC, help="folder of main.py")
+    parser.add_argument("--instance", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.instance:
+        result = run_instance(
+            os.path.abspath(args.src), args.digest, args.calls, args.metadata_ms / 1000
+        )
+        print(json.dumps(result))
+        return
+
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.cold_start", "--instance"]
+            + sys.argv[1:],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+
+    def median_ms(values):
+        return f"{statistics.median(values) * 1000:8.1f} ms"
+
+    print(f"import main.py   {median_ms([r['import'] for r in runs])}")
+    print(f"first invocation {median_ms([r['first'] for r in runs])}")
+    print(f"cold start       {median_ms([r['import'] + r['first'] for r in runs])}")
+    print(f"warm invocation  {median_ms([t for r in runs for t in r['warm']])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,64 @@
 import base64
+import functools
 import json
 import os
 import re
 from distutils.util import strtobool
-from google.cloud import aiplatform
-from kfp.registry import RegistryClient
+import google.auth
 
 from cloudevents.http import CloudEvent
 import functions_framework
 
+# Credentials and clients are created once per instance and reused by the
+# following invocations. The Vertex AI SDK is imported on the first invocation,
+# kfp only when a tag has to be resolved. See benchmarks/cold_start.py.
+
+# If template_path is an AR URL and a tag is used, resolve to exact version
+# Workaround for known issue
+# https://github.com/googleapis/python-aiplatform/issues/2181
+_VALID_AR_URL = re.compile(
+    r"https://([\w\-]+)-kfp\.pkg\.dev/([\w\-]+)/([\w\-]+)/([\w\-]+)/([\w\-.]+)",
+    re.IGNORECASE,
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _credentials():
+    """Default credentials, resolved once and shared by all clients."""
+    credentials, _ = google.auth.default(
+        scopes=["https://www.googleapis.com/auth/cloud-platform"]
+    )
+    return credentials
+
+
+# (project, location) the Vertex AI SDK was last initialised with
+_aiplatform_config = None
+
+
+def _init_aiplatform(project_id: str, location: str):
+    """Vertex AI SDK, initialised with the shared credentials.
+
+    aiplatform.init sets global defaults, so it is called again whenever the
+    project or location differs from the previous invocation.
+    """
+    global _aiplatform_config
+    from google.cloud import aiplatform
+
+    if _aiplatform_config != (project_id, location):
+        aiplatform.init(
+            project=project_id, location=location, credentials=_credentials()
+        )
+        _aiplatform_config = (project_id, location)
+    return aiplatform
+
+
+@functools.lru_cache(maxsize=None)
+def _registry_client(host: str):
+    from kfp.registry import RegistryClient
+
+    return RegistryClient(host=host, auth=_credentials())
+
+
 # Source: https://cloud.google.com/functions/docs/tutorials/pubsub
 @functions_framework.cloud_event
 def cf_handler(cloud_event: CloudEvent) -> None:
@@ -87,17 +137,11 @@ def cf_handler(cloud_event: CloudEvent) -> None:
     network = os.environ.get("VERTEX_NETWORK") or None
 
     # If template_path is an AR URL and a tag is used, resolve to exact version
-    # Workaround for known issue
-    # https://github.com/googleapis/python-aiplatform/issues/2181
-    _VALID_AR_URL = re.compile(
-        r"https://([\w\-]+)-kfp\.pkg\.dev/([\w\-]+)/([\w\-]+)/([\w\-]+)/([\w\-.]+)",
-        re.IGNORECASE,
-    )
     match = _VALID_AR_URL.match(template_path)
     if match and "sha256:" not in template_path:
         region, project, repo, package_name, tag = match.group(1, 2, 3, 4, 5)
         host = f"https://{region}-kfp.pkg.dev/{project}/{repo}"
-        client = RegistryClient(host=host)
+        client = _registry_client(host)
         metadata = client.get_tag(package_name, tag)
         version = metadata["version"][metadata["version"].find("sha256:") :]
         template_path = f"{host}/{package_name}/{version}"
@@ -107,6 +151,7 @@ def cf_handler(cloud_event: CloudEvent) -> None:
         pipeline_parameters = None
         print("Using default pipeline parameters as {} was provided.")
         
+    aiplatform = _init_aiplatform(project_id, location)
     pl = aiplatform.pipeline_jobs.PipelineJob(
         project=project_id,
         location=location,
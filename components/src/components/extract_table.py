@@ -11,7 +11,13 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from kfp.dsl import Dataset, Output, ContainerSpec, container_component
+from kfp.dsl import (
+    Dataset,
+    Output,
+    ContainerSpec,
+    IfPresentPlaceholder,
+    container_component,
+)
 
 
 @container_component
@@ -22,9 +28,24 @@ def extract_table(
     data: Output[Dataset],
     destination_format: str = "CSV",
     compression: str = "NONE",
-    field_delimiter: str = ",",
-    print_header: str = "true",
+    field_delimiter: str = None,
+    print_header: str = None,
 ):
+    """Extract a BigQuery table to Cloud Storage with `bq extract`.
+
+    Args:
+        project (str): project id to run the extract job in
+        location (str): location of the BigQuery dataset
+        table (str): `<project>:<dataset>.<table>` to extract
+        data (Output[Dataset]): extracted file(s), written as `data-*` shards into
+            the artifact folder so that tables larger than 1 GB can be extracted
+        destination_format (str): "CSV", "NEWLINE_DELIMITED_JSON", "AVRO" or
+            "PARQUET". The binary formats are smaller and much faster to parse.
+        compression (str): "NONE", "GZIP", "DEFLATE" (Avro) or "SNAPPY"
+            (Avro & Parquet)
+        field_delimiter (str): optional, CSV only. Defaults to ",".
+        print_header (str): optional, CSV only. Defaults to "true".
+    """
     return ContainerSpec(
         image="google/cloud-sdk:alpine",
         command=["bq"],
@@ -34,9 +55,16 @@ def extract_table(
             f"--location={location}",
             f"--destination_format={destination_format}",
             f"--compression={compression}",
-            f"--field_delimiter={field_delimiter}",
-            f"--print_header={print_header}",
+            # CSV options are only passed when set, other formats do not take them
+            IfPresentPlaceholder(
+                input_name="field_delimiter",
+                then=[f"--field_delimiter={field_delimiter}"],
+            ),
+            IfPresentPlaceholder(
+                input_name="print_header",
+                then=[f"--print_header={print_header}"],
+            ),
             table,
-            data.uri,
+            f"{data.uri}/data-*",
         ],
     )
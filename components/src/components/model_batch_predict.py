@@ -12,20 +12,107 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from kfp.dsl import Input, Model, component, OutputPath
+import inspect
+
+from kfp.dsl import Input, Metrics, Model, Output, component, OutputPath
 from typing import List
 
 
+def poll_until_done(
+    get_job,
+    is_done,
+    initial_interval: float,
+    max_interval: float,
+    multiplier: float = 1.5,
+    jitter: float = 0.2,
+    retry_limit: int = 5,
+):
+    """Poll `get_job()` until `is_done(job)`, backing off between polls.
+
+    Intervals start at `initial_interval`, grow by `multiplier` up to
+    `max_interval` and are randomised by +/- `jitter` so that parallel jobs
+    do not poll in lockstep. Transient errors are retried `retry_limit` times
+    in a row. Returns the final job and the seconds between the job's end_time
+    and this function seeing it finish, None if the job has no end_time.
+
+    The source of this function is embedded in the model_batch_predict
+    component, so it imports what it needs itself.
+    """
+    import logging
+    import random
+    import time
+
+    from datetime import datetime, timezone
+    from google.api_core import exceptions as api_exceptions
+    from google_cloud_pipeline_components.container.v1.gcp_launcher.utils import (
+        error_util,
+    )
+
+    _TRANSIENT_ERRORS = (
+        ConnectionError,
+        api_exceptions.ServiceUnavailable,
+        api_exceptions.DeadlineExceeded,
+        api_exceptions.InternalServerError,
+        api_exceptions.TooManyRequests,
+    )
+    interval, retry_count, n_polls = initial_interval, 0, 0
+    while True:
+        try:
+            job = get_job()
+            n_polls += 1
+            retry_count = 0
+            if is_done(job):
+                break
+        except _TRANSIENT_ERRORS as err:
+            retry_count += 1
+            if retry_count > retry_limit:
+                error_util.exit_with_internal_error(
+                    f"Request failed after {retry_limit} retries."
+                )
+            logging.warning(
+                f"{type(err).__name__} ({err}) encountered when polling job. "
+                "Retrying."
+            )
+        sleep = interval * random.uniform(1 - jitter, 1 + jitter)
+        logging.info(f"Waiting for {sleep:.1f} seconds for next poll.")
+        time.sleep(sleep)
+        interval = min(interval * multiplier, max_interval)
+
+    # time between the job finishing and this component noticing it
+    detection_delay = None
+    end_time = getattr(job, "end_time", None)
+    if isinstance(end_time, datetime):
+        detection_delay = (datetime.now(timezone.utc) - end_time).total_seconds()
+        logging.info(
+            f"Detected job completion {detection_delay:.1f}s after it ended, "
+            f"after {n_polls} polls."
+        )
+    return job, detection_delay
+
+
 @component(
     base_image="python:3.9",
     packages_to_install=[
         "google-cloud-aiplatform==1.30.1",
         "google-cloud-pipeline-components==1.0.33",
+        # generated code of gcpc 1.0.33 (GcpResources) needs protobuf 3, and
+        # grpcio-status 1.48 is the last release which supports it
+        "protobuf==3.20.3",
+        "grpcio-status==1.48.2",
+        # local mode, same versions as the model (model/poetry.lock) so that
+        # model.joblib can be unpickled
+        "numpy==1.26.2",
+        "pandas==2.1.4",
+        "pyarrow==17.0.0",
+        "joblib==1.3.2",
+        "scikit-learn==1.3.2",
+        "xgboost==1.7.6",
     ],
 )
 def model_batch_predict(
     model: Input[Model],
     gcp_resources: OutputPath(str),
+    metrics: Output[Metrics],
     job_display_name: str,
     location: str,
     project: str,
@@ -41,9 +128,32 @@ def model_batch_predict(
     notification_channels: List[str] = [],
     monitoring_skew_config: dict = None,
     instance_config: dict = None,
+    mode: str = "remote",
+    local_chunk_size: int = 100000,
+    local_max_workers: int = 0,
 ):
     """
-    Trigger a batch prediction job and enable monitoring.
+    Trigger a batch prediction job and enable monitoring, or predict locally.
+
+    In local mode the model artifact under `model.path` is loaded into this
+    process, the input files are streamed in chunks of `local_chunk_size` rows,
+    and every chunk is predicted in a thread pool and written to its own output
+    shard as soon as it is ready. Threads are used over processes because XGBoost
+    and NumPy release the GIL, and because the self-contained component source
+    cannot define picklable worker functions. The model is model.joblib, or if
+    training did not write it (model_format="native") the compiled export
+    (compiled_model.json and compiled_trees.npy), evaluated with NumPy like in
+    the prediction server. The packages of local mode are installed with the
+    component, pinned to the versions of the model environment.
+
+    With a `monitoring_skew_config`, local mode also checks training-serving skew
+    in the same pass: every chunk is counted into the buckets and frequency
+    tables of feature_stats.json, which training stores next to the model,
+    and the totals are compared with the training counts like Vertex AI does:
+    Jensen-Shannon divergence for numeric and L-infinity distance for categorical
+    features. Features above their threshold are logged as warnings and the
+    distances are written to skew_report.json in the output folder. The cost is
+    O(batch) as the training data itself is not read again.
 
     Args:
         model (Input[Model]): Input model to use for calculating predictions.
@@ -71,10 +181,23 @@ def model_batch_predict(
         instance_config (dict): Configuration defining how to transform batch prediction
             input instances to the instances that the Model accepts. See:
             https://cloud.google.com/vertex-ai/docs/reference/rest/v1beta1/projects.locations.batchPredictionJobs#instanceconfig
+        mode (str): "remote" (default) to run a Vertex AI batch prediction job,
+            "local" to predict in this component. Local mode reads `source_uri`
+            (a path, glob or JSON list of them; gs:// is read through /gcs/) in
+            `source_format` "csv", "jsonl" or "parquet" and writes shards named
+            predictions_<n>.<destination_format> into the `destination_uri` folder.
+            Skew is checked locally (see above), alert and machine settings are
+            ignored.
+        local_chunk_size (int): rows per chunk and output shard in local mode.
+        local_max_workers (int): prediction threads in local mode,
+            defaults to the number of CPUs.
     Returns:
         OutputPath: gcp_resources for Vertex AI UI integration.
+        Output[Metrics]: metrics of the batch prediction job, detection_delay_seconds
+            is the time between the job ending and this component noticing it.
     """
 
+    import json
     import logging
     import time
 
@@ -86,9 +209,6 @@ def model_batch_predict(
         GetBatchPredictionJobRequest,
     )
     from google.cloud.aiplatform_v1beta1.types.job_state import JobState
-    from google_cloud_pipeline_components.container.v1.gcp_launcher.utils import (
-        error_util,
-    )
     from google_cloud_pipeline_components.container.utils import execution_context
     from google_cloud_pipeline_components.proto.gcp_resources_pb2 import GcpResources
 
@@ -120,8 +240,254 @@ def model_batch_predict(
             logging.info(f"Job {response.name} is in a non-final state {job_state}.")
         return False
 
-    _POLLING_INTERVAL_IN_SECONDS = 20
-    _CONNECTION_ERROR_RETRY_LIMIT = 5
+    def run_local_batch_prediction():
+        import glob
+        import os
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+
+        import joblib
+        import numpy as np
+        import pandas as pd
+        import pyarrow.parquet as pq
+
+        _LOCAL_FORMATS = ["csv", "jsonl", "parquet"]
+        # written by training, see training/export.py
+        _MODEL_FILE = "model.joblib"
+        _COMPILED_MODEL = "compiled_model.json"
+        _COMPILED_TREES = "compiled_trees.npy"
+        # written by training next to the model, see training/monitoring.py
+        _FEATURE_STATS = "feature_stats.json"
+        _SKEW_REPORT = "skew_report.json"
+        if {source_format, destination_format} - set(_LOCAL_FORMATS):
+            raise ValueError(f"Local mode only supports formats {_LOCAL_FORMATS}")
+
+        def local_path(uri: str) -> str:
+            return "/gcs/" + uri[5:] if uri.startswith("gs://") else uri
+
+        uris = json.loads(source_uri) if source_uri.startswith("[") else [source_uri]
+        paths = sorted(p for uri in uris for p in glob.glob(local_path(uri)))
+        if not paths:
+            raise FileNotFoundError(f"No input files found for {source_uri}")
+
+        def read_chunks():
+            for path in paths:
+                logging.info(f"Reading {path}")
+                if source_format == "csv":
+                    yield from pd.read_csv(path, chunksize=local_chunk_size)
+                elif source_format == "jsonl":
+                    yield from pd.read_json(
+                        path, lines=True, chunksize=local_chunk_size
+                    )
+                else:
+                    for batch in pq.ParquetFile(path).iter_batches(local_chunk_size):
+                        yield batch.to_pandas()
+
+        def load_compiled_model(model_dir: str):
+            """Features and predict function of the compiled export, mirrors
+            `CompiledModel` in prediction/engine.py."""
+            with open(os.path.join(model_dir, _COMPILED_MODEL)) as fp:
+                compiled = json.load(fp)
+            nodes = np.load(os.path.join(model_dir, _COMPILED_TREES), mmap_mode="r")
+            roots = np.asarray(compiled["roots"], dtype=np.int32)
+
+            def encode(values: pd.Series, categories: list, unknown) -> np.ndarray:
+                lookup = {category: idx for idx, category in enumerate(categories)}
+                return np.fromiter(
+                    (lookup.get(v, unknown) for v in values), np.float64, len(values)
+                )
+
+            def predict(df: pd.DataFrame) -> np.ndarray:
+                n_rows = len(df)
+                blocks = []
+                for block in compiled["preprocessing"]:
+                    if block["type"] == "standard_scaler":
+                        x = df[block["columns"]].to_numpy(dtype=np.float64)
+                        blocks.append((x - block["mean"]) / block["scale"])
+                        continue
+                    for col, categories in zip(block["columns"], block["categories"]):
+                        if block["type"] == "one_hot":
+                            # unknown categories are encoded as all zeros
+                            codes = encode(df[col], categories, -1).astype(np.int64)
+                            one_hot = np.zeros((n_rows, len(categories)))
+                            known = codes >= 0
+                            one_hot[np.flatnonzero(known), codes[known]] = 1.0
+                            blocks.append(one_hot)
+                        else:
+                            unknown = block["unknown_value"]
+                            blocks.append(encode(df[col], categories, unknown)[:, None])
+                X = np.hstack(blocks).astype(np.float32)
+                if compiled["sparse_output"]:
+                    X[X == 0] = np.nan
+
+                rows = np.arange(n_rows)[:, None]
+                current = np.broadcast_to(roots, (n_rows, len(roots)))
+                for _ in range(compiled["max_depth"]):
+                    x = X[rows, nodes["split_index"][current]]
+                    go_left = np.where(
+                        np.isnan(x),
+                        nodes["default_left"][current],
+                        x < nodes["threshold"][current],
+                    )
+                    current = np.where(
+                        go_left, nodes["left"][current], nodes["right"][current]
+                    )
+                values = nodes["value"][current].sum(axis=1, dtype=np.float32)
+                return values + np.float32(compiled["base_score"])
+
+            return compiled["columns"], predict
+
+        max_workers = local_max_workers or os.cpu_count() or 1
+        model_file = os.path.join(model.path, _MODEL_FILE)
+        if os.path.exists(model_file):
+            pipeline = joblib.load(model_file)
+            features = list(getattr(pipeline, "feature_names_in_", []))
+            predict = pipeline.predict
+            try:
+                # parallelism comes from the pool, avoid oversubscribing the CPUs
+                pipeline.set_params(train_model__n_jobs=1)
+            except (AttributeError, ValueError):
+                pass
+        else:
+            logging.info(f"No {model_file}, loading the compiled model export")
+            features, predict = load_compiled_model(model.path)
+
+        baseline = None
+        if monitoring_skew_config:
+            stats_path = os.path.join(model.path, _FEATURE_STATS)
+            if os.path.exists(stats_path):
+                with open(stats_path) as fp:
+                    baseline = json.load(fp)
+            else:
+                logging.warning(f"No {stats_path}, skipping the local skew check")
+
+        def count_chunk(chunk: pd.DataFrame) -> dict:
+            """Counts of a chunk in the buckets & categories of the baseline."""
+            counts = {}
+            for col, stats in baseline["numeric"].items():
+                if col in chunk:
+                    values = pd.to_numeric(chunk[col], errors="coerce")
+                    values = values.to_numpy(dtype=np.float64, na_value=np.nan)
+                    is_missing = np.isnan(values)
+                    buckets = np.searchsorted(
+                        stats["edges"], values[~is_missing], side="right"
+                    )
+                    counts[col] = np.append(
+                        np.bincount(buckets, minlength=len(stats["edges"]) + 1),
+                        is_missing.sum(),
+                    )
+            for col in baseline["categorical"]:
+                if col in chunk:
+                    values = chunk[col].astype("string").fillna("__missing__")
+                    counts[col] = values.value_counts()
+            return counts
+
+        def add_counts(total: dict, counts: dict) -> dict:
+            for col, value in counts.items():
+                if col not in total:
+                    total[col] = value
+                elif isinstance(value, pd.Series):
+                    total[col] = total[col].add(value, fill_value=0)
+                else:
+                    total[col] = total[col] + value
+            return total
+
+        def skew_report(counts: dict) -> dict:
+            default = monitoring_skew_config.get("defaultSkewThreshold", {})
+            thresholds = monitoring_skew_config.get("skewThresholds", {})
+            report = {}
+            for col, value in counts.items():
+                if isinstance(value, pd.Series):
+                    stats = baseline["categorical"][col]
+                    train = pd.Series(
+                        {**stats["counts"], "__missing__": stats["missing"]}
+                    )
+                    train, value = train.align(value, fill_value=0)
+                    p, q = train.to_numpy(float), value.to_numpy(float)
+                    method = "l_infinity"
+                    distance = float(np.abs(p / p.sum() - q / q.sum()).max())
+                else:
+                    stats = baseline["numeric"][col]
+                    p = np.append(stats["counts"], stats["missing"]).astype(float)
+                    p, q = p / p.sum(), value / value.sum()
+                    m = (p + q) / 2
+                    method = "jensen_shannon_divergence"
+                    distance = float(
+                        sum(
+                            (x[x > 0] * np.log2(x[x > 0] / m[x > 0])).sum() / 2
+                            for x in [p, q]
+                        )
+                    )
+                threshold = thresholds.get(col, default).get("value")
+                report[col] = {
+                    "method": method,
+                    "distance": distance,
+                    "threshold": threshold,
+                    "skewed": threshold is not None and distance > threshold,
+                }
+                if report[col]["skewed"]:
+                    logging.warning(
+                        f"Training-serving skew of {col}: {method} {distance:.4g} "
+                        f"above threshold {threshold}"
+                    )
+            return report
+
+        def predict_chunk(chunk: pd.DataFrame) -> (pd.DataFrame, dict):
+            inputs = chunk[features] if features else chunk
+            counts = count_chunk(chunk) if baseline else {}
+            return chunk.assign(prediction=predict(inputs)), counts
+
+        output_dir = local_path(destination_uri)
+        os.makedirs(output_dir, exist_ok=True)
+        total_counts = {}
+
+        def write_shard(idx: int, future) -> int:
+            df, counts = future.result()
+            add_counts(total_counts, counts)
+            path = os.path.join(output_dir, f"predictions_{idx:05d}")
+            if destination_format == "csv":
+                df.to_csv(f"{path}.csv", index=False)
+            elif destination_format == "jsonl":
+                df.to_json(f"{path}.jsonl", orient="records", lines=True)
+            else:
+                df.to_parquet(f"{path}.parquet", index=False)
+            return len(df)
+
+        start, n_rows = time.monotonic(), 0
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            # at most 2 chunks per worker in memory, shards are written in order
+            pending = deque()
+            for idx, chunk in enumerate(read_chunks()):
+                pending.append((idx, pool.submit(predict_chunk, chunk)))
+                if len(pending) >= 2 * max_workers:
+                    n_rows += write_shard(*pending.popleft())
+            for idx, future in pending:
+                n_rows += write_shard(idx, future)
+
+        if baseline:
+            report = skew_report(total_counts)
+            with open(os.path.join(output_dir, _SKEW_REPORT), "w") as fp:
+                json.dump(report, fp, indent=2)
+            n_skewed = sum(feature["skewed"] for feature in report.values())
+            logging.info(f"Skew check: {n_skewed} of {len(report)} features skewed")
+
+        logging.info(
+            f"Predicted {n_rows} rows locally in {time.monotonic() - start:.1f}s, "
+            f"output written to {output_dir}"
+        )
+
+    if mode == "local":
+        run_local_batch_prediction()
+        # nothing to link in the Vertex AI UI
+        with open(gcp_resources, "w") as f:
+            f.write(MessageToJson(GcpResources()))
+        return
+    elif mode != "remote":
+        raise ValueError(f"mode must be 'remote' or 'local', got {mode}")
+
+    _POLLING_INITIAL_INTERVAL_IN_SECONDS = 5
+    _POLLING_MAX_INTERVAL_IN_SECONDS = 60
+    _TRANSIENT_ERROR_RETRY_LIMIT = 5
 
     api_endpoint = f"{location}-aiplatform.googleapis.com"
 
@@ -190,34 +556,27 @@ def model_batch_predict(
     with execution_context.ExecutionContext(
         on_cancel=partial(
             send_cancel_request,
-            api_endpoint,
+            client,
             response.name,
         )
     ):
-        retry_count = 0
-        while True:
-            try:
-                job_status_request = GetBatchPredictionJobRequest(
-                    {"name": response.name}
-                )
-                job_state = client.get_batch_prediction_job(
-                    request=job_status_request
-                ).state
-                retry_count = 0
-            except ConnectionError as err:
-                retry_count += 1
-                if retry_count <= _CONNECTION_ERROR_RETRY_LIMIT:
-                    logging.warning(
-                        f"ConnectionError ({err}) encountered when polling job: "
-                        f"{response.name}. Retrying."
-                    )
-                else:
-                    error_util.exit_with_internal_error(
-                        f"Request failed after {_CONNECTION_ERROR_RETRY_LIMIT} retries."
-                    )
-            if is_job_successful(job_state):
-                break
-            logging.info(
-                f"Waiting for {_POLLING_INTERVAL_IN_SECONDS} seconds for next poll."
-            )
-            time.sleep(_POLLING_INTERVAL_IN_SECONDS)
+        job_status_request = GetBatchPredictionJobRequest({"name": response.name})
+        _, detection_delay = poll_until_done(
+            get_job=partial(
+                client.get_batch_prediction_job, request=job_status_request
+            ),
+            is_done=lambda job: is_job_successful(job.state),
+            initial_interval=_POLLING_INITIAL_INTERVAL_IN_SECONDS,
+            max_interval=_POLLING_MAX_INTERVAL_IN_SECONDS,
+            retry_limit=_TRANSIENT_ERROR_RETRY_LIMIT,
+        )
+    if detection_delay is not None:
+        metrics.log_metric("detection_delay_seconds", detection_delay)
+
+
+# lightweight components only embed the source of their own function, so prepend
+# the helpers it calls (like `additional_funcs` does in newer kfp releases)
+_container = model_batch_predict.component_spec.implementation.container
+_container.command[-1] = (
+    inspect.getsource(poll_until_done) + "\n\n" + _container.command[-1]
+)
@@ -11,16 +11,29 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import json
+import os
+import pathlib
+import subprocess
+import uuid
+from datetime import datetime, timedelta, timezone
+
 import pytest
+import yaml
 from unittest import mock
-from kfp.dsl import Model
+from kfp import compiler
+from kfp.dsl import Metrics, Model
 from google.cloud.aiplatform_v1beta1.types.job_state import JobState
 
 
 import components
 
+from components.model_batch_predict import poll_until_done
+
 model_batch_predict = components.model_batch_predict.python_func
 
+# training and serving code of the model, see model/
+MODEL_DIR = pathlib.Path(__file__).parents[2] / "model"
 
 SKEW_THRESHOLD = {"defaultSkewThreshold": {"value": 0.001}}
 TRAIN_DATASET = {
@@ -85,6 +98,7 @@ def test_model_batch_predict(
             monitoring_alert_email_addresses=monitoring_alert_email_addresses,
             monitoring_skew_config=monitoring_skew_config,
             gcp_resources=str(gcp_resources_path),
+            metrics=Metrics(uri=str(tmp_path / "metrics")),
         )
 
         create_job.assert_called_once()
@@ -92,3 +106,516 @@ def test_model_batch_predict(
         assert gcp_resources_path.exists()
     finally:
         gcp_resources_path.unlink(missing_ok=True)
+
+
+class DoubleModel:
+    """Stand-in for the trained pipeline: predicts twice the input feature."""
+
+    feature_names_in_ = ["x"]
+
+    def predict(self, df):
+        return df["x"] * 2
+
+
+@pytest.mark.parametrize("source_format", ["csv", "jsonl", "parquet"])
+@pytest.mark.parametrize("destination_format", ["csv", "jsonl", "parquet"])
+def test_model_batch_predict_local(tmp_path, source_format, destination_format):
+    """
+    Asserts model_batch_predict in local mode predicts every input row, in order,
+    and writes one output shard per chunk.
+    """
+    # local mode dependencies are only installed in the model environment
+    joblib = pytest.importorskip("joblib")
+    pd = pytest.importorskip("pandas")
+    pytest.importorskip("pyarrow")
+
+    model_dir = tmp_path / "model"
+    model_dir.mkdir()
+    joblib.dump(DoubleModel(), model_dir / "model.joblib")
+
+    df = pd.DataFrame({"x": range(25), "label": range(25)})
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for i, part in enumerate([df[:10], df[10:]]):
+        path = input_dir / f"part-{i}.{source_format}"
+        if source_format == "csv":
+            part.to_csv(path, index=False)
+        elif source_format == "jsonl":
+            part.to_json(path, orient="records", lines=True)
+        else:
+            part.to_parquet(path, index=False)
+
+    output_dir = tmp_path / "output"
+    gcp_resources_path = tmp_path / "gcp_resources.json"
+    model_batch_predict(
+        model=Model(uri=str(model_dir)),
+        job_display_name="",
+        location="",
+        project="",
+        source_uri=str(input_dir / f"*.{source_format}"),
+        destination_uri=str(output_dir),
+        source_format=source_format,
+        destination_format=destination_format,
+        gcp_resources=str(gcp_resources_path),
+        metrics=Metrics(uri=str(tmp_path / "metrics")),
+        mode="local",
+        local_chunk_size=4,
+        local_max_workers=2,
+    )
+
+    shards = sorted(output_dir.iterdir())
+    assert len(shards) == 7  # 10 rows -> 3 chunks, 15 rows -> 4 chunks
+    if destination_format == "csv":
+        result = pd.concat(pd.read_csv(s) for s in shards)
+    elif destination_format == "jsonl":
+        result = pd.concat(pd.read_json(s, lines=True) for s in shards)
+    else:
+        result = pd.concat(pd.read_parquet(s) for s in shards)
+    assert result["x"].tolist() == list(range(25))
+    assert (result["prediction"] == result["x"] * 2).all()
+    assert gcp_resources_path.exists()
+
+
+def write_compiled_model(model_dir):
+    """
+    Writes a compiled export (as training does with model_format="native") of
+    10 + tree_1 + tree_2, where tree_1 is 1 if x < 10 else (3 if cat == "b" else 2)
+    and tree_2 is -0.5 if ord == "q" else 0.5. Features are [scaled x, cat == "a",
+    cat == "b", ordinal code of ord].
+    """
+    np = pytest.importorskip("numpy")
+
+    compiled = {
+        "columns": ["x", "cat", "ord"],
+        "preprocessing": [
+            {"type": "standard_scaler", "columns": ["x"], "mean": [10], "scale": [2]},
+            {"type": "one_hot", "columns": ["cat"], "categories": [["a", "b"]]},
+            {
+                "type": "ordinal",
+                "columns": ["ord"],
+                "categories": [["p", "q"]],
+                "unknown_value": -1.0,
+            },
+        ],
+        "sparse_output": False,
+        "base_score": 10.0,
+        "max_depth": 2,
+        "roots": [0, 5],
+    }
+    node_dtype = [
+        ("split_index", np.int32),
+        ("threshold", np.float32),
+        ("left", np.int32),
+        ("right", np.int32),
+        ("default_left", bool),
+        ("value", np.float32),
+    ]
+    nodes = np.array(
+        [
+            (0, 0.0, 1, 2, False, 0.0),
+            (0, 0.0, 1, 1, False, 1.0),
+            (2, 0.5, 3, 4, False, 0.0),
+            (0, 0.0, 3, 3, False, 2.0),
+            (0, 0.0, 4, 4, False, 3.0),
+            (3, 0.5, 6, 7, False, 0.0),
+            (0, 0.0, 6, 6, False, 0.5),
+            (0, 0.0, 7, 7, False, -0.5),
+        ],
+        dtype=node_dtype,
+    )
+    model_dir.mkdir()
+    with open(model_dir / "compiled_model.json", "w") as fp:
+        json.dump(compiled, fp)
+    np.save(model_dir / "compiled_trees.npy", nodes)
+
+
+COMPILED_INPUT = {
+    "x": [4, 12, 12, 30, 8],
+    "cat": ["a", "a", "b", "c", "b"],
+    "ord": ["p", "q", "q", "p", "r"],
+}
+COMPILED_PREDICTIONS = [11.5, 11.5, 12.5, 12.5, 11.5]
+
+
+def test_model_batch_predict_local_compiled(tmp_path):
+    """
+    Asserts model_batch_predict in local mode evaluates the compiled export when
+    there is no model.joblib.
+    """
+    pd = pytest.importorskip("pandas")
+    pytest.importorskip("pyarrow")
+
+    write_compiled_model(tmp_path / "model")
+    input_path = tmp_path / "input.csv"
+    pd.DataFrame(COMPILED_INPUT).to_csv(input_path, index=False)
+
+    output_dir = tmp_path / "output"
+    model_batch_predict(
+        model=Model(uri=str(tmp_path / "model")),
+        job_display_name="",
+        location="",
+        project="",
+        source_uri=str(input_path),
+        destination_uri=str(output_dir),
+        source_format="csv",
+        destination_format="csv",
+        gcp_resources=str(tmp_path / "gcp_resources.json"),
+        metrics=Metrics(uri=str(tmp_path / "metrics")),
+        mode="local",
+        local_chunk_size=2,
+    )
+
+    result = pd.concat(pd.read_csv(s) for s in sorted(output_dir.iterdir()))
+    assert result["prediction"].tolist() == COMPILED_PREDICTIONS
+
+
+def test_model_batch_predict_local_compiled_matches_engine(tmp_path, monkeypatch):
+    """
+    Asserts model_batch_predict in local mode predicts the same as the serving
+    engine from an export written by training/export.py.
+    """
+    np = pytest.importorskip("numpy")
+    pd = pytest.importorskip("pandas")
+    pytest.importorskip("pyarrow")
+    pytest.importorskip("sklearn")
+    pytest.importorskip("xgboost")
+    monkeypatch.syspath_prepend(str(MODEL_DIR))
+    from prediction.engine import CompiledModel
+    from training.export import export_compiled_model
+    from training.train import build_pipeline, fit_pipeline
+
+    rng = np.random.default_rng(0)
+    n = 600
+    X = pd.DataFrame(
+        {
+            "dayofweek": rng.integers(1, 8, n).astype(np.float64),
+            "hourofday": rng.integers(0, 24, n).astype(np.float64),
+            "trip_distance": rng.gamma(2, 2000, n),
+            "trip_miles": rng.gamma(2, 2, n),
+            "trip_seconds": rng.gamma(2, 600, n),
+            "payment_type": rng.choice(["Cash", "Credit Card", "Mobile"], n),
+            "company": rng.choice(["Flash Cab", "Sun Taxi", "City Service"], n),
+        }
+    )
+    y = 3 + 2 * X["trip_miles"] + X["trip_seconds"] / 120 + rng.normal(0, 0.5, n)
+    pipeline = build_pipeline(X, dict(n_estimators=20, max_depth=4))
+    fit_pipeline(pipeline, X[:400], y[:400], X[400:500], y[400:500])
+    (tmp_path / "model").mkdir()
+    export_compiled_model(pipeline, str(tmp_path / "model"))
+
+    X_test = X[500:].reset_index(drop=True)
+    X_test.loc[0, "company"] = "Unknown Cab Company"
+    X_test.loc[1, "payment_type"] = "Dispute"
+    X_test.loc[2, "trip_miles"] = np.nan
+    X_test.to_csv(tmp_path / "input.csv", index=False)
+
+    output_dir = tmp_path / "output"
+    model_batch_predict(
+        model=Model(uri=str(tmp_path / "model")),
+        job_display_name="",
+        location="",
+        project="",
+        source_uri=str(tmp_path / "input.csv"),
+        destination_uri=str(output_dir),
+        source_format="csv",
+        destination_format="csv",
+        gcp_resources=str(tmp_path / "gcp_resources.json"),
+        metrics=Metrics(uri=str(tmp_path / "metrics")),
+        mode="local",
+        local_chunk_size=32,
+    )
+
+    result = pd.concat(pd.read_csv(s) for s in sorted(output_dir.iterdir()))
+    engine = CompiledModel.load(str(tmp_path / "model"))
+    expected = engine.predict(engine.schema.decode({"columns": X_test.to_dict("list")}))
+    np.testing.assert_allclose(result["prediction"], expected, rtol=1e-6, atol=1e-5)
+
+
+@pytest.fixture
+def gcs_bucket(tmp_path):
+    """
+    Bucket name whose gs:// URIs are read and written through tmp_path, like
+    Vertex AI mounts Cloud Storage at /gcs/ in the component's container.
+    """
+    bucket = f"test-{uuid.uuid4().hex}"
+    mount = pathlib.Path("/gcs") / bucket
+    created = not mount.parent.exists()
+    try:
+        mount.parent.mkdir(exist_ok=True)
+        mount.symlink_to(tmp_path, target_is_directory=True)
+    except OSError:
+        pytest.skip("needs a writable /gcs/ to mount the bucket on")
+    yield bucket
+    mount.unlink()
+    if created:
+        mount.parent.rmdir()
+
+
+@pytest.mark.skipif(
+    not os.environ.get("COMPONENT_VENV_PYTHON"),
+    reason="set COMPONENT_VENV_PYTHON to a Python interpreter to run it, "
+    "installs the component packages from PyPI",
+)
+def test_model_batch_predict_local_declared_packages(tmp_path, gcs_bucket):
+    """
+    Asserts local mode works with only the packages the component declares: runs
+    the component's container command, which installs them, in a new virtualenv,
+    like a pipeline step does.
+    """
+    pd = pytest.importorskip("pandas")
+
+    venv = tmp_path / "venv"
+    subprocess.run(
+        [os.environ["COMPONENT_VENV_PYTHON"], "-m", "venv", str(venv)], check=True
+    )
+    write_compiled_model(tmp_path / "model")
+    pd.DataFrame(COMPILED_INPUT).to_json(
+        tmp_path / "input.jsonl", orient="records", lines=True
+    )
+
+    executor_input = {
+        "inputs": {
+            "parameterValues": {
+                "job_display_name": "",
+                "location": "",
+                "project": "",
+                "source_uri": f"gs://{gcs_bucket}/input.jsonl",
+                "destination_uri": f"gs://{gcs_bucket}/output",
+                "source_format": "jsonl",
+                "destination_format": "csv",
+                "mode": "local",
+            },
+            "artifacts": {
+                "model": {
+                    "artifacts": [
+                        {
+                            "name": "model",
+                            "type": {"schemaTitle": "system.Model"},
+                            "uri": f"gs://{gcs_bucket}/model",
+                            "metadata": {},
+                        }
+                    ]
+                }
+            },
+        },
+        "outputs": {
+            "artifacts": {
+                "metrics": {
+                    "artifacts": [
+                        {
+                            "name": "metrics",
+                            "type": {"schemaTitle": "system.Metrics"},
+                            "uri": f"gs://{gcs_bucket}/metrics",
+                            "metadata": {},
+                        }
+                    ]
+                }
+            },
+            "parameters": {
+                "gcp_resources": {"outputFile": str(tmp_path / "gcp_resources")}
+            },
+            "outputFile": str(tmp_path / "executor_output.json"),
+        },
+    }
+    # the command and arguments of the compiled component, as run by Vertex AI
+    component_path = tmp_path / "component.yaml"
+    compiler.Compiler().compile(components.model_batch_predict, str(component_path))
+    with open(component_path) as fp:
+        (executor,) = yaml.safe_load(fp)["deploymentSpec"]["executors"].values()
+    container = executor["container"]
+    args = [
+        json.dumps(executor_input) if arg == "{{$}}" else arg
+        for arg in container["args"]
+    ]
+    # only the virtualenv on the PATH, as in the component's image
+    env = {"PATH": f"{venv / 'bin'}:/usr/bin:/bin", "HOME": str(tmp_path)}
+    subprocess.run(container["command"] + args, env=env, check=True, cwd=tmp_path)
+
+    result = pd.read_csv(tmp_path / "output" / "predictions_00000.csv")
+    assert result["prediction"].tolist() == COMPILED_PREDICTIONS
+    assert (tmp_path / "gcp_resources").exists()
+
+
+def test_model_batch_predict_local_skew(tmp_path):
+    """
+    Asserts model_batch_predict in local mode compares the input features with the
+    training statistics stored next to the model and reports skewed features.
+    """
+    joblib = pytest.importorskip("joblib")
+    pd = pytest.importorskip("pandas")
+    pytest.importorskip("pyarrow")
+
+    model_dir = tmp_path / "model"
+    model_dir.mkdir()
+    joblib.dump(DoubleModel(), model_dir / "model.joblib")
+    # x was uniform over 5 buckets in training, category always "a"
+    feature_stats = {
+        "num_rows": 25,
+        "numeric": {"x": {"edges": [5, 10, 15, 20], "counts": [5] * 5, "missing": 0}},
+        "categorical": {"cat": {"counts": {"a": 25}, "missing": 0}},
+    }
+    with open(model_dir / "feature_stats.json", "w") as fp:
+        json.dump(feature_stats, fp)
+
+    input_path = tmp_path / "input.csv"
+    df = pd.DataFrame({"x": range(25), "cat": ["a"] * 20 + ["b"] * 5})
+    df.to_csv(input_path, index=False)
+
+    output_dir = tmp_path / "output"
+    model_batch_predict(
+        model=Model(uri=str(model_dir)),
+        job_display_name="",
+        location="",
+        project="",
+        source_uri=str(input_path),
+        destination_uri=str(output_dir),
+        source_format="csv",
+        destination_format="csv",
+        gcp_resources=str(tmp_path / "gcp_resources.json"),
+        metrics=Metrics(uri=str(tmp_path / "metrics")),
+        monitoring_skew_config={
+            "defaultSkewThreshold": {"value": 0.001},
+            "skewThresholds": {"cat": {"value": 0.1}},
+        },
+        mode="local",
+        local_chunk_size=4,
+    )
+
+    with open(output_dir / "skew_report.json") as fp:
+        report = json.load(fp)
+    assert report["x"]["distance"] == pytest.approx(0)
+    assert not report["x"]["skewed"]
+    # 20% of the rows moved from "a" to "b"
+    assert report["cat"]["method"] == "l_infinity"
+    assert report["cat"]["distance"] == pytest.approx(0.2)
+    assert report["cat"]["skewed"]
+    assert len(list(output_dir.glob("predictions_*.csv"))) == 7
+
+
+class FakeJobServiceClient:
+    """JobServiceClient returning a scripted sequence of job states or errors."""
+
+    responses = []
+
+    def __init__(self, *args, **kwargs):
+        self.polls = iter(self.responses)
+
+    def create_batch_prediction_job(self, parent, batch_prediction_job):
+        return mock_job1
+
+    def get_batch_prediction_job(self, request):
+        response = next(self.polls)
+        if isinstance(response, Exception):
+            raise response
+        job = mock.Mock()
+        job.state = response
+        job.end_time = None
+        if response == JobState.JOB_STATE_SUCCEEDED:
+            job.end_time = datetime.now(timezone.utc) - timedelta(seconds=30)
+        return job
+
+
+@mock.patch("time.sleep")
+@mock.patch(
+    "google.cloud.aiplatform_v1beta1.services.job_service.JobServiceClient",
+    FakeJobServiceClient,
+)
+def test_model_batch_predict_polling(mock_sleep, tmp_path):
+    """
+    Asserts model_batch_predict backs off between polls, caps the interval and
+    retries transient errors until the job succeeds.
+    """
+    from google.api_core.exceptions import DeadlineExceeded, ServiceUnavailable
+
+    FakeJobServiceClient.responses = (
+        [JobState.JOB_STATE_RUNNING] * 3
+        + [ServiceUnavailable("unavailable"), DeadlineExceeded("deadline")]
+        + [JobState.JOB_STATE_RUNNING] * 5
+        + [JobState.JOB_STATE_SUCCEEDED]
+    )
+    metrics = Metrics(uri=str(tmp_path / "metrics"))
+
+    model_batch_predict(
+        model=Model(uri=str(tmp_path / "model"), metadata={"resourceName": ""}),
+        job_display_name="",
+        location="",
+        project="",
+        source_uri="bq://a.b.c",
+        destination_uri="bq://a.b",
+        source_format="bigquery",
+        destination_format="bigquery",
+        gcp_resources=str(tmp_path / "gcp_resources.json"),
+        metrics=metrics,
+    )
+
+    intervals = [c.args[0] for c in mock_sleep.call_args_list]
+    assert len(intervals) == len(FakeJobServiceClient.responses) - 1
+    # first poll comes quickly, then intervals grow (with jitter) up to the cap
+    assert intervals[0] <= 5 * 1.2
+    assert intervals[-1] > intervals[0]
+    assert max(intervals) <= 60 * 1.2
+    # seen 30s after the job ended, sleeping is mocked
+    assert 30 <= metrics.metadata["detection_delay_seconds"] < 40
+
+
+@mock.patch("time.sleep")
+@mock.patch(
+    "google.cloud.aiplatform_v1beta1.services.job_service.JobServiceClient",
+    FakeJobServiceClient,
+)
+def test_model_batch_predict_polling_failed_job(mock_sleep, tmp_path):
+    """
+    Asserts model_batch_predict raises when the job ends in a failed state.
+    """
+    FakeJobServiceClient.responses = [
+        JobState.JOB_STATE_RUNNING,
+        JobState.JOB_STATE_FAILED,
+    ]
+
+    with pytest.raises(RuntimeError):
+        model_batch_predict(
+            model=Model(uri=str(tmp_path / "model"), metadata={"resourceName": ""}),
+            job_display_name="",
+            location="",
+            project="",
+            source_uri="bq://a.b.c",
+            destination_uri="bq://a.b",
+            source_format="bigquery",
+            destination_format="bigquery",
+            gcp_resources=str(tmp_path / "gcp_resources.json"),
+            metrics=Metrics(uri=str(tmp_path / "metrics")),
+        )
+
+
+@mock.patch("time.sleep")
+def test_poll_until_done_retry_limit(mock_sleep):
+    """
+    Asserts poll_until_done retries transient errors in a row up to the limit,
+    and exits with an internal error after that.
+    """
+    from google.api_core.exceptions import ServiceUnavailable
+
+    get_job = mock.Mock(side_effect=ServiceUnavailable("unavailable"))
+
+    with pytest.raises(SystemExit):
+        poll_until_done(get_job, lambda job: True, 5, 60, retry_limit=2)
+
+    assert get_job.call_count == 3
+    assert mock_sleep.call_count == 2
+
+
+def test_model_batch_predict_embeds_poll_until_done(tmp_path):
+    """
+    Asserts the source run by the compiled component defines poll_until_done,
+    which lightweight components do not embed by themselves.
+    """
+    component_path = tmp_path / "component.yaml"
+    compiler.Compiler().compile(components.model_batch_predict, str(component_path))
+    with open(component_path) as fp:
+        (executor,) = yaml.safe_load(fp)["deploymentSpec"]["executors"].values()
+
+    namespace = {}
+    exec(executor["container"]["command"][-1], namespace)
+
+    assert callable(namespace["poll_until_done"])
+    assert callable(namespace["model_batch_predict"])
@@ -0,0 +1,121 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import base64
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+from google.api_core.exceptions import NotFound
+
+_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def _md5(path: str) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class ArtifactCache:
+    """Content-addressed local cache of model artifacts.
+
+    Artifacts are downloaded once into `<cache_dir>/<key>/` where the key is
+    derived from the MD5 hashes (or GCS generations) of all requested files, so a
+    restarted server finds its model on disk and a new model version never
+    overwrites an old one. Every file is checked against its MD5 hash after
+    download and before a cached copy is reused.
+
+    Args:
+        cache_dir (str): local directory to keep artifacts in
+        client (storage.Client): optional client for gs:// URIs, created on first
+            use. Any other URI is read as a local path (e.g. for tests).
+    """
+
+    def __init__(self, cache_dir: str, client=None):
+        self.cache_dir = Path(cache_dir)
+        self._client = client
+
+    @property
+    def client(self):
+        if self._client is None:
+            from google.cloud import storage
+
+            self._client = storage.Client()
+        return self._client
+
+    def _stat(self, uri: str) -> (str, str):
+        """Return (MD5 hex digest or None, cache key) of a remote or local file."""
+        if uri.startswith("gs://"):
+            from google.cloud import storage
+
+            blob = storage.Blob.from_string(uri, client=self.client)
+            blob.reload()  # raises NotFound
+            if blob.md5_hash is None:
+                # composite objects have no MD5 hash, fall back to the generation
+                return None, f"{blob.name}@{blob.generation}"
+            md5 = base64.b64decode(blob.md5_hash).hex()
+            return md5, md5
+
+        if not os.path.isfile(uri):
+            raise NotFound(f"No such file: {uri}")
+        md5 = _md5(uri)
+        return md5, md5
+
+    def _download(self, uri: str, path: Path):
+        """Stream `uri` to a temporary file next to `path`, then move it in place."""
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if uri.startswith("gs://"):
+                    self.client.download_blob_to_file(uri, f, checksum="md5")
+                else:
+                    with open(uri, "rb") as src:
+                        shutil.copyfileobj(src, f, _CHUNK_SIZE)
+            os.replace(tmp, path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+
+    def fetch(self, storage_uri: str, file_names: list) -> str:
+        """Make `file_names` under `storage_uri` available locally.
+
+        Args:
+            storage_uri (str): gs:// URI or local directory holding the artifacts
+            file_names (list): names of the files to fetch
+        Returns:
+            str: local directory which contains all requested files
+        """
+        stats = {name: self._stat(f"{storage_uri}/{name}") for name in file_names}
+        key = hashlib.sha256(
+            "".join(f"{name}:{stats[name][1]};" for name in file_names).encode()
+        ).hexdigest()[:32]
+        target = self.cache_dir / key
+        target.mkdir(parents=True, exist_ok=True)
+
+        for name, (md5, _) in stats.items():
+            path = target / name
+            if path.exists() and (md5 is None or _md5(path) == md5):
+                logging.info(f"Using cached {name} from {target}")
+                continue
+            logging.info(f"Download {storage_uri}/{name} to {target}")
+            self._download(f"{storage_uri}/{name}", path)
+            if md5 is not None and _md5(path) != md5:
+                path.unlink()
+                raise IOError(f"Checksum mismatch for {storage_uri}/{name}")
+        return str(target)
@@ -0,0 +1,82 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+from typing import Callable
+
+import numpy as np
+
+
+class MicroBatcher:
+    """Coalesce concurrent prediction requests into one vectorized predict call.
+
+    Requests are buffered until `max_batch_size` instances are pending or
+    `window_ms` milliseconds have passed since the first one arrived, whichever
+    comes first. The outputs are then split and handed back to each caller.
+
+    Args:
+        predict_fn (Callable): coroutine function mapping decoded columns (dict of
+            arrays) to predictions
+        window_ms (float): maximum time a request waits for others to join its batch
+        max_batch_size (int): number of instances which triggers an immediate flush
+    """
+
+    def __init__(
+        self, predict_fn: Callable, window_ms: float = 2.0, max_batch_size: int = 256
+    ):
+        self.predict_fn = predict_fn
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self._pending = []
+        self._pending_size = 0
+        self._timer = None
+
+    async def predict(self, columns: dict) -> np.ndarray:
+        """Queue decoded columns for the next batch and wait for their predictions."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((columns, future))
+        self._pending_size += len(next(iter(columns.values())))
+
+        if self._pending_size >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending, self._pending_size = self._pending, [], 0
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: list):
+        sizes = [len(next(iter(columns.values()))) for columns, _ in batch]
+        try:
+            columns = {
+                col: np.concatenate([c[col] for c, _ in batch]) for col in batch[0][0]
+            }
+            outputs = await self.predict_fn(columns)
+        except Exception as err:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(err)
+            return
+
+        outputs = np.split(outputs, np.cumsum(sizes)[:-1])
+        for (_, future), output in zip(batch, outputs):
+            # the caller may have gone away (e.g. client disconnect)
+            if not future.done():
+                future.set_result(output)
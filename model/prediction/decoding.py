@@ -0,0 +1,92 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from operator import itemgetter
+
+import numpy as np
+
+
+class FeatureSchema:
+    """Input columns of a trained model and which of them are numeric.
+
+    Args:
+        columns (list): column names in the order the model was trained with
+        numeric (list): subset of `columns` holding numeric features,
+            all other columns are decoded as categorical (object) arrays
+    """
+
+    def __init__(self, columns: list, numeric: list):
+        self.columns = list(columns)
+        self.numeric = set(numeric)
+        # itemgetter returns a bare value (not a tuple) for a single key
+        if len(self.columns) == 1:
+            self._getter = lambda inst: (inst[self.columns[0]],)
+        else:
+            self._getter = itemgetter(*self.columns)
+
+    @classmethod
+    def from_pipeline(cls, pipeline) -> "FeatureSchema":
+        """Derive the schema from a fitted sklearn pipeline (see training/train.py)."""
+        preprocessor = pipeline.named_steps["feature_engineering"]
+        columns = list(preprocessor.feature_names_in_)
+        numeric = [
+            columns[idx]
+            for name, _, indices in preprocessor.transformers_
+            if name == "numeric_scaling"
+            for idx in indices
+        ]
+        return cls(columns, numeric)
+
+    def _typed(self, column: str, values) -> np.ndarray:
+        if column in self.numeric:
+            # None (JSON null) becomes NaN, same as when building a DataFrame
+            return np.array(values, dtype=np.float64)
+        return np.array(values, dtype=object)
+
+    def decode(self, body: dict) -> dict:
+        """Decode a request body into one typed NumPy array per column.
+
+        Two payload shapes are accepted:
+            {"instances": [{"col": value, ...}, ...]} (or list of lists in
+            column order), as sent by Vertex AI endpoints and batch predictions
+            {"columns": {"col": [value, ...], ...}}, which skips the
+            row-to-column transpose altogether
+
+        Args:
+            body (dict): JSON body of the prediction request
+        Returns:
+            dict: mapping of column name to NumPy array
+        """
+        if "columns" in body:
+            data = body["columns"]
+            return {col: self._typed(col, data[col]) for col in self.columns}
+
+        instances = body["instances"]
+        if not instances:
+            return {col: self._typed(col, []) for col in self.columns}
+
+        if isinstance(instances[0], dict):
+            try:
+                rows = list(map(self._getter, instances))
+            except KeyError:
+                # sparse instances: missing keys become null like in pandas
+                rows = [
+                    tuple(inst.get(col) for col in self.columns) for inst in instances
+                ]
+        else:
+            rows = instances
+
+        return {
+            col: self._typed(col, values)
+            for col, values in zip(self.columns, zip(*rows))
+        }
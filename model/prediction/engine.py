@@ -0,0 +1,161 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+
+import numpy as np
+
+from training.export import COMPILED_MODEL, COMPILED_TREES
+
+from .decoding import FeatureSchema
+
+
+class CompiledModel:
+    """NumPy-only evaluation of a preprocessing + XGBoost pipeline.
+
+    Mirrors `Pipeline.predict` of the model trained in training/train.py from the
+    plain arrays exported by training/export.py: standard scaling, one-hot and
+    ordinal encoding, then a level-by-level walk of all trees at once.
+
+    Args:
+        compiled (dict): contents of COMPILED_MODEL
+        nodes (np.ndarray): structured array of tree nodes from COMPILED_TREES
+    """
+
+    def __init__(self, compiled: dict, nodes: np.ndarray):
+        self.base_score = np.float32(compiled["base_score"])
+        self.max_depth = compiled["max_depth"]
+        self.sparse_output = compiled["sparse_output"]
+        self.blocks = compiled["preprocessing"]
+        for block in self.blocks:
+            if block["type"] == "standard_scaler":
+                block["mean"] = np.asarray(block["mean"], dtype=np.float64)
+                block["scale"] = np.asarray(block["scale"], dtype=np.float64)
+            else:
+                block["lookup"] = [
+                    {category: idx for idx, category in enumerate(categories)}
+                    for categories in block["categories"]
+                ]
+        self.n_features = sum(self._width(block) for block in self.blocks)
+
+        numeric = [
+            col
+            for block in self.blocks
+            if block["type"] == "standard_scaler"
+            for col in block["columns"]
+        ]
+        self.schema = FeatureSchema(compiled["columns"], numeric)
+        # views on the (possibly memory-mapped) node records, nothing is copied
+        self.trees = {name: nodes[name] for name in nodes.dtype.names}
+        self.trees["roots"] = np.asarray(compiled["roots"], dtype=np.int32)
+
+    @classmethod
+    def load(cls, model_dir: str) -> "CompiledModel":
+        """Load a compiled model from a local directory.
+
+        The tree nodes are memory-mapped, so loading takes the same time whatever
+        the number of trees and forked workers share the pages of the OS cache.
+        """
+        with open(f"{model_dir}/{COMPILED_MODEL}") as fp:
+            compiled = json.load(fp)
+        nodes = np.load(f"{model_dir}/{COMPILED_TREES}", mmap_mode="r")
+        model = cls(compiled, nodes)
+        # lets process pool workers load their own copy (see workers.py)
+        model.source = (cls.load, model_dir)
+        return model
+
+    @staticmethod
+    def _width(block: dict) -> int:
+        if block["type"] == "one_hot":
+            return sum(len(categories) for categories in block["categories"])
+        return len(block["columns"])
+
+    def transform(self, columns: dict) -> np.ndarray:
+        """Apply the preprocessing to decoded columns (see FeatureSchema.decode).
+
+        Returns:
+            np.ndarray: float32 feature matrix as passed to the booster
+        """
+        n_rows = len(columns[self.schema.columns[0]])
+        X = np.zeros((n_rows, self.n_features), dtype=np.float64)
+        start = 0
+        for block in self.blocks:
+            if block["type"] == "standard_scaler":
+                for idx, col in enumerate(block["columns"]):
+                    X[:, start + idx] = columns[col]
+                end = start + len(block["columns"])
+                X[:, start:end] -= block["mean"]
+                X[:, start:end] /= block["scale"]
+                start = end
+            elif block["type"] == "one_hot":
+                rows = np.arange(n_rows)
+                for col, lookup in zip(block["columns"], block["lookup"]):
+                    codes = np.fromiter(
+                        (lookup.get(v, -1) for v in columns[col]), np.int64, n_rows
+                    )
+                    # unknown categories are encoded as all zeros
+                    known = codes >= 0
+                    X[rows[known], start + codes[known]] = 1.0
+                    start += len(lookup)
+            else:
+                for col, lookup in zip(block["columns"], block["lookup"]):
+                    unknown_value = block["unknown_value"]
+                    X[:, start] = np.fromiter(
+                        (lookup.get(v, unknown_value) for v in columns[col]),
+                        np.float64,
+                        n_rows,
+                    )
+                    start += 1
+
+        X = X.astype(np.float32)
+        if self.sparse_output:
+            X[X == 0] = np.nan
+        return X
+
+    def predict(self, columns: dict) -> np.ndarray:
+        """Predict from decoded columns (see FeatureSchema.decode)."""
+        X = self.transform(columns)
+        t = self.trees
+
+        rows = np.arange(len(X))[:, None]
+        nodes = np.broadcast_to(t["roots"], (len(X), len(t["roots"])))
+        for _ in range(self.max_depth):
+            x = X[rows, t["split_index"][nodes]]
+            go_left = np.where(
+                np.isnan(x), t["default_left"][nodes], x < t["threshold"][nodes]
+            )
+            nodes = np.where(go_left, t["left"][nodes], t["right"][nodes])
+
+        return t["value"][nodes].sum(axis=1, dtype=np.float32) + self.base_score
+
+
+class PipelineModel:
+    """Fallback for models without a compiled export: the joblib-dumped pipeline."""
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.schema = FeatureSchema.from_pipeline(pipeline)
+
+    @classmethod
+    def load(cls, model_file: str) -> "PipelineModel":
+        import joblib
+
+        # memory-map the (uncompressed) NumPy arrays instead of copying them
+        model = cls(joblib.load(model_file, mmap_mode="r"))
+        model.source = (cls.load, model_file)
+        return model
+
+    def predict(self, columns: dict) -> np.ndarray:
+        import pandas as pd
+
+        return self.pipeline.predict(pd.DataFrame(columns, copy=False))
@@ -11,19 +11,57 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import joblib
 import os
+from functools import partial
 
-import pandas as pd
-from fastapi import FastAPI, Request
-from google.cloud import storage
+from fastapi import FastAPI, HTTPException, Request
+
+from .artifacts import ArtifactCache
+from .batching import MicroBatcher
+from .registry import ModelRegistry
+from .workers import PredictionExecutor, Saturated
 
 app = FastAPI()
-client = storage.Client()
+# keeps artifacts across restarts of the server, keyed by their content
+_cache = ArtifactCache(os.environ.get("PREDICTION_CACHE_DIR", "/tmp/model_cache"))
+_registry = ModelRegistry(_cache)
+_model = _registry.load(
+    os.environ.get("AIP_DEPLOYED_MODEL_ID", "default"), os.environ["AIP_STORAGE_URI"]
+)
+
+# run predictions off the event loop so that health checks stay responsive
+_executor = PredictionExecutor(
+    executor_type=os.environ.get("PREDICTION_EXECUTOR", "thread"),
+    max_workers=int(os.environ.get("PREDICTION_WORKERS", 0)) or None,
+    max_queue_depth=int(os.environ.get("PREDICTION_MAX_QUEUE_DEPTH", 0)) or None,
+    preload=_model.source,
+)
+
+# opt-in: coalesce concurrent requests into one predict call (window in ms)
+_batch_window_ms = float(os.environ.get("PREDICTION_BATCH_WINDOW_MS", 0))
+_max_batch_size = int(os.environ.get("PREDICTION_MAX_BATCH_SIZE", 256))
+# (model, batcher) per version, requests are only batched with the same model
+_batchers = {}
+
+
+async def _predict(version: str, model, inputs: dict):
+    if _batch_window_ms <= 0:
+        return await _executor.predict(model, inputs)
+    if version not in _batchers or _batchers[version][0] is not model:
+        batcher = MicroBatcher(
+            partial(_executor.run, model),
+            window_ms=_batch_window_ms,
+            max_batch_size=_max_batch_size,
+        )
+        _batchers[version] = (model, batcher)
+    # admitted per request, not per batch, before it is queued in the batcher
+    with _executor.admit():
+        return await _batchers[version][1].predict(inputs)
+
 
-with open("model.joblib", "wb") as f:
-    client.download_blob_to_file(f"{os.environ['AIP_STORAGE_URI']}/model.joblib", f)
-_model = joblib.load("model.joblib")
+@app.on_event("shutdown")
+def shutdown():
+    _executor.shutdown()
 
 
 @app.get(os.environ.get("AIP_HEALTH_ROUTE", "/healthz"))
@@ -35,8 +73,85 @@ def health():
 async def predict(request: Request):
     body = await request.json()
 
-    instances = body["instances"]
-    inputs_df = pd.DataFrame(instances)
-    outputs = _model.predict(inputs_df).tolist()
+    try:
+        version, model = _registry.get(body.get("model_version"))
+    except KeyError:
+        if body.get("model_version") is None:
+            raise HTTPException(
+                status_code=503,
+                detail="No default model loaded",
+                headers={"Retry-After": "1"},
+            )
+        raise HTTPException(
+            status_code=404, detail=f"Unknown model version {body['model_version']}"
+        )
 
+    # decode straight into typed columns instead of pd.DataFrame(instances),
+    # which parses every row dict separately
+    inputs = model.schema.decode(body)
+    try:
+        outputs = (await _predict(version, model, inputs)).tolist()
+    except Saturated as err:
+        raise HTTPException(
+            status_code=429, detail=str(err), headers={"Retry-After": "1"}
+        )
+
+    if "model_version" in body:
+        return {"predictions": outputs, "model_version": version}
     return {"predictions": outputs}
+
+
+# Model management routes, off by default. They are not authenticated and load
+# (unpickle) the model at any given URI, so they are only registered if
+# PREDICTION_ENABLE_MODELS_ROUTE=true, and only accept models in Cloud Storage.
+# Vertex AI only forwards the health and predict routes, so when enabled they
+# are reachable from inside the serving cluster only.
+_models_route_enabled = (
+    os.environ.get("PREDICTION_ENABLE_MODELS_ROUTE", "false").lower() == "true"
+)
+_models_route = os.environ.get("PREDICTION_MODELS_ROUTE", "/models")
+
+
+def list_models():
+    return _registry.status()
+
+
+async def load_model(request: Request):
+    """Load {"version", "storage_uri"} in the background, optionally as "default"."""
+    body = await request.json()
+    storage_uri = body.get("storage_uri")
+    if not isinstance(storage_uri, str) or not storage_uri.startswith("gs://"):
+        raise HTTPException(
+            status_code=400, detail="storage_uri must be a gs:// Cloud Storage URI"
+        )
+    _registry.load_in_background(
+        body["version"], storage_uri, make_default=body.get("default", False)
+    )
+    return _registry.status()
+
+
+async def set_default_model(request: Request):
+    body = await request.json()
+    try:
+        _registry.set_default(body["version"])
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Unknown model version")
+    return _registry.status()
+
+
+def remove_model(version: str):
+    try:
+        _registry.remove(version)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Unknown model version")
+    except ValueError as err:
+        raise HTTPException(status_code=409, detail=str(err))
+    _batchers.pop(version, None)
+    return _registry.status()
+
+
+if _models_route_enabled:
+    app.get(_models_route)(list_models)
+    app.post(_models_route, status_code=202)(load_model)
+    app.put(_models_route + "/default")(set_default_model)
+    app.delete(_models_route + "/{version}")(remove_model)
@@ -0,0 +1,113 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import logging
+import threading
+
+from google.api_core.exceptions import NotFound
+
+from training.export import COMPILED_MODEL, COMPILED_TREES
+
+from .artifacts import ArtifactCache
+from .engine import CompiledModel, PipelineModel
+
+
+def load_model(cache: ArtifactCache, storage_uri: str):
+    """Fetch and load the model stored under `storage_uri`.
+
+    Prefers the compiled export, which is evaluated with NumPy only, and falls
+    back to model.joblib.
+    """
+    try:
+        model_dir = cache.fetch(storage_uri, [COMPILED_MODEL, COMPILED_TREES])
+        return CompiledModel.load(model_dir)
+    except NotFound:
+        model_dir = cache.fetch(storage_uri, ["model.joblib"])
+        return PipelineModel.load(f"{model_dir}/model.joblib")
+
+
+class ModelRegistry:
+    """Several model versions held in one server, with a swappable default.
+
+    New versions are loaded in a background thread while the current ones keep
+    serving; switching the default is a single reference swap, so a request
+    always sees either the old or the new default model, never a partial one.
+
+    Args:
+        cache (ArtifactCache): local cache to fetch model artifacts through
+    """
+
+    def __init__(self, cache: ArtifactCache):
+        self.cache = cache
+        self.default_version = None
+        self._models = {}
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def load(self, version: str, storage_uri: str, make_default: bool = False):
+        """Load a model version (blocking) and register it."""
+        logging.info(f"Load model version {version} from {storage_uri}")
+        model = load_model(self.cache, storage_uri)
+        with self._lock:
+            self._models[version] = model
+            if make_default or self.default_version is None:
+                self.default_version = version
+        logging.info(f"Model version {version} ready")
+        return model
+
+    def load_in_background(
+        self, version: str, storage_uri: str, make_default: bool = False
+    ) -> asyncio.Task:
+        """Load a model version off the event loop, returns the pending task."""
+        task = asyncio.ensure_future(
+            asyncio.to_thread(self.load, version, storage_uri, make_default)
+        )
+        self._loading[version] = task
+
+        def _done(task: asyncio.Task):
+            # a newer load of the same version may have replaced this task
+            if self._loading.get(version) is task:
+                del self._loading[version]
+            if not task.cancelled() and task.exception() is not None:
+                logging.error(
+                    f"Failed to load model version {version}: {task.exception()}"
+                )
+
+        task.add_done_callback(_done)
+        return task
+
+    def set_default(self, version: str):
+        with self._lock:
+            if version not in self._models:
+                raise KeyError(version)
+            self.default_version = version
+
+    def remove(self, version: str):
+        with self._lock:
+            if version == self.default_version:
+                raise ValueError("Cannot remove the default model version")
+            del self._models[version]
+
+    def get(self, version: str = None) -> (str, object):
+        """Return (version, model) for `version`, or the default if None."""
+        with self._lock:
+            version = version or self.default_version
+            return version, self._models[version]
+
+    def status(self) -> dict:
+        return {
+            "default": self.default_version,
+            "versions": sorted(self._models),
+            "loading": sorted(self._loading),
+        }
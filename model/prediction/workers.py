@@ -0,0 +1,124 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import contextlib
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+EXECUTOR_TYPES = ["thread", "process", "none"]
+
+# models loaded inside process pool workers, keyed by their source
+_worker_models = {}
+
+
+def _load_in_worker(source: tuple):
+    """Load (once per worker) the model described by `source` = (loader, path)."""
+    if source not in _worker_models:
+        loader, path = source
+        _worker_models[source] = loader(path)
+    return _worker_models[source]
+
+
+def _predict_in_worker(source: tuple, columns: dict) -> np.ndarray:
+    return _load_in_worker(source).predict(columns)
+
+
+class Saturated(Exception):
+    """Raised when more requests are in flight than the executor accepts."""
+
+
+class PredictionExecutor:
+    """Run predictions off the event loop with a bounded number in flight.
+
+    Args:
+        executor_type (str): "thread" (XGBoost and NumPy release the GIL),
+            "process" (each worker loads its own copy of the model) or "none"
+            to predict on the event loop
+        max_workers (int): size of the pool, defaults to the number of CPUs
+        max_queue_depth (int): requests accepted (running, or queued in the pool
+            or in a batch, see `admit`) before further ones raise Saturated,
+            defaults to 4 per worker
+        preload (tuple): optional (loader, path) model source loaded by each
+            process worker at startup
+    """
+
+    def __init__(
+        self,
+        executor_type: str = "thread",
+        max_workers: int = None,
+        max_queue_depth: int = None,
+        preload: tuple = None,
+    ):
+        if executor_type not in EXECUTOR_TYPES:
+            raise ValueError(
+                f"executor_type must be one of {EXECUTOR_TYPES}, got {executor_type}"
+            )
+        self.executor_type = executor_type
+        max_workers = max_workers or os.cpu_count() or 1
+        self.max_queue_depth = max_queue_depth or 4 * max_workers
+        self.in_flight = 0
+
+        self._pool = None
+        if executor_type == "thread":
+            self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        elif executor_type == "process":
+            self._pool = ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=_load_in_worker if preload else None,
+                initargs=(preload,) if preload else (),
+            )
+
+    @contextlib.contextmanager
+    def admit(self):
+        """Count a request as in flight until it is answered.
+
+        Requests which wait in a MicroBatcher are counted from the time they are
+        queued, so the limit does not depend on how they are batched.
+
+        Raises:
+            Saturated: if `max_queue_depth` requests are already in flight
+        """
+        if self.in_flight >= self.max_queue_depth:
+            raise Saturated(f"{self.in_flight} requests in flight")
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+    async def predict(self, model, columns: dict) -> np.ndarray:
+        """Admit one request (see `admit`) and predict its columns with `model`."""
+        with self.admit():
+            return await self.run(model, columns)
+
+    async def run(self, model, columns: dict) -> np.ndarray:
+        """Predict decoded columns with `model` in the pool, without admission.
+
+        Process workers cannot receive the model itself, so they load it from
+        `model.source` (see engine.py) the first time they see it.
+        """
+        if self._pool is None:
+            return model.predict(columns)
+        loop = asyncio.get_running_loop()
+        if self.executor_type == "process":
+            return await loop.run_in_executor(
+                self._pool, _predict_in_worker, model.source, columns
+            )
+        return await loop.run_in_executor(self._pool, model.predict, columns)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,75 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from training.train import build_pipeline, fit_pipeline
+from training.utils import split_xy
+
+LABEL = "total_fare"
+HPARAMS = dict(
+    n_estimators=30,
+    early_stopping_rounds=5,
+    objective="reg:squarederror",
+    max_depth=4,
+    learning_rate=0.3,
+)
+PAYMENT_TYPES = ["Cash", "Credit Card", "Mobile", "Prcard"]
+COMPANIES = ["City Service", "Flash Cab", "Sun Taxi", "Taxi Affiliation Services"]
+
+
+def make_trips(n: int, seed: int = 0) -> pd.DataFrame:
+    """Random trips with the columns of the preprocessed Chicago taxi table."""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        {
+            "dayofweek": rng.integers(1, 8, n).astype(np.float64),
+            "hourofday": rng.integers(0, 24, n).astype(np.float64),
+            "trip_distance": rng.gamma(2, 2000, n),
+            "trip_miles": rng.gamma(2, 2, n),
+            "trip_seconds": rng.gamma(2, 600, n),
+            "payment_type": rng.choice(PAYMENT_TYPES, n),
+            "company": rng.choice(COMPANIES, n),
+        }
+    )
+    df[LABEL] = (
+        3
+        + 2 * df["trip_miles"]
+        + df["trip_seconds"] / 120
+        + (df["payment_type"] == "Cash")
+        + rng.normal(0, 0.5, n)
+    )
+    return df
+
+
+@pytest.fixture(scope="session")
+def trips() -> pd.DataFrame:
+    return make_trips(2000)
+
+
+@pytest.fixture(scope="session", params=["dense", "sparse"])
+def fitted_pipeline(request, trips):
+    """Pipeline of training/train.py fitted on `trips`, once with a dense and once
+    with a sparse output of the ColumnTransformer."""
+    X, y = split_xy(trips, LABEL)
+    pipeline = build_pipeline(X, HPARAMS)
+    # the blocks are stacked into a sparse matrix if their density is below this
+    preprocessor = pipeline.named_steps["feature_engineering"]
+    preprocessor.set_params(sparse_threshold=1.0 if request.param == "sparse" else 0)
+
+    fit_pipeline(pipeline, X[:1500], y[:1500], X[1500:], y[1500:])
+    assert preprocessor.sparse_output_ == (request.param == "sparse")
+    return pipeline
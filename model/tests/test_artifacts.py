@@ -0,0 +1,97 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pathlib import Path
+from unittest import mock
+
+import pytest
+from google.api_core.exceptions import NotFound
+
+from prediction.artifacts import ArtifactCache
+
+FILES = ["model.json", "trees.npy"]
+
+
+@pytest.fixture
+def storage(tmp_path):
+    """Local directory standing in for the model folder in Cloud Storage."""
+    storage = tmp_path / "storage"
+    storage.mkdir()
+    (storage / "model.json").write_text('{"version": 1}')
+    (storage / "trees.npy").write_bytes(b"\x93NUMPY" + bytes(range(256)))
+    return storage
+
+
+def test_artifact_cache_miss_then_hit(storage, tmp_path):
+    """
+    Assert artifacts are copied on the first fetch only, and a new cache instance
+    (e.g. after a restart) finds them on disk
+    """
+    cache = ArtifactCache(tmp_path / "cache")
+    with mock.patch.object(cache, "_download", wraps=cache._download) as download:
+        model_dir = cache.fetch(str(storage), FILES)
+        assert download.call_count == 2
+        assert cache.fetch(str(storage), FILES) == model_dir
+        assert download.call_count == 2
+
+    for name in FILES:
+        assert (Path(model_dir) / name).read_bytes() == (storage / name).read_bytes()
+
+    restarted = ArtifactCache(tmp_path / "cache")
+    with mock.patch.object(restarted, "_download") as download:
+        assert restarted.fetch(str(storage), FILES) == model_dir
+    download.assert_not_called()
+
+
+def test_artifact_cache_new_version(storage, tmp_path):
+    """Assert changed content is fetched into a new folder, next to the old one"""
+    cache = ArtifactCache(tmp_path / "cache")
+    old_dir = cache.fetch(str(storage), FILES)
+
+    (storage / "model.json").write_text('{"version": 2}')
+    new_dir = cache.fetch(str(storage), FILES)
+
+    assert new_dir != old_dir
+    assert (Path(new_dir) / "model.json").read_text() == '{"version": 2}'
+    assert (Path(old_dir) / "model.json").read_text() == '{"version": 1}'
+
+
+def test_artifact_cache_corrupted_copy(storage, tmp_path):
+    """Assert a cached file which does not match its checksum is fetched again"""
+    cache = ArtifactCache(tmp_path / "cache")
+    cached = Path(cache.fetch(str(storage), FILES)) / "trees.npy"
+    cached.write_bytes(b"truncated")
+
+    cache.fetch(str(storage), FILES)
+
+    assert cached.read_bytes() == (storage / "trees.npy").read_bytes()
+
+
+def test_artifact_cache_checksum_mismatch(storage, tmp_path):
+    cache = ArtifactCache(tmp_path / "cache")
+
+    def corrupt_download(uri, path):
+        path.write_bytes(b"corrupted in transit")
+
+    with mock.patch.object(cache, "_download", side_effect=corrupt_download):
+        with pytest.raises(IOError):
+            cache.fetch(str(storage), FILES)
+    assert not list((tmp_path / "cache").glob("*/*"))
+
+
+def test_artifact_cache_not_found(storage, tmp_path):
+    cache = ArtifactCache(tmp_path / "cache")
+
+    with pytest.raises(NotFound):
+        cache.fetch(str(storage), ["model.joblib"])
@@ -0,0 +1,90 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+import numpy as np
+
+from prediction.batching import MicroBatcher
+
+
+class FakePredict:
+    """Coroutine function recording the size of each batch, predicts x + 0.5."""
+
+    def __init__(self, error: Exception = None):
+        self.batch_sizes = []
+        self.error = error
+
+    async def __call__(self, columns: dict) -> np.ndarray:
+        self.batch_sizes.append(len(columns["x"]))
+        if self.error:
+            raise self.error
+        return columns["x"] + 0.5
+
+
+def requests(sizes: list) -> list:
+    """Decoded columns of requests with `sizes` rows, numbered consecutively."""
+    bounds = np.cumsum([0] + sizes)
+    return [
+        {"x": np.arange(start, end, dtype=float)}
+        for start, end in zip(bounds, bounds[1:])
+    ]
+
+
+async def predict_all(batcher: MicroBatcher, columns: list, **kwargs) -> list:
+    return await asyncio.gather(*[batcher.predict(c) for c in columns], **kwargs)
+
+
+def test_micro_batcher_order():
+    """
+    Assert concurrent requests are predicted in one call, and each caller gets the
+    outputs of its own rows back
+    """
+    predict_fn = FakePredict()
+    batcher = MicroBatcher(predict_fn, window_ms=20, max_batch_size=100)
+    columns = requests([1, 3, 2])
+
+    outputs = asyncio.run(predict_all(batcher, columns))
+
+    assert predict_fn.batch_sizes == [6]
+    for c, output in zip(columns, outputs):
+        np.testing.assert_array_equal(output, c["x"] + 0.5)
+
+
+def test_micro_batcher_max_batch_size():
+    """Assert a batch is flushed as soon as max_batch_size rows are pending"""
+    predict_fn = FakePredict()
+    batcher = MicroBatcher(predict_fn, window_ms=10_000, max_batch_size=4)
+
+    async def run():
+        return await asyncio.wait_for(
+            predict_all(batcher, requests([2, 2, 1, 3])), timeout=5
+        )
+
+    outputs = asyncio.run(run())
+
+    assert predict_fn.batch_sizes == [4, 4]
+    np.testing.assert_array_equal(np.concatenate(outputs), np.arange(8) + 0.5)
+
+
+def test_micro_batcher_error_fan_out():
+    """Assert an error of the batch prediction is raised to every caller"""
+    error = RuntimeError("prediction failed")
+    batcher = MicroBatcher(FakePredict(error), window_ms=20, max_batch_size=100)
+
+    results = asyncio.run(
+        predict_all(batcher, requests([1, 2, 3]), return_exceptions=True)
+    )
+
+    assert results == [error] * 3
@@ -0,0 +1,103 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from prediction.decoding import FeatureSchema
+
+SCHEMA = FeatureSchema(
+    ["trip_miles", "company", "hourofday"], ["trip_miles", "hourofday"]
+)
+ROWS = [
+    {"trip_miles": 1.5, "company": "Flash Cab", "hourofday": 3},
+    {"trip_miles": None, "company": "Sun Taxi", "hourofday": 23},
+]
+
+
+def assert_columns_equal(columns: dict, expected: pd.DataFrame):
+    assert list(columns) == SCHEMA.columns
+    for col in SCHEMA.columns:
+        if col in SCHEMA.numeric:
+            assert columns[col].dtype == np.float64
+            np.testing.assert_array_equal(columns[col], expected[col].astype(float))
+        else:
+            assert columns[col].dtype == object
+            assert columns[col].tolist() == expected[col].tolist()
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        {"instances": ROWS},
+        {"instances": [[row[col] for col in SCHEMA.columns] for row in ROWS]},
+        {"columns": {col: [row[col] for row in ROWS] for col in SCHEMA.columns}},
+    ],
+    ids=["instance-dicts", "instance-lists", "columns"],
+)
+def test_decode(body):
+    """
+    Assert all payload shapes decode into the same typed columns as building a
+    DataFrame of the instances, with null as NaN
+    """
+    assert_columns_equal(SCHEMA.decode(body), pd.DataFrame(ROWS))
+
+
+def test_decode_sparse_instances():
+    """Assert keys missing from instance dicts are decoded as null"""
+    rows = [ROWS[0], {"company": "Sun Taxi", "hourofday": 23}]
+
+    columns = SCHEMA.decode({"instances": rows})
+
+    assert_columns_equal(columns, pd.DataFrame(ROWS))
+    assert np.isnan(columns["trip_miles"][1])
+
+
+def test_decode_ignores_extra_columns():
+    rows = [{**row, "extra": "x"} for row in ROWS]
+
+    assert_columns_equal(SCHEMA.decode({"instances": rows}), pd.DataFrame(ROWS))
+
+
+def test_decode_empty():
+    columns = SCHEMA.decode({"instances": []})
+
+    assert {col: len(values) for col, values in columns.items()} == {
+        "trip_miles": 0,
+        "company": 0,
+        "hourofday": 0,
+    }
+
+
+def test_decode_single_column():
+    schema = FeatureSchema(["company"], [])
+
+    columns = schema.decode({"instances": [{"company": "Flash Cab"}]})
+
+    assert columns["company"].tolist() == ["Flash Cab"]
+
+
+def test_schema_from_pipeline(fitted_pipeline):
+    schema = FeatureSchema.from_pipeline(fitted_pipeline)
+
+    preprocessor = fitted_pipeline.named_steps["feature_engineering"]
+    assert schema.columns == list(preprocessor.feature_names_in_)
+    assert schema.numeric == {
+        "dayofweek",
+        "hourofday",
+        "trip_distance",
+        "trip_miles",
+        "trip_seconds",
+    }
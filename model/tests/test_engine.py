@@ -0,0 +1,68 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+
+from prediction.engine import CompiledModel, PipelineModel
+from training.export import export_compiled_model
+from training.utils import split_xy
+
+from conftest import LABEL, make_trips
+
+
+@pytest.fixture(scope="module")
+def X_test():
+    """Unseen trips, including unknown categories and missing values."""
+    X, _ = split_xy(make_trips(300, seed=1), LABEL)
+    X.loc[0, "company"] = "Unknown Cab Company"
+    X.loc[1, "payment_type"] = "Dispute"
+    X.loc[2, "trip_miles"] = np.nan
+    return X
+
+
+def test_compiled_model_matches_pipeline(fitted_pipeline, X_test, tmp_path):
+    """
+    Assert the NumPy evaluation of the compiled export predicts the same as
+    `Pipeline.predict`, for a dense and a sparse ColumnTransformer output
+    """
+    export_compiled_model(fitted_pipeline, str(tmp_path))
+    model = CompiledModel.load(str(tmp_path))
+
+    columns = model.schema.decode({"columns": X_test.to_dict("list")})
+
+    np.testing.assert_allclose(
+        model.predict(columns), fitted_pipeline.predict(X_test), rtol=1e-5, atol=1e-4
+    )
+
+
+def test_compiled_model_schema(fitted_pipeline, tmp_path):
+    export_compiled_model(fitted_pipeline, str(tmp_path))
+    model = CompiledModel.load(str(tmp_path))
+
+    preprocessor = fitted_pipeline.named_steps["feature_engineering"]
+    assert model.schema.columns == list(preprocessor.feature_names_in_)
+    assert "trip_miles" in model.schema.numeric
+    assert "company" not in model.schema.numeric
+    assert model.source == (CompiledModel.load, str(tmp_path))
+
+
+def test_pipeline_model_matches_pipeline(fitted_pipeline, X_test):
+    model = PipelineModel(fitted_pipeline)
+
+    columns = model.schema.decode({"columns": X_test.to_dict("list")})
+
+    np.testing.assert_allclose(
+        model.predict(columns), fitted_pipeline.predict(X_test), rtol=1e-6
+    )
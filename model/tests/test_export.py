@@ -0,0 +1,73 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+
+import numpy as np
+import pytest
+import xgboost as xgb
+
+from prediction.engine import CompiledModel
+from training.export import (
+    COMPILED_TREES,
+    NATIVE_BOOSTER,
+    NODE_DTYPE,
+    export_compiled_model,
+    export_native_booster,
+)
+from training.utils import split_xy
+
+from conftest import LABEL
+
+
+def test_compiled_trees_memory_mapped(fitted_pipeline, tmp_path):
+    """
+    Assert the tree nodes are one .npy file of node records, which the server
+    memory-maps instead of reading it into memory
+    """
+    export_compiled_model(fitted_pipeline, str(tmp_path))
+
+    nodes = np.load(tmp_path / COMPILED_TREES)
+    assert nodes.dtype == NODE_DTYPE
+    model = CompiledModel.load(str(tmp_path))
+    for name in NODE_DTYPE.names:
+        assert isinstance(model.trees[name], np.memmap)
+
+
+def test_native_booster(fitted_pipeline, trips, tmp_path):
+    """Assert the booster saved as UBJSON loads without pickle and predicts the same"""
+    export_native_booster(fitted_pipeline, str(tmp_path))
+
+    booster = xgb.Booster(model_file=str(tmp_path / NATIVE_BOOSTER))
+    preprocessor = fitted_pipeline.named_steps["feature_engineering"]
+    X, _ = split_xy(trips, LABEL)
+    features = preprocessor.transform(X).astype(np.float32)
+
+    # like XGBRegressor.predict, only up to the best iteration saved with the model
+    best_trees = (0, int(booster.attr("best_iteration")) + 1)
+    np.testing.assert_allclose(
+        booster.inplace_predict(features, iteration_range=best_trees),
+        fitted_pipeline.predict(X),
+        rtol=1e-6,
+    )
+
+
+def test_export_unsupported_objective(fitted_pipeline, tmp_path):
+    pipeline = copy.deepcopy(fitted_pipeline)
+    pipeline.named_steps["train_model"].get_booster().set_param(
+        "objective", "reg:gamma"
+    )
+
+    with pytest.raises(ValueError, match="reg:gamma"):
+        export_compiled_model(pipeline, str(tmp_path))
@@ -0,0 +1,94 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import importlib
+import sys
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+
+from training.export import export_compiled_model
+from training.utils import split_xy
+
+from conftest import LABEL, make_trips
+
+
+class FakeRequest:
+    """Stands in for fastapi.Request, holds the JSON body."""
+
+    def __init__(self, body: dict):
+        self.body = body
+
+    async def json(self) -> dict:
+        return self.body
+
+
+@pytest.fixture
+def server(fitted_pipeline, tmp_path, monkeypatch):
+    """prediction.main imported fresh, serving the compiled `fitted_pipeline`."""
+    model_dir = tmp_path / "model"
+    model_dir.mkdir()
+    export_compiled_model(fitted_pipeline, str(model_dir))
+    monkeypatch.setenv("AIP_STORAGE_URI", str(model_dir))
+    monkeypatch.setenv("PREDICTION_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.delitem(sys.modules, "prediction.main", raising=False)
+
+    main = importlib.import_module("prediction.main")
+    yield main
+    main.shutdown()
+    sys.modules.pop("prediction.main", None)
+
+
+def predict(main, body: dict) -> dict:
+    return asyncio.run(main.predict(FakeRequest(body)))
+
+
+def test_predict(server, fitted_pipeline):
+    X, _ = split_xy(make_trips(20, seed=2), LABEL)
+
+    response = predict(server, {"instances": X.to_dict("records")})
+
+    np.testing.assert_allclose(
+        response["predictions"], fitted_pipeline.predict(X), rtol=1e-5, atol=1e-4
+    )
+
+
+def test_predict_unknown_version(server):
+    with pytest.raises(HTTPException) as err:
+        predict(server, {"instances": [], "model_version": "v2"})
+    assert err.value.status_code == 404
+
+
+def test_predict_without_default_model(server):
+    """
+    Assert requests for the default model get 503 (unavailable) rather than 429
+    (too many requests) while no model is loaded
+    """
+    server._registry._models.clear()
+    server._registry.default_version = None
+
+    with pytest.raises(HTTPException) as err:
+        predict(server, {"instances": []})
+    assert err.value.status_code == 503
+
+
+def test_predict_saturated(server):
+    server._executor.max_queue_depth = 0
+
+    with pytest.raises(HTTPException) as err:
+        predict(server, {"instances": []})
+    assert err.value.status_code == 429
+    assert err.value.headers == {"Retry-After": "1"}
@@ -0,0 +1,141 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.metrics import (
+    max_error,
+    mean_absolute_error,
+    mean_absolute_percentage_error,
+    mean_squared_error,
+    mean_squared_log_error,
+    r2_score,
+)
+
+from training.metrics import QUANTILES, RegressionMetrics
+from training.utils import VERTEX_METRICS, save_metrics
+
+
+@pytest.fixture
+def data():
+    """Labels, predictions and a segment column with a missing value."""
+    rng = np.random.default_rng(0)
+    n = 1000
+    y_true = rng.gamma(2.0, 10.0, n) + 1e6  # a large offset for r2's variance
+    y_pred = y_true + rng.normal(0, 5, n)
+    segments = pd.DataFrame(
+        {"payment_type": rng.choice(["Cash", "Credit Card", None], n)}
+    )
+    return y_true, y_pred, segments
+
+
+def sklearn_metrics(y_true, y_pred) -> dict:
+    return {
+        "count": len(y_true),
+        "rootMeanSquaredError": np.sqrt(mean_squared_error(y_true, y_pred)),
+        "meanAbsoluteError": mean_absolute_error(y_true, y_pred),
+        "meanAbsolutePercentageError": mean_absolute_percentage_error(y_true, y_pred),
+        "rSquared": r2_score(y_true, y_pred),
+        "maxAbsoluteError": max_error(y_true, y_pred),
+        "rootMeanSquaredLogError": np.sqrt(mean_squared_log_error(y_true, y_pred)),
+    }
+
+
+def assert_metrics_close(result: dict, expected: dict):
+    assert result.keys() >= expected.keys()
+    for key, value in expected.items():
+        assert result[key] == pytest.approx(value, rel=1e-9, abs=1e-12), key
+
+
+def test_metrics_chunks_match_sklearn(data):
+    """
+    Assert the metrics merged across uneven chunks match sklearn's on the whole
+    data, overall and per segment
+    """
+    y_true, y_pred, segments = data
+    metrics = RegressionMetrics(["payment_type"])
+
+    for start, end in [(0, 1), (1, 250), (250, 251), (251, 700), (700, 1000)]:
+        metrics.update(y_true[start:end], y_pred[start:end], segments[start:end])
+
+    result = metrics.result()
+    assert_metrics_close(result, sklearn_metrics(y_true, y_pred))
+    abs_error = np.abs(y_pred - y_true)
+    for q in QUANTILES:
+        # within the ~2.3% bin width of the histogram
+        assert result["absoluteErrorQuantiles"][f"p{q * 100:g}"] == pytest.approx(
+            np.quantile(abs_error, q), rel=0.03
+        )
+
+    records = metrics.segments()["payment_type"]
+    assert [r["count"] for r in records] == sorted(
+        [r["count"] for r in records], reverse=True
+    )
+    for record in records:
+        value = record["value"]
+        mask = segments["payment_type"].isna().to_numpy()
+        if value is not None:
+            mask = (segments["payment_type"] == value).to_numpy()
+        assert_metrics_close(record, sklearn_metrics(y_true[mask], y_pred[mask]))
+
+
+def test_metrics_edge_cases():
+    """
+    Assert constant labels follow sklearn's r2_score, and the log error is left
+    out where sklearn's mean_squared_log_error would raise
+    """
+    metrics = RegressionMetrics()
+    metrics.update([2.0, 2.0], [2.0, 2.0])
+    assert metrics.result()["rSquared"] == 1.0
+
+    metrics.update([2.0], [-1.5])
+    result = metrics.result()
+    assert result["rSquared"] == 0.0
+    assert "rootMeanSquaredLogError" not in result
+
+    assert RegressionMetrics().result() == {"count": 0, "absoluteErrorQuantiles": {}}
+    with pytest.raises(ValueError):
+        metrics.update([1.0, 2.0], [1.0])
+    with pytest.raises(ValueError):
+        RegressionMetrics(["payment_type"]).update([1.0], [1.0])
+
+
+def test_save_metrics(data, tmp_path):
+    """
+    Assert the metrics are saved in Vertex AI's regression schema, with the
+    quantiles and segments in the details only
+    """
+    y_true, y_pred, segments = data
+    metrics = RegressionMetrics(["payment_type"])
+    metrics.update(y_true, y_pred, segments)
+
+    save_metrics(metrics, tmp_path / "metrics.json", tmp_path / "details.json")
+
+    with open(tmp_path / "metrics.json") as fp:
+        saved = json.load(fp)
+    assert saved == {
+        "problemType": "regression",
+        **{key: metrics.result()[key] for key in VERTEX_METRICS},
+    }
+    with open(tmp_path / "details.json") as fp:
+        details = json.load(fp)
+    assert details["absoluteErrorQuantiles"].keys() == {"p50", "p90", "p95", "p99"}
+    assert {r["value"] for r in details["segments"]["payment_type"]} == {
+        "Cash",
+        "Credit Card",
+        None,
+    }
@@ -0,0 +1,82 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+import numpy as np
+import pandas as pd
+
+from training.monitoring import FeatureStats, bucket_edges
+
+NUMERIC_COLS = ["trip_miles"]
+CATEGORICAL_COLS = ["payment_type"]
+
+
+def make_df() -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "trip_miles": [0.5, 1.0, 1.5, np.nan, 2.0, 3.0, 10.0, np.nan],
+            "payment_type": ["Cash", "Cash", None, "Card"] * 2,
+        }
+    )
+
+
+def test_bucket_edges():
+    values = pd.Series(np.arange(100, dtype=np.float64))
+
+    assert bucket_edges(values, 4) == [24.75, 49.5, 74.25]
+    # repeated quantiles collapse into a single edge
+    assert bucket_edges(pd.Series([1.0] * 10 + [2.0]), 4) == [1.0]
+    assert bucket_edges(pd.Series([np.nan, np.nan])) == []
+
+
+def test_feature_stats_counts(tmp_path):
+    """
+    Assert the buckets, category frequencies and missing values are counted, with
+    edge values in the bucket above
+    """
+    stats = FeatureStats({"trip_miles": [1.0, 2.0]}, CATEGORICAL_COLS)
+
+    stats.update(make_df())
+
+    assert stats.to_dict() == {
+        "num_rows": 8,
+        "numeric": {
+            "trip_miles": {"edges": [1.0, 2.0], "counts": [1, 2, 3], "missing": 2}
+        },
+        "categorical": {
+            "payment_type": {"counts": {"Cash": 4, "Card": 2}, "missing": 2}
+        },
+    }
+    stats.save(tmp_path / "feature_stats.json")
+    with open(tmp_path / "feature_stats.json") as fp:
+        assert json.load(fp) == stats.to_dict()
+
+
+def test_feature_stats_chunks():
+    """
+    Assert the statistics accumulated chunk by chunk equal those of one pass,
+    including categories which only appear in later chunks
+    """
+    df = make_df()
+    edges = FeatureStats.from_sample(df, NUMERIC_COLS, CATEGORICAL_COLS, 4).edges
+    once = FeatureStats(edges, CATEGORICAL_COLS)
+    chunked = FeatureStats(edges, CATEGORICAL_COLS)
+
+    once.update(df)
+    for start in range(0, len(df), 3):
+        chunked.update(df[start : start + 3])
+
+    assert chunked.to_dict() == once.to_dict()
+    assert sum(once.to_dict()["numeric"]["trip_miles"]["counts"]) == 6
@@ -0,0 +1,84 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+from unittest import mock
+
+import joblib
+import pytest
+
+from prediction.artifacts import ArtifactCache
+from prediction.engine import CompiledModel, PipelineModel
+from prediction.registry import ModelRegistry
+from training.export import export_compiled_model
+
+
+@pytest.fixture
+def registry(tmp_path):
+    return ModelRegistry(ArtifactCache(tmp_path / "cache"))
+
+
+def test_registry_versions(registry, fitted_pipeline, tmp_path):
+    """
+    Assert the compiled export is preferred over model.joblib, and the default
+    version can be switched but not removed
+    """
+    compiled_dir, joblib_dir = tmp_path / "v1", tmp_path / "v2"
+    compiled_dir.mkdir()
+    joblib_dir.mkdir()
+    export_compiled_model(fitted_pipeline, str(compiled_dir))
+    joblib.dump(fitted_pipeline, joblib_dir / "model.joblib")
+
+    registry.load("v1", str(compiled_dir))
+    registry.load("v2", str(joblib_dir))
+    assert isinstance(registry.get()[1], CompiledModel)
+    assert isinstance(registry.get("v2")[1], PipelineModel)
+
+    registry.set_default("v2")
+    assert registry.get()[0] == "v2"
+    with pytest.raises(ValueError):
+        registry.remove("v2")
+    registry.remove("v1")
+    assert registry.status() == {"default": "v2", "versions": ["v2"], "loading": []}
+    with pytest.raises(KeyError):
+        registry.get("v1")
+    with pytest.raises(KeyError):
+        registry.set_default("v1")
+
+
+def test_registry_reload_while_loading(registry):
+    """
+    Assert a load which finishes while a newer load of the same version is still
+    running leaves the newer one listed as loading
+    """
+    released = {"gs://old": threading.Event(), "gs://new": threading.Event()}
+
+    def load(version, storage_uri, make_default=False):
+        assert released[storage_uri].wait(5)
+
+    async def run():
+        with mock.patch.object(registry, "load", side_effect=load):
+            old = registry.load_in_background("v2", "gs://old")
+            new = registry.load_in_background("v2", "gs://new")
+            released["gs://old"].set()
+            await old
+            await asyncio.sleep(0)  # done callbacks run in the next iteration
+            assert registry.status()["loading"] == ["v2"]
+            released["gs://new"].set()
+            await new
+            await asyncio.sleep(0)
+            assert registry.status()["loading"] == []
+
+    asyncio.run(run())
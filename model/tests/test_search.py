@@ -0,0 +1,83 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from training.search import search_pipeline, sample_params
+from training.train import build_pipeline, split_search_space
+from training.utils import split_xy
+
+from conftest import HPARAMS, LABEL
+
+SPACE = {
+    "max_depth": {"values": [2, 4]},
+    "min_child_weight": {"min": 1, "max": 8},
+    "learning_rate": {"min": 0.05, "max": 0.5, "log": True},
+}
+
+
+def test_sample_params():
+    rng = np.random.default_rng(0)
+
+    samples = [sample_params(SPACE, rng) for _ in range(50)]
+
+    assert {s["max_depth"] for s in samples} == {2, 4}
+    assert all(isinstance(s["min_child_weight"], int) for s in samples)
+    assert all(1 <= s["min_child_weight"] <= 8 for s in samples)
+    assert all(0.05 <= s["learning_rate"] <= 0.5 for s in samples)
+
+
+def test_split_search_space():
+    fixed, space = split_search_space({"n_estimators": 30, **SPACE})
+
+    assert fixed == {"n_estimators": 30}
+    assert space == SPACE
+    with pytest.raises(ValueError):
+        split_search_space({"n_estimators": {"values": [10, 20]}})
+
+
+@pytest.mark.parametrize(
+    "method, statuses",
+    [
+        ("random", {"complete", "early_stopped"}),
+        ("successive_halving", {"complete", "early_stopped", "pruned"}),
+    ],
+)
+def test_search_pipeline(trips, method, statuses):
+    """
+    Assert every trial is recorded, best first, and the pipeline's model is the
+    best trial with its hparams
+    """
+    X, y = split_xy(trips, LABEL)
+    fixed = {k: v for k, v in HPARAMS.items() if k not in SPACE}
+    pipeline = build_pipeline(X, fixed)
+
+    records = search_pipeline(
+        pipeline, X[:1500], y[:1500], X[1500:], y[1500:], SPACE, method, n_trials=9
+    )
+
+    assert sorted(r["trial"] for r in records) == list(range(9))
+    assert [r["score"] for r in records] == sorted(r["score"] for r in records)
+    assert set(r["status"] for r in records) <= statuses
+    if method == "successive_halving":
+        # 3 rungs: 9 trials, the best 3 of them, then the best one
+        assert Counter(r["status"] for r in records)["pruned"] == 8
+    best = records[0]
+    model = pipeline.named_steps["train_model"]
+    assert model.get_params()["max_depth"] == best["params"]["max_depth"]
+    assert int(model.get_booster().attr("best_iteration")) == best["best_iteration"]
+    assert pipeline.predict(X).shape == (len(X),)
@@ -0,0 +1,145 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+from unittest import mock
+
+import joblib
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.compose import ColumnTransformer
+
+from training import external_memory
+from training.train import (
+    NUM_COLS,
+    TRAINING_DATASET_INFO,
+    build_pipeline,
+    fit_pipeline,
+    train,
+)
+from training.utils import detect_file_format, split_xy
+
+from conftest import HPARAMS, LABEL, make_trips
+
+N_ROWS = 1000
+
+
+@pytest.fixture(scope="module")
+def input_path(tmp_path_factory):
+    """Folder of a CSV extract of the training table."""
+    folder = tmp_path_factory.mktemp("extract")
+    make_trips(N_ROWS).to_csv(folder / "data-000000000000", index=False)
+    return str(folder)
+
+
+def run_train(input_path: str, output_dir, hparams: dict = None, **kwargs) -> dict:
+    """Run `train` with the outputs in `output_dir`, returns the output paths."""
+    outputs = dict(
+        output_train_path=str(output_dir / "train" / "data"),
+        output_valid_path=str(output_dir / "valid" / "data"),
+        output_test_path=str(output_dir / "test" / "data"),
+        output_model=str(output_dir / "model"),
+        output_metrics=str(output_dir / "metrics" / "metrics.json"),
+    )
+    train(
+        input_path,
+        "",
+        **outputs,
+        hparams={**HPARAMS, "label": LABEL, **(hparams or {})},
+        **kwargs,
+    )
+    return outputs
+
+
+@pytest.mark.parametrize("split_format", ["csv", "parquet"])
+def test_train_splits(input_path, tmp_path, split_format):
+    """
+    Assert the splits are written in the split format, and only CSV splits are
+    referenced for model monitoring
+    """
+    outputs = run_train(input_path, tmp_path, split_format=split_format)
+
+    sizes = {}
+    for split in ["train", "valid", "test"]:
+        path = outputs[f"output_{split}_path"]
+        assert detect_file_format(path) == split_format
+        read = pd.read_csv if split_format == "csv" else pd.read_parquet
+        sizes[split] = len(read(path))
+    assert sizes == {"train": 600, "valid": 200, "test": 200}
+
+    info_path = os.path.join(outputs["output_model"], TRAINING_DATASET_INFO)
+    if split_format == "csv":
+        with open(info_path) as fp:
+            info = json.load(fp)
+        assert info["gcsSource"]["uris"] == [outputs["output_train_path"]]
+    else:
+        assert not os.path.exists(info_path)
+
+
+def test_fit_pipeline_fits_preprocessing_once(trips):
+    """
+    Assert the ColumnTransformer is fitted once, and only transforms the
+    validation data
+    """
+    X, y = split_xy(trips, LABEL)
+    pipeline = build_pipeline(X, HPARAMS)
+
+    with mock.patch.object(
+        ColumnTransformer,
+        "fit_transform",
+        autospec=True,
+        side_effect=ColumnTransformer.fit_transform,
+    ) as fit_transform, mock.patch.object(
+        ColumnTransformer,
+        "transform",
+        autospec=True,
+        side_effect=ColumnTransformer.transform,
+    ) as transform:
+        fit_pipeline(pipeline, X[:1500], y[:1500], X[1500:], y[1500:])
+
+    assert fit_transform.call_count == 1
+    assert transform.call_count == 1
+    assert len(transform.call_args.args[1]) == 500
+    assert pipeline.predict(X).shape == (len(X),)
+
+
+def test_train_external_memory(input_path, tmp_path, monkeypatch):
+    """
+    Assert training streams the data in batches, with the preprocessing fitted on
+    the whole training split
+    """
+    monkeypatch.setattr(external_memory, "BATCH_SIZE", 128)
+
+    outputs = run_train(input_path, tmp_path, engine="external_memory")
+
+    splits = {
+        split: pd.read_csv(outputs[f"output_{split}_path"])
+        for split in ["train", "valid", "test"]
+    }
+    assert sum(len(df) for df in splits.values()) == N_ROWS
+    pipeline = joblib.load(os.path.join(outputs["output_model"], "model.joblib"))
+    preprocessor = pipeline.named_steps["feature_engineering"]
+    scaler = preprocessor.named_transformers_["numeric_scaling"]
+    np.testing.assert_allclose(
+        scaler.mean_, splits["train"][NUM_COLS].mean(), rtol=1e-5
+    )
+    assert scaler.n_samples_seen_ == len(splits["train"])
+    encoder = preprocessor.named_transformers_["one_hot_encoding"]
+    assert set(encoder.categories_[0]) == set(splits["train"]["payment_type"])
+
+    with open(outputs["output_metrics"]) as fp:
+        metrics = json.load(fp)
+    assert metrics["rootMeanSquaredError"] < splits["test"][LABEL].std()
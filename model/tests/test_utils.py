@@ -0,0 +1,131 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fastavro
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.api.types import is_numeric_dtype
+
+from training.train import DTYPES
+from training.utils import expand_paths, iter_batches, read_files
+
+from conftest import make_trips
+
+CATEGORICAL_COLS = [col for col, dtype in DTYPES.items() if dtype == "category"]
+
+
+def write_avro(df: pd.DataFrame, path):
+    fields = [
+        {"name": col, "type": "double" if is_numeric_dtype(dtype) else "string"}
+        for col, dtype in df.dtypes.items()
+    ]
+    schema = fastavro.parse_schema({"type": "record", "name": "Row", "fields": fields})
+    with open(path, "wb") as f:
+        fastavro.writer(f, schema, df.to_dict("records"), codec="snappy")
+
+
+WRITERS = {
+    "csv": lambda df, path: df.to_csv(path, index=False),
+    "parquet": lambda df, path: df.to_parquet(path, index=False),
+    "avro": write_avro,
+}
+
+
+@pytest.fixture
+def trips():
+    """Trips of which each shard only holds some of the companies."""
+    return make_trips(300).sort_values("company", ignore_index=True)
+
+
+def write_shards(df: pd.DataFrame, folder, file_format: str, n_shards: int = 3):
+    """Write `df` like `bq extract` to `<folder>/data-*`, without file extension."""
+    folder.mkdir()
+    bounds = np.linspace(0, len(df), n_shards + 1).astype(int)
+    for idx, (start, end) in enumerate(zip(bounds, bounds[1:])):
+        WRITERS[file_format](df.iloc[start:end], folder / f"data-{idx:012d}")
+
+
+def assert_rows_equal(result: pd.DataFrame, df: pd.DataFrame):
+    """Assert `result` holds the rows of `df`, read with the compact DTYPES."""
+    pd.testing.assert_frame_equal(
+        result.astype({col: object for col in CATEGORICAL_COLS}),
+        df.astype({col: "float32" for col, t in DTYPES.items() if t == "float32"}),
+        check_dtype=False,
+        rtol=1e-6,
+    )
+
+
+@pytest.mark.parametrize("file_format", ["csv", "parquet", "avro"])
+@pytest.mark.parametrize("read_format", ["auto", "explicit"])
+def test_read_files_sharded(trips, tmp_path, file_format, read_format):
+    """
+    Assert all shards of a folder are read into one dataframe with compact dtypes,
+    with the union of the categories of the shards
+    """
+    write_shards(trips, tmp_path / "data", file_format)
+
+    result = read_files(
+        str(tmp_path / "data"),
+        file_format if read_format == "explicit" else "auto",
+        dtype=DTYPES,
+        max_workers=2,
+    )
+
+    for col, dtype in DTYPES.items():
+        assert result[col].dtype == dtype
+        if dtype == "category":
+            assert set(result[col].cat.categories) == set(trips[col])
+    assert_rows_equal(result, trips)
+
+
+@pytest.mark.parametrize("file_format", ["csv", "parquet", "avro"])
+def test_iter_batches_sharded(trips, tmp_path, file_format):
+    """Assert the shards are streamed in order, in batches of at most batch_size"""
+    write_shards(trips, tmp_path / "data", file_format)
+
+    batches = list(iter_batches(str(tmp_path / "data"), dtype=DTYPES, batch_size=40))
+
+    assert max(len(batch) for batch in batches) == 40
+    result = pd.concat(
+        [batch.astype({col: object for col in CATEGORICAL_COLS}) for batch in batches],
+        ignore_index=True,
+    )
+    assert_rows_equal(result, trips)
+
+
+def test_read_gzip_csv(trips, tmp_path):
+    """Assert CSV extracted with --compression=GZIP is read, without file extension"""
+    (tmp_path / "data").mkdir()
+    trips.to_csv(
+        tmp_path / "data" / "data-000000000000", index=False, compression="gzip"
+    )
+
+    assert_rows_equal(read_files(str(tmp_path / "data"), dtype=DTYPES), trips)
+    batches = iter_batches(str(tmp_path / "data"), "csv", DTYPES, batch_size=100)
+    assert [len(batch) for batch in batches] == [100, 100, 100]
+
+
+def test_expand_paths(tmp_path):
+    for name in ["data-000000000001", "data-000000000000", "other"]:
+        (tmp_path / name).touch()
+    (tmp_path / "subfolder").mkdir()
+
+    assert expand_paths(str(tmp_path / "data-*")) == [
+        str(tmp_path / "data-000000000000"),
+        str(tmp_path / "data-000000000001"),
+    ]
+    assert len(expand_paths(str(tmp_path))) == 3
+    with pytest.raises(FileNotFoundError):
+        expand_paths(str(tmp_path / "missing-*"))
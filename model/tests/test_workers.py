@@ -0,0 +1,101 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+from functools import partial
+
+import numpy as np
+import pytest
+
+from prediction.batching import MicroBatcher
+from prediction.workers import PredictionExecutor, Saturated
+
+
+class BlockingModel:
+    """Predicts twice the column "x" once the test sets `release`."""
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def predict(self, columns: dict) -> np.ndarray:
+        assert self.release.wait(5)
+        return columns["x"] * 2
+
+
+def test_executor_saturated():
+    """
+    Assert predictions beyond max_queue_depth raise Saturated while the admitted
+    ones still complete
+    """
+    executor = PredictionExecutor("thread", max_workers=1, max_queue_depth=2)
+    model = BlockingModel()
+
+    async def run():
+        columns = {"x": np.arange(3.0)}
+        admitted = [
+            asyncio.ensure_future(executor.predict(model, columns)) for _ in range(2)
+        ]
+        await asyncio.sleep(0)
+        assert executor.in_flight == 2
+        with pytest.raises(Saturated):
+            await executor.predict(model, columns)
+        model.release.set()
+        return await asyncio.gather(*admitted)
+
+    try:
+        outputs = asyncio.run(run())
+    finally:
+        executor.shutdown()
+
+    for output in outputs:
+        np.testing.assert_array_equal(output, [0, 2, 4])
+    assert executor.in_flight == 0
+
+
+def test_executor_admits_requests_queued_in_batcher():
+    """
+    Assert requests waiting in a MicroBatcher count towards max_queue_depth,
+    although they are predicted in a single call
+    """
+    executor = PredictionExecutor("none", max_queue_depth=2)
+    model = BlockingModel()
+    model.release.set()
+    batcher = MicroBatcher(
+        partial(executor.run, model), window_ms=50, max_batch_size=100
+    )
+
+    async def predict(columns):
+        with executor.admit():
+            return await batcher.predict(columns)
+
+    async def run():
+        queued = [
+            asyncio.ensure_future(predict({"x": np.array([float(i)])}))
+            for i in range(2)
+        ]
+        await asyncio.sleep(0)
+        with pytest.raises(Saturated):
+            await predict({"x": np.array([2.0])})
+        return await asyncio.gather(*queued)
+
+    outputs = asyncio.run(run())
+
+    assert [output.tolist() for output in outputs] == [[0.0], [2.0]]
+    assert executor.in_flight == 0
+
+
+def test_executor_type():
+    with pytest.raises(ValueError):
+        PredictionExecutor("gpu")
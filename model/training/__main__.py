@@ -17,7 +17,8 @@ import json
 import os
 import logging
 
-from .train import train
+from .train import MODEL_FORMATS, SEARCH_METHODS, TRAINING_ENGINES, train
+from .utils import FILE_FORMATS, SPLIT_FORMATS
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -30,6 +31,12 @@ parser.add_argument("--output_test_path", type=str, required=True)
 parser.add_argument("--output_model", default=os.getenv("AIP_MODEL_DIR"), type=str)
 parser.add_argument("--output_metrics", type=str, required=True)
 parser.add_argument("--hparams", default={}, type=json.loads)
+parser.add_argument("--model_format", default="joblib", choices=MODEL_FORMATS)
+parser.add_argument("--input_format", default="auto", choices=FILE_FORMATS)
+parser.add_argument("--split_format", default="csv", choices=SPLIT_FORMATS)
+parser.add_argument("--engine", default="sklearn", choices=TRAINING_ENGINES)
+parser.add_argument("--search", default="none", choices=SEARCH_METHODS)
+parser.add_argument("--n_trials", default=16, type=int)
 args = vars(parser.parse_args())
 
 train(**args)
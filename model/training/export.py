@@ -0,0 +1,183 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import logging
+
+import numpy as np
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, OrdinalEncoder, StandardScaler
+
+# file names read by prediction/engine.py and the model_batch_predict component
+COMPILED_MODEL = "compiled_model.json"
+COMPILED_TREES = "compiled_trees.npy"
+NATIVE_BOOSTER = "model.ubj"
+# one record per tree node, leaves point to themselves and hold their value
+NODE_DTYPE = np.dtype(
+    [
+        ("split_index", np.int32),
+        ("threshold", np.float32),
+        ("left", np.int32),
+        ("right", np.int32),
+        ("default_left", bool),
+        ("value", np.float32),
+    ]
+)
+# objectives whose prediction is the raw margin (identity link)
+IDENTITY_OBJECTIVES = [
+    "reg:squarederror",
+    "reg:squaredlogerror",
+    "reg:absoluteerror",
+    "reg:pseudohubererror",
+]
+
+
+def _export_preprocessing(preprocessor) -> list:
+    """Flatten the fitted ColumnTransformer into plain parameter blocks."""
+    columns = list(preprocessor.feature_names_in_)
+    blocks = []
+    for name, transformer, indices in preprocessor.transformers_:
+        if name == "remainder":
+            continue
+        block_columns = [columns[idx] for idx in indices]
+        if isinstance(transformer, StandardScaler):
+            n = len(block_columns)
+            mean = transformer.mean_ if transformer.with_mean else np.zeros(n)
+            scale = transformer.scale_ if transformer.with_std else np.ones(n)
+            blocks.append(
+                {
+                    "type": "standard_scaler",
+                    "columns": block_columns,
+                    "mean": mean.tolist(),
+                    "scale": scale.tolist(),
+                }
+            )
+        elif isinstance(transformer, OneHotEncoder):
+            if transformer.drop is not None:
+                raise ValueError(f"{name}: OneHotEncoder with drop is not supported")
+            blocks.append(
+                {
+                    "type": "one_hot",
+                    "columns": block_columns,
+                    "categories": [c.tolist() for c in transformer.categories_],
+                }
+            )
+        elif isinstance(transformer, OrdinalEncoder):
+            blocks.append(
+                {
+                    "type": "ordinal",
+                    "columns": block_columns,
+                    "categories": [c.tolist() for c in transformer.categories_],
+                    "unknown_value": float(transformer.unknown_value),
+                }
+            )
+        else:
+            raise ValueError(f"{name}: {type(transformer).__name__} is not supported")
+    return blocks
+
+
+def _export_trees(trees: list) -> (np.ndarray, list, int):
+    """Concatenate trees of an XGBoost JSON model into one array of nodes.
+
+    Child indices are global (offset into the concatenated array) and leaves point
+    to themselves, so a fixed number of steps lands every row on its leaf.
+
+    Returns:
+        (np.ndarray, list, int): nodes (NODE_DTYPE), index of each tree's root
+            and depth of the deepest leaf
+    """
+    nodes, roots = [], []
+    offset, max_depth = 0, 0
+    for tree in trees:
+        if any(tree["split_type"]):
+            raise ValueError("Categorical splits are not supported")
+        left = np.asarray(tree["left_children"], dtype=np.int64)
+        right = np.asarray(tree["right_children"], dtype=np.int64)
+        is_leaf = left == -1
+        node_ids = np.arange(len(left))
+        conditions = np.asarray(tree["split_conditions"], dtype=np.float32)
+
+        stack = [(0, 0)]
+        while stack:
+            node, depth = stack.pop()
+            max_depth = max(max_depth, depth)
+            if not is_leaf[node]:
+                stack += [(left[node], depth + 1), (right[node], depth + 1)]
+
+        tree_nodes = np.zeros(len(left), dtype=NODE_DTYPE)
+        tree_nodes["split_index"] = np.where(is_leaf, 0, tree["split_indices"])
+        tree_nodes["threshold"] = np.where(is_leaf, 0, conditions)
+        tree_nodes["left"] = np.where(is_leaf, node_ids, left) + offset
+        tree_nodes["right"] = np.where(is_leaf, node_ids, right) + offset
+        tree_nodes["default_left"] = tree["default_left"]
+        tree_nodes["value"] = np.where(is_leaf, conditions, 0)
+        nodes.append(tree_nodes)
+        roots.append(offset)
+        offset += len(left)
+
+    return np.concatenate(nodes), roots, max_depth
+
+
+def export_compiled_model(pipeline: Pipeline, output_dir: str):
+    """Export a fitted preprocessing + XGBRegressor pipeline as plain arrays.
+
+    The result is evaluated with NumPy only by prediction/engine.py, without the
+    per-call validation overhead of sklearn and without importing it at all.
+    Only trees up to the best iteration are kept, like `XGBRegressor.predict`.
+    The tree nodes are a single .npy file so that the server can memory-map them.
+
+    Args:
+        pipeline (Pipeline): fitted pipeline as built in `train()`
+        output_dir (str): directory to write COMPILED_MODEL and COMPILED_TREES to
+    """
+    preprocessor = pipeline.named_steps["feature_engineering"]
+    booster = pipeline.named_steps["train_model"].get_booster()
+
+    model = json.loads(booster.save_raw("json"))["learner"]
+    objective = model["objective"]["name"]
+    if objective not in IDENTITY_OBJECTIVES:
+        raise ValueError(f"Objective {objective} is not supported")
+    if model["gradient_booster"]["name"] != "gbtree":
+        raise ValueError("Only the gbtree booster is supported")
+    # stored as "1.5E1" in older and "[1.5E1]" in newer XGBoost versions
+    base_score = float(model["learner_model_param"]["base_score"].strip("[]"))
+
+    n_trees = booster.num_boosted_rounds()
+    best_iteration = booster.attr("best_iteration")
+    if best_iteration is not None:
+        n_trees = int(best_iteration) + 1
+    gbtree = model["gradient_booster"]["model"]
+    n_trees *= int(gbtree["gbtree_model_param"]["num_parallel_tree"])
+
+    nodes, roots, max_depth = _export_trees(gbtree["trees"][:n_trees])
+    compiled = {
+        "columns": list(preprocessor.feature_names_in_),
+        "preprocessing": _export_preprocessing(preprocessor),
+        # XGBoost treats implicit zeros of sparse inputs as missing values
+        "sparse_output": bool(preprocessor.sparse_output_),
+        "base_score": base_score,
+        "max_depth": max_depth,
+        "roots": roots,
+    }
+
+    logging.info(f"Save compiled model ({n_trees} trees) to: {output_dir}")
+    with open(f"{output_dir}/{COMPILED_MODEL}", "w") as fp:
+        json.dump(compiled, fp)
+    np.save(f"{output_dir}/{COMPILED_TREES}", nodes)
+
+
+def export_native_booster(pipeline: Pipeline, output_dir: str):
+    """Save the booster in XGBoost's own UBJSON format, loadable without pickle."""
+    booster = pipeline.named_steps["train_model"].get_booster()
+    logging.info(f"Save native booster to: {output_dir}/{NATIVE_BOOSTER}")
+    booster.save_model(f"{output_dir}/{NATIVE_BOOSTER}")
@@ -0,0 +1,242 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import os
+import tempfile
+from contextlib import ExitStack
+
+import numpy as np
+import xgboost as xgb
+from sklearn.compose import ColumnTransformer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+from .metrics import RegressionMetrics
+from .monitoring import FeatureStats
+from .train import (
+    DTYPES,
+    NUM_COLS,
+    OHE_COLS,
+    ORD_COLS,
+    SEGMENT_COLS,
+    booster_params,
+    build_pipeline,
+    evaluate,
+    feature_stats,
+    load_booster,
+)
+from .utils import BatchWriter, iter_batches, split_xy
+
+# rows per batch read from the files, bounds the memory used for the raw data
+BATCH_SIZE = 250_000
+# the split is random per row, with the same fractions as in train_test_split
+VALID_FRACTION = 0.2
+TEST_FRACTION = 0.2
+
+
+class _BatchIterator(xgb.DataIter):
+    """Feed the preprocessed batches of a split file to XGBoost."""
+
+    def __init__(
+        self,
+        path: str,
+        file_format: str,
+        preprocessor: ColumnTransformer,
+        label: str,
+        cache_prefix: str,
+    ):
+        self.path = path
+        self.file_format = file_format
+        self.preprocessor = preprocessor
+        self.label = label
+        self._batches = None
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data) -> int:
+        if self._batches is None:
+            self._batches = iter_batches(
+                self.path, self.file_format, DTYPES, BATCH_SIZE
+            )
+        df = next(self._batches, None)
+        if df is None:
+            return 0
+        X, y = split_xy(df, self.label)
+        input_data(
+            data=self.preprocessor.transform(X).astype(np.float32), label=y.to_numpy()
+        )
+        return 1
+
+    def reset(self):
+        self._batches = None
+
+
+def _split_and_fit_preprocessing(
+    input_path: str,
+    input_format: str,
+    input_test_path: str,
+    output_paths: list,
+    split_format: str,
+    label: str,
+    hparams: dict,
+) -> (Pipeline, FeatureStats):
+    """First streaming pass: write the splits and fit the preprocessing.
+
+    The scaler statistics are accumulated with `StandardScaler.partial_fit` and the
+    category vocabularies as sets, both on the training rows only, like fitting
+    the ColumnTransformer on the training dataframe would. The feature statistics
+    for skew checks are accumulated in the same pass, with bucket edges from the
+    first batch.
+
+    Returns:
+        (Pipeline, FeatureStats): pipeline with fitted preprocessing and unfitted
+            model, statistics of the training split
+    """
+    rng = np.random.default_rng(1)
+    scaler = StandardScaler()
+    vocabularies = {col: set() for col in ORD_COLS + OHE_COLS}
+    has_missing = {col: False for col in vocabularies}
+    sample, stats = None, None
+
+    with ExitStack() as stack:
+        train, valid, test = [
+            stack.enter_context(BatchWriter(path, split_format))
+            for path in output_paths
+        ]
+        for df in iter_batches(input_path, input_format, DTYPES, BATCH_SIZE):
+            u = rng.random(len(df))
+            is_valid = u < VALID_FRACTION
+            is_test = np.zeros(len(df), dtype=bool)
+            if not input_test_path:
+                is_test = (u >= VALID_FRACTION) & (u < VALID_FRACTION + TEST_FRACTION)
+            df_train = df[~is_valid & ~is_test]
+            train.write(df_train)
+            valid.write(df[is_valid])
+            test.write(df[is_test])
+
+            X_train, _ = split_xy(df_train, label)
+            if sample is None:
+                sample, stats = X_train, feature_stats(X_train)
+            stats.update(X_train)
+            scaler.partial_fit(X_train[[c for c in X_train.columns if c in NUM_COLS]])
+            for col in vocabularies:
+                vocabularies[col].update(X_train[col].dropna().unique())
+                has_missing[col] |= bool(X_train[col].isna().any())
+
+        if input_test_path:
+            for df in iter_batches(input_test_path, "auto", DTYPES, BATCH_SIZE):
+                test.write(df)
+
+    if sample is None:
+        raise ValueError(f"No training data found in {input_path}")
+    logging.info(f"Split into {train.n_rows}/{valid.n_rows}/{test.n_rows} rows")
+
+    # sorted, with missing values last, like the encoders' own categories_
+    categories = {
+        col: sorted(values) + ([np.nan] if has_missing[col] else [])
+        for col, values in vocabularies.items()
+    }
+    pipeline = build_pipeline(sample, hparams, categories)
+    preprocessor = pipeline.named_steps["feature_engineering"]
+    # fit on one batch, then replace the scaler statistics by the full ones
+    preprocessor.fit(sample)
+    fitted_scaler = preprocessor.named_transformers_["numeric_scaling"]
+    for attr in ["mean_", "var_", "scale_", "n_samples_seen_"]:
+        setattr(fitted_scaler, attr, getattr(scaler, attr))
+    return pipeline, stats
+
+
+def train_external_memory(
+    input_path: str,
+    input_format: str,
+    input_test_path: str,
+    output_paths: list,
+    split_format: str,
+    label: str,
+    hparams: dict,
+) -> (Pipeline, RegressionMetrics, FeatureStats):
+    """Train on data which does not fit into memory.
+
+    1. One streaming pass writes the train/valid/test splits and fits the
+       preprocessing statistics (see `_split_and_fit_preprocessing`).
+    2. XGBoost reads the preprocessed train and valid splits batch by batch and
+       keeps its own (quantized) copy in a cache on local disk.
+    3. The test split is predicted and evaluated batch by batch.
+
+    Args:
+        input_path (str): file, folder or wildcard path of the input data
+        input_format (str): one of FILE_FORMATS
+        input_test_path (str): optional static test data
+        output_paths (list): paths of the train, valid and test splits
+        split_format (str): one of SPLIT_FORMATS
+        label (str): name of the label column
+        hparams (dict): parameters of XGBRegressor
+    Returns:
+        (Pipeline, RegressionMetrics, FeatureStats): fitted pipeline, its test
+            metrics and the statistics of the training split
+    """
+    logging.info("Split data and fit preprocessing in one streaming pass")
+    pipeline, stats = _split_and_fit_preprocessing(
+        input_path,
+        input_format,
+        input_test_path,
+        output_paths,
+        split_format,
+        label,
+        hparams,
+    )
+    preprocessor = pipeline.named_steps["feature_engineering"]
+    model = pipeline.named_steps["train_model"]
+    params = booster_params(model)
+    train_path, valid_path, test_path = output_paths
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        train_iter, valid_iter = [
+            _BatchIterator(
+                path, split_format, preprocessor, label, os.path.join(cache_dir, name)
+            )
+            for path, name in [(train_path, "train"), (valid_path, "valid")]
+        ]
+        logging.info(f"Build external memory DMatrix in {cache_dir}")
+        if hasattr(xgb, "ExtMemQuantileDMatrix"):
+            # XGBoost >= 3.0, quantized pages for the hist tree method
+            dtrain = xgb.ExtMemQuantileDMatrix(
+                train_iter, max_bin=params["max_bin"], nthread=params["nthread"]
+            )
+            dvalid = xgb.ExtMemQuantileDMatrix(
+                valid_iter,
+                max_bin=params["max_bin"],
+                nthread=params["nthread"],
+                ref=dtrain,
+            )
+        else:
+            dtrain = xgb.DMatrix(train_iter, nthread=params["nthread"])
+            dvalid = xgb.DMatrix(valid_iter, nthread=params["nthread"])
+
+        logging.info(f"Train booster with {params}")
+        booster = xgb.train(
+            params,
+            dtrain,
+            num_boost_round=model.n_estimators or 100,
+            evals=[(dvalid, "validation_0")],
+            early_stopping_rounds=model.early_stopping_rounds,
+        )
+        load_booster(model, booster)
+        # release the cache files before their directory is removed
+        del dtrain, dvalid
+
+    logging.info("Evaluate on test data")
+    metrics = RegressionMetrics(SEGMENT_COLS)
+    for df in iter_batches(test_path, split_format, DTYPES, BATCH_SIZE):
+        evaluate(pipeline, *split_xy(df, label), metrics)
+    return pipeline, metrics, stats
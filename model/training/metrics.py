@@ -0,0 +1,230 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import numpy as np
+import pandas as pd
+
+# quantiles of the absolute error reported next to the Vertex AI metrics
+QUANTILES = [0.5, 0.9, 0.95, 0.99]
+# log-spaced histogram of absolute errors from 1e-4 to 1e6 for the quantiles,
+# 100 bins per decade bound their relative error to ~2.3%
+HIST_MIN_LOG10, HIST_MAX_LOG10, BINS_PER_DECADE = -4, 6, 100
+HIST_EDGES = np.concatenate(
+    [
+        [0.0],
+        np.logspace(
+            HIST_MIN_LOG10,
+            HIST_MAX_LOG10,
+            (HIST_MAX_LOG10 - HIST_MIN_LOG10) * BINS_PER_DECADE + 1,
+        ),
+    ]
+)
+# the first bin holds the errors below 1e-4, the last one those above 1e6
+N_BINS = len(HIST_EDGES)
+# same epsilon as sklearn's mean_absolute_percentage_error
+EPS = np.finfo(np.float64).eps
+
+# columns of the per-group statistics, all sums except for MEAN, M2 and MAX_AE
+N, SE, AE, APE, SLE, LOG_INVALID, MEAN, M2, MAX_AE = range(9)
+N_STATS = 9
+
+
+def _row_terms(y_true: np.ndarray, y_pred: np.ndarray) -> dict:
+    """Per-row terms of the metrics, computed once per chunk."""
+    error = y_pred - y_true
+    abs_error = np.abs(error)
+    # log1p is defined above -1, rows outside make the log error undefined
+    log_valid = (y_true > -1) & (y_pred > -1)
+    log_error = np.log1p(np.where(log_valid, y_pred, 0)) - np.log1p(
+        np.where(log_valid, y_true, 0)
+    )
+    return {
+        SE: error * error,
+        AE: abs_error,
+        APE: abs_error / np.maximum(np.abs(y_true), EPS),
+        SLE: log_error * log_error,
+        LOG_INVALID: ~log_valid,
+        "y_true": y_true,
+    }
+
+
+def _group_stats(terms: dict, groups: np.ndarray = None, n_groups: int = 1):
+    """Statistics of one chunk per group, plain sums if there is a single group.
+
+    Args:
+        terms (dict): per-row terms from `_row_terms`
+        groups (np.ndarray): group index of every row, in [0, n_groups)
+        n_groups (int): number of groups
+    Returns:
+        np.ndarray: float64 array of shape (n_groups, N_STATS)
+    """
+    y_true, abs_error = terms["y_true"], terms[AE]
+    stats = np.zeros((n_groups, N_STATS))
+    # the centered second moment of the labels, merged with Chan et al.'s formula
+    # in _merge_stats, stays accurate where sum(y^2) - sum(y)^2 / n would not
+    if groups is None:
+        stats[0, N] = len(y_true)
+        for col in [SE, AE, APE, SLE, LOG_INVALID]:
+            stats[0, col] = terms[col].sum()
+        stats[0, MEAN] = y_true.mean()
+        stats[0, M2] = np.square(y_true - stats[0, MEAN]).sum()
+        stats[0, MAX_AE] = abs_error.max()
+    else:
+        stats[:, N] = np.bincount(groups, minlength=n_groups)
+        for col in [SE, AE, APE, SLE, LOG_INVALID]:
+            stats[:, col] = np.bincount(groups, terms[col], n_groups)
+        stats[:, MEAN] = np.bincount(groups, y_true, n_groups) / stats[:, N]
+        centered = y_true - stats[groups, MEAN]
+        stats[:, M2] = np.bincount(groups, centered * centered, n_groups)
+        np.maximum.at(stats[:, MAX_AE], groups, abs_error)
+    return stats
+
+
+def _histogram_bins(abs_error: np.ndarray) -> np.ndarray:
+    """Histogram bin of every absolute error, computed instead of searched."""
+    with np.errstate(divide="ignore"):
+        position = (np.log10(abs_error) - HIST_MIN_LOG10) * BINS_PER_DECADE
+    return np.clip(np.floor(position) + 1, 0, N_BINS - 1).astype(np.intp)
+
+
+def _merge_stats(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Combine the statistics of two disjoint sets of rows, group by group."""
+    merged = a + b
+    n = np.maximum(merged[:, N], 1)
+    delta = b[:, MEAN] - a[:, MEAN]
+    merged[:, MEAN] = a[:, MEAN] + delta * b[:, N] / n
+    merged[:, M2] = a[:, M2] + b[:, M2] + delta * delta * a[:, N] * b[:, N] / n
+    merged[:, MAX_AE] = np.maximum(a[:, MAX_AE], b[:, MAX_AE])
+    return merged
+
+
+def _metrics(stats: np.ndarray) -> dict:
+    """Regression metrics of one group, named like in Vertex AI's schema."""
+    n = stats[N]
+    if n == 0:
+        return {"count": 0}
+    ss_res, ss_tot = stats[SE], stats[M2]
+    if ss_tot > 0:
+        r2 = 1 - ss_res / ss_tot
+    else:
+        # constant labels, like sklearn's r2_score with force_finite=True
+        r2 = 1.0 if ss_res == 0 else 0.0
+    metrics = {
+        "count": int(n),
+        "rootMeanSquaredError": float(np.sqrt(ss_res / n)),
+        "meanAbsoluteError": float(stats[AE] / n),
+        "meanAbsolutePercentageError": float(stats[APE] / n),
+        "rSquared": float(r2),
+        "maxAbsoluteError": float(stats[MAX_AE]),
+    }
+    if stats[LOG_INVALID] == 0:
+        metrics["rootMeanSquaredLogError"] = float(np.sqrt(stats[SLE] / n))
+    return metrics
+
+
+def _segment_key(value):
+    """JSON serializable segment value, None for missing values."""
+    if pd.isna(value):
+        return None
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class RegressionMetrics:
+    """Regression metrics accumulated over chunks of labels and predictions.
+
+    Each `update` is a single vectorized pass over the chunk in float64, the
+    totals are merged exactly, so evaluating a test set chunk by chunk gives the
+    same metrics as evaluating it at once. Only the quantiles of the absolute
+    error are approximate, they are read from a fixed log-spaced histogram.
+    The root mean squared log error is left out if a label or prediction is at
+    or below -1, where sklearn's `mean_squared_log_error` would raise.
+
+    Args:
+        segment_cols (list): columns to break the metrics down by
+    """
+
+    def __init__(self, segment_cols: list = None):
+        self.segment_cols = list(segment_cols or [])
+        self._total = np.zeros((1, N_STATS))
+        self._histogram = np.zeros(N_BINS, dtype=np.int64)
+        self._segment_values = {col: {} for col in self.segment_cols}
+        self._segment_stats = {col: np.zeros((0, N_STATS)) for col in self.segment_cols}
+
+    def update(self, y_true, y_pred, segments: pd.DataFrame = None):
+        """Add a chunk of labels and predictions.
+
+        Args:
+            y_true (array-like): labels
+            y_pred (array-like): predictions
+            segments (pd.DataFrame): values of `segment_cols` for the same rows
+        """
+        y_true = np.asarray(y_true, dtype=np.float64).ravel()
+        y_pred = np.asarray(y_pred, dtype=np.float64).ravel()
+        if len(y_true) != len(y_pred):
+            raise ValueError(f"{len(y_true)} labels but {len(y_pred)} predictions")
+        if self.segment_cols and segments is None:
+            raise ValueError(f"Segment columns {self.segment_cols} are missing")
+        if len(y_true) == 0:
+            return
+
+        terms = _row_terms(y_true, y_pred)
+        self._total = _merge_stats(self._total, _group_stats(terms))
+        self._histogram += np.bincount(_histogram_bins(terms[AE]), minlength=N_BINS)
+
+        for col in self.segment_cols:
+            codes, uniques = pd.factorize(segments[col], use_na_sentinel=False)
+            known = self._segment_values[col]
+            rows = [known.setdefault(_segment_key(v), len(known)) for v in uniques]
+            chunk_stats = np.zeros((len(known), N_STATS))
+            chunk_stats[rows] = _group_stats(terms, codes, len(uniques))
+            stats = self._segment_stats[col]
+            stats = np.vstack([stats, np.zeros((len(known) - len(stats), N_STATS))])
+            self._segment_stats[col] = _merge_stats(stats, chunk_stats)
+
+    def quantiles(self) -> dict:
+        """Approximate quantiles of the absolute error, e.g. {"p50": 0.12}."""
+        n = self._histogram.sum()
+        if n == 0:
+            return {}
+        max_error = self._total[0, MAX_AE]
+        upper_edges = np.append(HIST_EDGES[1:], max_error)
+        cumulative = np.cumsum(self._histogram)
+        result = {}
+        for q in QUANTILES:
+            rank = q * n
+            b = int(np.searchsorted(cumulative, rank))
+            below = cumulative[b - 1] if b > 0 else 0
+            fraction = (rank - below) / self._histogram[b]
+            value = HIST_EDGES[b] + fraction * (upper_edges[b] - HIST_EDGES[b])
+            result[f"p{q * 100:g}"] = float(min(value, max_error))
+        return result
+
+    def result(self) -> dict:
+        """Overall metrics, including the absolute error quantiles."""
+        return {
+            **_metrics(self._total[0]),
+            "absoluteErrorQuantiles": self.quantiles(),
+        }
+
+    def segments(self) -> dict:
+        """Metrics per segment value, by column, most frequent values first."""
+        result = {}
+        for col in self.segment_cols:
+            values = self._segment_values[col]
+            stats = self._segment_stats[col]
+            records = [
+                {"value": value, **_metrics(stats[row])}
+                for value, row in values.items()
+            ]
+            result[col] = sorted(records, key=lambda r: -r["count"])
+        return result
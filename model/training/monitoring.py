@@ -0,0 +1,113 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import logging
+
+import numpy as np
+import pandas as pd
+
+# file name must match the one read by the model_batch_predict component
+FEATURE_STATS = "feature_stats.json"
+# buckets per numeric feature, their edges are quantiles of the training data
+N_BUCKETS = 20
+
+
+def bucket_edges(values: pd.Series, n_buckets: int = N_BUCKETS) -> list:
+    """Inner edges of buckets holding about the same number of training values."""
+    values = values.to_numpy(dtype=np.float64, na_value=np.nan)
+    if np.isnan(values).all():
+        return []
+    quantiles = np.linspace(0, 1, n_buckets + 1)[1:-1]
+    return np.unique(np.nanquantile(values, quantiles)).tolist()
+
+
+class FeatureStats:
+    """Statistics of the training features, the baseline for skew checks.
+
+    Numeric features are counted in buckets between fixed `edges` (value v is in
+    bucket i if edges[i - 1] <= v < edges[i], with open first and last buckets),
+    categorical features as a frequency table, missing values separately. The
+    statistics are accumulated chunk by chunk, so computing them takes one pass
+    over the training split, and comparing a prediction batch against them costs
+    O(batch) instead of a scan of the training data.
+
+    Args:
+        edges (dict): bucket edges per numeric column, see `bucket_edges`
+        categorical_cols (list): categorical columns
+    """
+
+    def __init__(self, edges: dict, categorical_cols: list):
+        self.edges = edges
+        self.categorical_cols = list(categorical_cols)
+        self.n_rows = 0
+        self._buckets = {
+            col: np.zeros(len(values) + 1, np.int64) for col, values in edges.items()
+        }
+        self._counts = {col: pd.Series(dtype=np.int64) for col in categorical_cols}
+        self._missing = {col: 0 for col in [*edges, *categorical_cols]}
+
+    @classmethod
+    def from_sample(
+        cls,
+        sample: pd.DataFrame,
+        numeric_cols: list,
+        categorical_cols: list,
+        n_buckets: int = N_BUCKETS,
+    ):
+        """Empty statistics with bucket edges at the quantiles of `sample`."""
+        edges = {col: bucket_edges(sample[col], n_buckets) for col in numeric_cols}
+        return cls(edges, categorical_cols)
+
+    def update(self, df: pd.DataFrame):
+        """Add a chunk of training rows."""
+        self.n_rows += len(df)
+        for col, edges in self.edges.items():
+            values = df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+            is_missing = np.isnan(values)
+            buckets = np.searchsorted(edges, values[~is_missing], side="right")
+            self._buckets[col] += np.bincount(buckets, minlength=len(edges) + 1)
+            self._missing[col] += int(is_missing.sum())
+        for col in self.categorical_cols:
+            counts = df[col].value_counts(dropna=True)
+            self._counts[col] = self._counts[col].add(counts, fill_value=0)
+            self._missing[col] += int(df[col].isna().sum())
+
+    def to_dict(self) -> dict:
+        return {
+            "num_rows": self.n_rows,
+            "numeric": {
+                col: {
+                    "edges": edges,
+                    "counts": self._buckets[col].tolist(),
+                    "missing": self._missing[col],
+                }
+                for col, edges in self.edges.items()
+            },
+            "categorical": {
+                col: {
+                    "counts": {
+                        str(value): int(count)
+                        for value, count in self._counts[col].items()
+                        if count > 0
+                    },
+                    "missing": self._missing[col],
+                }
+                for col in self.categorical_cols
+            },
+        }
+
+    def save(self, output_path: str):
+        logging.info(f"Save feature statistics for skew checks to: {output_path}")
+        with open(output_path, "w") as fp:
+            json.dump(self.to_dict(), fp)
@@ -0,0 +1,210 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import xgboost as xgb
+from sklearn.pipeline import Pipeline
+
+from .train import booster_params, load_booster
+
+# fraction of trials kept (1 / ETA) and growth of their rounds per rung
+ETA = 3
+
+
+def sample_params(space: dict, rng: np.random.Generator) -> dict:
+    """Draw one set of hparams from a search space (see `split_search_space`)."""
+    params = {}
+    for name, spec in space.items():
+        if "values" in spec:
+            params[name] = spec["values"][rng.integers(len(spec["values"]))]
+            continue
+        low, high = spec["min"], spec["max"]
+        if spec.get("log"):
+            value = math.exp(rng.uniform(math.log(low), math.log(high)))
+        else:
+            value = rng.uniform(low, high)
+        if isinstance(low, int) and isinstance(high, int):
+            value = min(int(round(value)), high)
+        params[name] = value
+    return params
+
+
+class _Trial:
+    """One sampled configuration, trained rung by rung."""
+
+    def __init__(self, number: int, params: dict):
+        self.number = number
+        self.params = params
+        self.booster = None
+        self.history = []
+        self.status = "running"
+
+    @property
+    def score(self) -> float:
+        # the regression metrics (rmse, mae, ...) are all better when lower
+        return min(self.history) if self.history else math.inf
+
+    @property
+    def best_iteration(self) -> int:
+        return int(np.argmin(self.history))
+
+    def record(self) -> dict:
+        return {
+            "trial": self.number,
+            "params": self.params,
+            "status": self.status,
+            "rounds": len(self.history),
+            "best_iteration": self.best_iteration,
+            "score": self.score,
+        }
+
+
+class _Search:
+    """Trials sharing the preprocessed features and their quantized DMatrix."""
+
+    def __init__(self, base_params, X_train, y_train, X_valid, y_valid):
+        self.base_params = base_params
+        self.data = (X_train, y_train, X_valid, y_valid)
+        self._dmatrices = {}
+        self._lock = threading.Lock()
+
+    def dmatrices(self, max_bin: int) -> (xgb.QuantileDMatrix, xgb.QuantileDMatrix):
+        """Build (once per max_bin) the train and valid QuantileDMatrix."""
+        with self._lock:
+            if max_bin not in self._dmatrices:
+                X_train, y_train, X_valid, y_valid = self.data
+                dtrain = xgb.QuantileDMatrix(X_train, y_train, max_bin=max_bin)
+                dvalid = xgb.QuantileDMatrix(
+                    X_valid, y_valid, max_bin=max_bin, ref=dtrain
+                )
+                self._dmatrices[max_bin] = (dtrain, dvalid)
+            return self._dmatrices[max_bin]
+
+    def train(self, trial: _Trial, rounds: int, early_stopping_rounds: int):
+        """Continue training `trial` up to `rounds` boosting rounds in total."""
+        params = {**self.base_params, **trial.params}
+        dtrain, dvalid = self.dmatrices(params["max_bin"])
+        evals_result = {}
+        remaining = rounds - len(trial.history)
+        trial.booster = xgb.train(
+            params,
+            dtrain,
+            num_boost_round=remaining,
+            evals=[(dvalid, "validation_0")],
+            early_stopping_rounds=early_stopping_rounds,
+            evals_result=evals_result,
+            verbose_eval=False,
+            xgb_model=trial.booster,
+        )
+        # the last metric is the one used for early stopping
+        history = list(evals_result["validation_0"].values())[-1]
+        trial.history += history
+        if len(history) < remaining:
+            trial.status = "early_stopped"
+
+
+def search_pipeline(
+    pipeline: Pipeline,
+    X_train,
+    y_train,
+    X_valid,
+    y_valid,
+    space: dict,
+    method: str = "random",
+    n_trials: int = 16,
+    max_parallel: int = None,
+    seed: int = 1,
+) -> list:
+    """Fit the preprocessing once, then search the hparams of the model.
+
+    Trials run in parallel threads (XGBoost releases the GIL), each with an even
+    share of the cores, on one QuantileDMatrix of the preprocessed features.
+    "random" trains every trial for the full number of rounds. "successive_halving"
+    trains all trials for a few rounds, keeps the best 1 / ETA of them and trains
+    those ETA times longer, until the survivors reach the full number of rounds.
+    Early stopping on the validation set applies to every trial.
+
+    The best booster and its hparams are set on the pipeline's model.
+
+    Args:
+        pipeline (Pipeline): pipeline from `build_pipeline` with the fixed hparams
+        space (dict): search space (see `split_search_space`)
+        method (str): "random" or "successive_halving"
+        n_trials (int): number of sampled configurations
+        max_parallel (int): trials trained at once, defaults to #CPUs
+        seed (int): seed of the sampling
+    Returns:
+        list: one record per trial, sorted from best to worst
+    """
+    preprocessor = pipeline.named_steps["feature_engineering"]
+    model = pipeline.named_steps["train_model"]
+    X_train = preprocessor.fit_transform(X_train).astype(np.float32)
+    X_valid = preprocessor.transform(X_valid).astype(np.float32)
+
+    n_cpus = os.cpu_count() or 1
+    max_parallel = min(max_parallel or n_cpus, n_trials)
+    base_params = booster_params(model)
+    base_params["nthread"] = max(1, n_cpus // max_parallel)
+    search = _Search(base_params, X_train, y_train, X_valid, y_valid)
+
+    rng = np.random.default_rng(seed)
+    trials = [_Trial(i, sample_params(space, rng)) for i in range(n_trials)]
+    max_rounds = model.n_estimators or 100
+    n_rungs = 1
+    if method == "successive_halving":
+        n_rungs = 1 + int(math.log(n_trials, ETA) + 1e-9)
+
+    alive = trials
+    with ThreadPoolExecutor(max_workers=max_parallel) as pool:
+        for rung in range(n_rungs):
+            rounds = max(1, max_rounds // ETA ** (n_rungs - 1 - rung))
+            logging.info(f"Rung {rung}: train {len(alive)} trials to {rounds} rounds")
+            futures = [
+                pool.submit(search.train, t, rounds, model.early_stopping_rounds)
+                for t in alive
+                if t.status == "running"
+            ]
+            for future in futures:
+                future.result()
+
+            alive = sorted(alive, key=lambda t: t.score)
+            if rung < n_rungs - 1:
+                n_keep = max(1, math.ceil(len(alive) / ETA))
+                for trial in alive[n_keep:]:
+                    trial.status = "pruned"
+                    trial.booster = None
+                alive = alive[:n_keep]
+
+    for trial in alive:
+        if trial.status == "running":
+            trial.status = "complete"
+    records = sorted((t.record() for t in trials), key=lambda r: r["score"])
+    best = min(alive, key=lambda t: t.score)
+    logging.info(f"Best trial {best.number}: {best.params} ({best.score})")
+
+    if model.early_stopping_rounds:
+        # predict with the trees up to the best iteration, like early stopping
+        best.booster.set_attr(
+            best_iteration=str(best.best_iteration), best_score=str(best.score)
+        )
+    else:
+        best.booster.set_attr(best_iteration=None, best_score=None)
+    model.set_params(**best.params)
+    load_booster(model, best.booster)
+    return records
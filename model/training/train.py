@@ -12,19 +12,37 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import joblib
+import json
 import logging
+import warnings
 
+import numpy as np
 import pandas as pd
+
 from sklearn.compose import ColumnTransformer
 from sklearn.model_selection import train_test_split
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler, OrdinalEncoder, OneHotEncoder
+import xgboost as xgb
 from xgboost import XGBRegressor
 
-from .utils import indices_in_list, save_metrics, save_monitoring_info, split_xy
+from .export import export_compiled_model, export_native_booster
+from .metrics import RegressionMetrics
+from .monitoring import FEATURE_STATS, FeatureStats
+from .utils import (
+    FILE_FORMATS,
+    SPLIT_FORMATS,
+    indices_in_list,
+    read_files,
+    save_metrics,
+    save_monitoring_info,
+    split_xy,
+    write_file,
+)
 
 
 # used for monitoring during prediction time
@@ -33,52 +51,63 @@ TRAINING_DATASET_INFO = "training_dataset.json"
 NUM_COLS = ["dayofweek", "hourofday", "trip_distance", "trip_miles", "trip_seconds"]
 ORD_COLS = ["company"]
 OHE_COLS = ["payment_type"]
+# compact dtypes to read the features with, halves memory of the raw dataframe
+DTYPES = {
+    **{col: "float32" for col in NUM_COLS},
+    **{col: "category" for col in ORD_COLS + OHE_COLS},
+}
+# "native" skips model.joblib and only writes the compiled export & booster
+MODEL_FORMATS = ["joblib", "native"]
+# "native" trains with xgboost.train on QuantileDMatrix inputs (see fit_pipeline),
+# "external_memory" streams data larger than memory (see external_memory.py)
+TRAINING_ENGINES = ["sklearn", "native", "external_memory"]
+# hparams search over the search space entries of hparams (see search.py)
+SEARCH_METHODS = ["none", "random", "successive_halving"]
+# table of all trials of a search, saved next to the model
+HPARAM_TRIALS = "hparam_trials.json"
+# metrics per payment type & company and error quantiles, next to the model as
+# the metrics artifact is imported into Vertex AI with the regression schema
+METRICS_DETAILS = "metrics_details.json"
+SEGMENT_COLS = ["payment_type", "company"]
 
 
-def train(
-    input_path: str,
-    input_test_path: str,
-    output_train_path: str,
-    output_valid_path: str,
-    output_test_path: str,
-    output_model: str,
-    output_metrics: str,
-    hparams: dict,
-):
-
-    logging.info("Read csv files into dataframes")
-    df = pd.read_csv(input_path)
-
-    logging.info("Split dataframes")
-    label = hparams.pop("label")
+def split_search_space(hparams: dict) -> (dict, dict):
+    """Separate fixed hparams from search space entries.
 
-    if input_test_path:
-        # if static test data is used, only split into train & valid dataframes
-        if input_test_path.startswith("gs://"):
-            input_test_path = "/gcs/" + input_test_path[5:]
-        df_train, df_valid = train_test_split(df, test_size=0.2, random_state=1)
-        df_test = pd.read_csv(input_test_path)
-    else:
-        # otherwise, split into train, valid, and test dataframes
-        df_train, df_test = train_test_split(df, test_size=0.2, random_state=1)
-        df_train, df_valid = train_test_split(df_train, test_size=0.25, random_state=1)
+    A search space entry is a dict instead of a value:
+        {"values": [4, 6, 8]} picks one of the values,
+        {"min": 0.01, "max": 0.3, "log": true} samples a float, uniformly on a
+        log scale if "log" is set; the sample is an int if min and max are ints.
 
-    # create output folders
-    for x in [output_metrics, output_train_path, output_test_path, output_test_path]:
-        Path(x).parent.mkdir(parents=True, exist_ok=True)
-    Path(output_model).mkdir(parents=True, exist_ok=True)
+    Returns:
+        (dict, dict): fixed hparams and search space
+    """
+    space = {k: v for k, v in hparams.items() if isinstance(v, dict)}
+    for name in ["n_estimators", "early_stopping_rounds"]:
+        if name in space:
+            raise ValueError(f"{name} sets the budget of the search, not searchable")
+    fixed = {k: v for k, v in hparams.items() if k not in space}
+    return fixed, space
 
-    df_train.to_csv(output_train_path, index=False)
-    df_valid.to_csv(output_valid_path, index=False)
-    df_test.to_csv(output_test_path, index=False)
 
-    X_train, y_train = split_xy(df_train, label)
-    X_valid, y_valid = split_xy(df_valid, label)
-    X_test, y_test = split_xy(df_test, label)
+def build_pipeline(
+    X_train: pd.DataFrame, hparams: dict, categories: dict = None
+) -> Pipeline:
+    """Build the (unfitted) preprocessing + XGBoost pipeline for the features.
 
+    Args:
+        X_train (pd.DataFrame): training features, or a sample of them if
+            `categories` is given
+        hparams (dict): parameters of XGBRegressor
+        categories (dict): optional categories of each ORD_COLS and OHE_COLS
+            column, otherwise the encoders learn them from the data in `fit`
+    """
     logging.info("Get the number of unique categories for ordinal encoded columns")
-    ordinal_columns = X_train[ORD_COLS]
-    n_unique_cat = ordinal_columns.nunique()
+    if categories:
+        n_unique_cat = {col: len(categories[col]) for col in ORD_COLS}
+    else:
+        ordinal_columns = X_train[ORD_COLS]
+        n_unique_cat = ordinal_columns.nunique()
 
     logging.info("Get indices of columns in base data")
     col_list = X_train.columns.tolist()
@@ -90,7 +119,9 @@ def train(
         (
             f"ordinal encoding for {ord_col}",
             OrdinalEncoder(
-                handle_unknown="use_encoded_value", unknown_value=n_unique_cat[ord_col]
+                categories=[categories[ord_col]] if categories else "auto",
+                handle_unknown="use_encoded_value",
+                unknown_value=n_unique_cat[ord_col],
             ),
             [ord_index],
         )
@@ -101,37 +132,294 @@ def train(
         ("numeric_scaling", StandardScaler(), num_indices),
         (
             "one_hot_encoding",
-            OneHotEncoder(handle_unknown="ignore"),
+            OneHotEncoder(
+                categories=[categories[col] for col in col_list if col in OHE_COLS]
+                if categories
+                else "auto",
+                handle_unknown="ignore",
+            ),
             cat_indices_onehot,
         ),
     ] + ordinal_transformers
 
     logging.info("Build sklearn preprocessing steps")
     preprocesser = ColumnTransformer(transformers=all_transformers)
-    logging.info("Build sklearn pipeline with XGBoost model")
     xgb_model = XGBRegressor(**hparams)
 
-    pipeline = Pipeline(
+    return Pipeline(
         steps=[("feature_engineering", preprocesser), ("train_model", xgb_model)]
     )
 
-    logging.info("Transform validation data")
-    valid_preprocesser = preprocesser.fit(X_train)
-    X_valid_transformed = valid_preprocesser.transform(X_valid)
 
-    logging.info("Fit model")
-    pipeline.fit(
-        X_train, y_train, train_model__eval_set=[(X_valid_transformed, y_valid)]
+def fit_pipeline(
+    pipeline: Pipeline,
+    X_train: pd.DataFrame,
+    y_train: pd.Series,
+    X_valid: pd.DataFrame,
+    y_valid: pd.Series,
+    engine: str = "sklearn",
+) -> Pipeline:
+    """Fit the preprocessing and the model of a pipeline from `build_pipeline`.
+
+    `Pipeline.fit` would fit the ColumnTransformer a second time after it was
+    fitted to transform the validation set. Here it is fitted and applied once and
+    the features go to XGBoost as float32, which is what it converts them to
+    anyway (sparse matrices stay sparse: implicit zeros are missing values).
+
+    Args:
+        engine (str): "sklearn" fits `XGBRegressor`, "native" trains with
+            `xgboost.train` on QuantileDMatrix inputs (see `_train_native`)
+    Returns:
+        Pipeline: the fitted pipeline
+    """
+    preprocessor = pipeline.named_steps["feature_engineering"]
+    model = pipeline.named_steps["train_model"]
+    X_train = preprocessor.fit_transform(X_train).astype(np.float32)
+    X_valid = preprocessor.transform(X_valid).astype(np.float32)
+    if engine == "native":
+        _train_native(model, X_train, y_train, X_valid, y_valid)
+    else:
+        model.fit(X_train, y_train, eval_set=[(X_valid, y_valid)])
+    return pipeline
+
+
+def booster_params(model: XGBRegressor) -> dict:
+    """Parameters of `xgboost.train` for the hparams of `model`.
+
+    `nthread` (or `n_jobs`), `max_bin` and `tree_method` are taken from the
+    hparams like the other booster parameters, `tree_method` defaults to `hist`.
+    """
+    params = {k: v for k, v in model.get_xgb_params().items() if v is not None}
+    params["tree_method"] = params.get("tree_method") or "hist"
+    params["max_bin"] = params.get("max_bin") or 256
+    params["nthread"] = params.pop("n_jobs", None) or params.get("nthread")
+    return params
+
+
+def load_booster(model: XGBRegressor, booster: xgb.Booster):
+    """Load a booster trained with `xgboost.train` into the sklearn `model`.
+
+    The pipeline is then saved and served like a sklearn-trained one.
+    """
+    with warnings.catch_warnings():
+        # "Loading a native XGBoost model with Scikit-Learn interface"
+        warnings.simplefilter("ignore", UserWarning)
+        model.load_model(booster.save_raw())
+
+
+def _train_native(model: XGBRegressor, X_train, y_train, X_valid, y_valid):
+    """Train the booster of `model` with the native XGBoost API.
+
+    QuantileDMatrix bins the features while it is built instead of keeping a full
+    copy of them, and the `hist` tree method trains on the binned data with all
+    cores.
+    """
+    params = booster_params(model)
+
+    logging.info(f"Build QuantileDMatrix with max_bin={params['max_bin']}")
+    dtrain = xgb.QuantileDMatrix(
+        X_train, y_train, max_bin=params["max_bin"], nthread=params["nthread"]
+    )
+    dvalid = xgb.QuantileDMatrix(
+        X_valid,
+        y_valid,
+        max_bin=params["max_bin"],
+        nthread=params["nthread"],
+        ref=dtrain,
     )
 
-    logging.info("Predict test data")
-    y_pred = pipeline.predict(X_test)
-    y_pred = y_pred.clip(0)
+    logging.info(f"Train booster with {params}")
+    booster = xgb.train(
+        params,
+        dtrain,
+        num_boost_round=model.n_estimators or 100,
+        evals=[(dvalid, "validation_0")],
+        early_stopping_rounds=model.early_stopping_rounds,
+    )
+    load_booster(model, booster)
 
-    logging.info(f"Save model to: {output_model}")
-    joblib.dump(pipeline, f"{output_model}/model.joblib")
 
-    save_metrics(y_test, y_pred, output_metrics)
-    save_monitoring_info(
-        output_train_path, label, f"{output_model}/{TRAINING_DATASET_INFO}"
+def feature_stats(sample: pd.DataFrame) -> FeatureStats:
+    """Empty statistics for skew checks of the features in `sample`."""
+    return FeatureStats.from_sample(
+        sample,
+        [col for col in NUM_COLS if col in sample],
+        [col for col in ORD_COLS + OHE_COLS if col in sample],
     )
+
+
+def evaluate(pipeline: Pipeline, X_test, y_test, metrics: RegressionMetrics):
+    """Predict a chunk of test data and add it to the metrics."""
+    y_pred = pipeline.predict(X_test).clip(0)
+    metrics.update(y_test, y_pred, X_test[metrics.segment_cols])
+
+
+def _train_in_memory(
+    input_path: str,
+    input_format: str,
+    input_test_path: str,
+    output_paths: list,
+    split_format: str,
+    label: str,
+    hparams: dict,
+    engine: str,
+    space: dict = None,
+    search: str = "none",
+    n_trials: int = 16,
+    output_trials: str = None,
+) -> (Pipeline, RegressionMetrics, FeatureStats):
+    """Read all data into dataframes, split, fit and evaluate on the test split.
+
+    With a search `space` the model is the best trial of a hparams search, the
+    records of all trials are saved to `output_trials`.
+
+    Returns:
+        (Pipeline, RegressionMetrics, FeatureStats): fitted pipeline, its test
+            metrics and the statistics of the training split
+    """
+    logging.info(f"Read input files ({input_format}) into dataframes")
+    df = read_files(input_path, input_format, dtype=DTYPES)
+
+    logging.info("Split dataframes")
+    if input_test_path:
+        # if static test data is used, only split into train & valid dataframes
+        df_train, df_valid = train_test_split(df, test_size=0.2, random_state=1)
+        # the static test data may be stored in another format than the extract
+        df_test = read_files(input_test_path, dtype=DTYPES)
+    else:
+        # otherwise, split into train, valid, and test dataframes
+        df_train, df_test = train_test_split(df, test_size=0.2, random_state=1)
+        df_train, df_valid = train_test_split(df_train, test_size=0.25, random_state=1)
+
+    # write the splits in a background thread while the model is being fitted
+    splits = zip([df_train, df_valid, df_test], output_paths)
+    writer = ThreadPoolExecutor(max_workers=1)
+    splits_written = writer.submit(
+        lambda: [write_file(df, path, split_format) for df, path in splits]
+    )
+    writer.shutdown(wait=False)
+
+    X_train, y_train = split_xy(df_train, label)
+    X_valid, y_valid = split_xy(df_valid, label)
+    X_test, y_test = split_xy(df_test, label)
+
+    stats = feature_stats(X_train)
+    stats.update(X_train)
+
+    logging.info("Build sklearn pipeline with XGBoost model")
+    pipeline = build_pipeline(X_train, hparams)
+
+    if space:
+        from .search import search_pipeline
+
+        logging.info(f"Fit preprocessing and search hparams ({search})")
+        trials = search_pipeline(
+            pipeline, X_train, y_train, X_valid, y_valid, space, search, n_trials
+        )
+        logging.info(f"Save {len(trials)} trials to: {output_trials}")
+        with open(output_trials, "w") as fp:
+            json.dump(trials, fp, indent=2)
+    else:
+        logging.info(f"Fit preprocessing and model ({engine})")
+        fit_pipeline(pipeline, X_train, y_train, X_valid, y_valid, engine)
+
+    logging.info("Evaluate on test data")
+    metrics = RegressionMetrics(SEGMENT_COLS)
+    evaluate(pipeline, X_test, y_test, metrics)
+
+    logging.info("Wait for the splits to be written")
+    splits_written.result()
+    return pipeline, metrics, stats
+
+
+def train(
+    input_path: str,
+    input_test_path: str,
+    output_train_path: str,
+    output_valid_path: str,
+    output_test_path: str,
+    output_model: str,
+    output_metrics: str,
+    hparams: dict,
+    model_format: str = "joblib",
+    input_format: str = "auto",
+    split_format: str = "csv",
+    engine: str = "sklearn",
+    search: str = "none",
+    n_trials: int = 16,
+):
+    if model_format not in MODEL_FORMATS:
+        raise ValueError(f"model_format must be one of {MODEL_FORMATS}")
+    if input_format not in FILE_FORMATS:
+        raise ValueError(f"input_format must be one of {FILE_FORMATS}")
+    if split_format not in SPLIT_FORMATS:
+        raise ValueError(f"split_format must be one of {SPLIT_FORMATS}")
+    if engine not in TRAINING_ENGINES:
+        raise ValueError(f"engine must be one of {TRAINING_ENGINES}")
+    if search not in SEARCH_METHODS:
+        raise ValueError(f"search must be one of {SEARCH_METHODS}")
+
+    label = hparams.pop("label")
+    hparams, space = split_search_space(hparams)
+    if bool(space) != (search != "none"):
+        raise ValueError("A search needs both a search method and search space")
+    if space and engine == "external_memory":
+        raise ValueError("The external_memory engine does not support a search")
+
+    # create output folders
+    output_paths = [output_train_path, output_valid_path, output_test_path]
+    for x in [output_metrics] + output_paths:
+        Path(x).parent.mkdir(parents=True, exist_ok=True)
+    Path(output_model).mkdir(parents=True, exist_ok=True)
+
+    if engine == "external_memory":
+        from .external_memory import train_external_memory
+
+        pipeline, metrics, stats = train_external_memory(
+            input_path,
+            input_format,
+            input_test_path,
+            output_paths,
+            split_format,
+            label,
+            hparams,
+        )
+    else:
+        pipeline, metrics, stats = _train_in_memory(
+            input_path,
+            input_format,
+            input_test_path,
+            output_paths,
+            split_format,
+            label,
+            hparams,
+            engine,
+            space,
+            search,
+            n_trials,
+            f"{output_model}/{HPARAM_TRIALS}",
+        )
+
+    logging.info(f"Save model to: {output_model}")
+    if model_format == "joblib":
+        joblib.dump(pipeline, f"{output_model}/model.joblib")
+        try:
+            export_compiled_model(pipeline, output_model)
+        except ValueError as err:
+            # the prediction server falls back to model.joblib
+            logging.warning(f"Skip compiled model export: {err}")
+    else:
+        # without model.joblib the compiled export is the only servable artifact
+        export_compiled_model(pipeline, output_model)
+    export_native_booster(pipeline, output_model)
+
+    save_metrics(metrics, output_metrics, f"{output_model}/{METRICS_DETAILS}")
+    stats.save(f"{output_model}/{FEATURE_STATS}")
+    if split_format == "csv":
+        save_monitoring_info(
+            output_train_path, label, f"{output_model}/{TRAINING_DATASET_INFO}"
+        )
+    else:
+        # Vertex AI Model Monitoring does not read Parquet, without this file
+        # batch predictions run without skew detection (see lookup_model)
+        logging.warning(f"No training dataset info for {split_format} splits")
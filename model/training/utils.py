@@ -11,12 +11,30 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import glob
+import itertools
 import logging
 import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 
-import numpy as np
 import pandas as pd
-from sklearn import metrics
+from pandas.api.types import union_categoricals
+
+# formats of BigQuery extracts which can be read for training
+FILE_FORMATS = ["auto", "csv", "parquet", "avro"]
+# formats the train/valid/test splits can be written in
+SPLIT_FORMATS = ["csv", "parquet"]
+_MAGIC_BYTES = {b"PAR1": "parquet", b"Obj\x01": "avro"}
+_GZIP_MAGIC = b"\x1f\x8b"
+# fields of Vertex AI's regression metrics schema, the only ones it imports
+VERTEX_METRICS = [
+    "rootMeanSquaredError",
+    "meanAbsoluteError",
+    "meanAbsolutePercentageError",
+    "rSquared",
+    "rootMeanSquaredLogError",
+]
 
 
 def split_xy(df: pd.DataFrame, label: str) -> (pd.DataFrame, pd.Series):
@@ -29,25 +47,238 @@ def indices_in_list(elements: list, base_list: list) -> list:
     return [idx for idx, elem in enumerate(base_list) if elem in elements]
 
 
-def save_metrics(y_test: pd.DataFrame, y_pred: pd.DataFrame, output_path: str):
-    """Save metrics in JSON format for Vertex AI Evaluation."""
-    data = {
-        "problemType": "regression",
-        "rootMeanSquaredError": np.sqrt(metrics.mean_squared_error(y_test, y_pred)),
-        "meanAbsoluteError": metrics.mean_absolute_error(y_test, y_pred),
-        "meanAbsolutePercentageError": metrics.mean_absolute_percentage_error(
-            y_test, y_pred
-        ),
-        "rSquared": metrics.r2_score(y_test, y_pred),
-        "rootMeanSquaredLogError": np.sqrt(
-            metrics.mean_squared_log_error(y_test, y_pred)
-        ),
-    }
+def expand_paths(path: str) -> list:
+    """Resolve a file, a folder of files or a wildcard path into a list of files.
+
+    Large BigQuery tables are extracted as several shards (`.../data-*`).
+    gs:// paths are read through the Cloud Storage FUSE mount at /gcs/.
+    """
+    if path.startswith("gs://"):
+        path = "/gcs/" + path[5:]
+    if os.path.isdir(path):
+        path = os.path.join(path, "*")
+    paths = sorted(p for p in glob.glob(path) if os.path.isfile(p))
+    if not paths:
+        raise FileNotFoundError(f"No files found for {path}")
+    return paths
+
+
+def concat_frames(frames: list) -> pd.DataFrame:
+    """Concatenate dataframes, keeping categorical columns categorical."""
+    if len(frames) == 1:
+        return frames[0]
+    for col, dtype in frames[0].dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            # pd.concat falls back to object dtype if the categories differ
+            categories = union_categoricals([f[col] for f in frames]).categories
+            for f in frames:
+                f[col] = f[col].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
+
+
+def detect_file_format(path: str) -> str:
+    """Detect "parquet", "avro" or "csv" from the magic bytes of a file.
+
+    BigQuery extracts have no file extension, so the content is checked instead.
+    """
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    return _MAGIC_BYTES.get(magic, "csv")
+
+
+def csv_compression(path: str) -> str:
+    """Return "gzip" for a GZIP compressed CSV file, None for plain text.
+
+    `bq extract --compression=GZIP` keeps the extension-less shard names, so
+    pandas cannot infer the compression from the file name.
+    """
+    with open(path, "rb") as f:
+        magic = f.read(2)
+    return "gzip" if magic == _GZIP_MAGIC else None
+
+
+def read_file(path: str, file_format: str = "auto", dtype: dict = None):
+    """Read a CSV, Parquet or Avro file into a dataframe.
+
+    Args:
+        path (str): local file path
+        file_format (str): one of FILE_FORMATS, "auto" detects it per file
+        dtype (dict): column dtypes, e.g. float32 / category to save memory
+    Returns:
+        pd.DataFrame: all rows of the file
+    """
+    if file_format not in FILE_FORMATS:
+        raise ValueError(f"file_format must be one of {FILE_FORMATS}")
+    if file_format == "auto":
+        file_format = detect_file_format(path)
+
+    if file_format == "csv":
+        return pd.read_csv(path, dtype=dtype, compression=csv_compression(path))
+    if file_format == "parquet":
+        df = pd.read_parquet(path)
+    else:
+        import fastavro
+
+        with open(path, "rb") as f:
+            df = pd.DataFrame.from_records(list(fastavro.reader(f)))
+    return _astype(df, dtype)
 
-    logging.info(f"Metrics: {metrics}")
+
+def _astype(df: pd.DataFrame, dtype: dict = None) -> pd.DataFrame:
+    if dtype:
+        df = df.astype({col: t for col, t in dtype.items() if col in df.columns})
+    return df
+
+
+def iter_batches(
+    path: str, file_format: str = "auto", dtype: dict = None, batch_size: int = None
+):
+    """Read one or many files (see `expand_paths`) as a stream of dataframes.
+
+    Only one batch is held in memory at a time (see external_memory.py).
+
+    Args:
+        path (str): file, folder or wildcard path
+        file_format (str): one of FILE_FORMATS, "auto" detects it per file
+        dtype (dict): column dtypes, e.g. float32 / category to save memory
+        batch_size (int): maximum number of rows per dataframe
+    Yields:
+        pd.DataFrame: consecutive rows of the files
+    """
+    if file_format not in FILE_FORMATS:
+        raise ValueError(f"file_format must be one of {FILE_FORMATS}")
+    batch_size = batch_size or 100_000
+    for file_path in expand_paths(path):
+        file_type = file_format
+        if file_type == "auto":
+            file_type = detect_file_format(file_path)
+
+        if file_type == "csv":
+            yield from pd.read_csv(
+                file_path,
+                dtype=dtype,
+                chunksize=batch_size,
+                compression=csv_compression(file_path),
+            )
+        elif file_type == "parquet":
+            import pyarrow.parquet as pq
+
+            for batch in pq.ParquetFile(file_path).iter_batches(batch_size):
+                yield _astype(batch.to_pandas(), dtype)
+        else:
+            import fastavro
+
+            with open(file_path, "rb") as f:
+                records = fastavro.reader(f)
+                while batch := list(itertools.islice(records, batch_size)):
+                    yield _astype(pd.DataFrame.from_records(batch), dtype)
+
+
+def read_files(
+    path: str, file_format: str = "auto", dtype: dict = None, max_workers: int = None
+):
+    """Read one or many files (see `expand_paths`) in parallel threads.
+
+    Args:
+        path (str): file, folder or wildcard path
+        file_format (str): one of FILE_FORMATS, "auto" detects it per file
+        dtype (dict): column dtypes, e.g. float32 / category to save memory
+        max_workers (int): number of files read at once, defaults to #CPUs
+    Returns:
+        pd.DataFrame: all rows of all files
+    """
+    paths = expand_paths(path)
+    logging.info(f"Read {len(paths)} file(s) from {path}")
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        frames = list(pool.map(lambda p: read_file(p, file_format, dtype), paths))
+    return concat_frames(frames)
+
+
+def write_file(df: pd.DataFrame, path: str, file_format: str = "csv"):
+    """Write a dataframe as CSV or Snappy-compressed Parquet (see SPLIT_FORMATS)."""
+    logging.info(f"Write {len(df)} rows as {file_format} to: {path}")
+    if file_format == "csv":
+        df.to_csv(path, index=False)
+    elif file_format == "parquet":
+        df.to_parquet(path, index=False, compression="snappy")
+    else:
+        raise ValueError(f"file_format must be one of {SPLIT_FORMATS}")
+
+
+class BatchWriter:
+    """Write a stream of dataframes to one CSV or Parquet file (see SPLIT_FORMATS).
+
+    Args:
+        path (str): local file path
+        file_format (str): "csv" or "parquet" (Snappy-compressed)
+    """
+
+    def __init__(self, path: str, file_format: str = "csv"):
+        if file_format not in SPLIT_FORMATS:
+            raise ValueError(f"file_format must be one of {SPLIT_FORMATS}")
+        self.path = path
+        self.file_format = file_format
+        self.n_rows = 0
+        self._started = False
+        self._writer = None
+
+    def write(self, df: pd.DataFrame):
+        if self.file_format == "csv":
+            mode, header = ("a", False) if self._started else ("w", True)
+            df.to_csv(self.path, mode=mode, header=header, index=False)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            # the categories differ between batches, store the plain values
+            df = df.astype(
+                {c: object for c, t in df.dtypes.items() if t.name == "category"}
+            )
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(
+                    self.path, table.schema, compression="snappy"
+                )
+            self._writer.write_table(table.cast(self._writer.schema))
+        self._started = True
+        self.n_rows += len(df)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        logging.info(f"Wrote {self.n_rows} rows as {self.file_format} to: {self.path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def save_metrics(metrics, output_path: str, details_path: str = None):
+    """Save metrics in JSON format for Vertex AI Evaluation.
+
+    Args:
+        metrics (RegressionMetrics): metrics accumulated on the test data
+        output_path (str): path of the metrics in Vertex AI's regression schema
+        details_path (str): optional path of the error quantiles and the metrics
+            per segment, which that schema has no fields for
+    """
+    result = metrics.result()
+    data = {"problemType": "regression"}
+    for key in VERTEX_METRICS:
+        if key in result:
+            data[key] = result[key]
+
+    logging.info(f"Metrics: {data}")
     with open(output_path, "w") as fp:
         json.dump(data, fp)
 
+    if details_path:
+        logging.info(f"Save detailed metrics to: {details_path}")
+        with open(details_path, "w") as fp:
+            json.dump({**result, "segments": metrics.segments()}, fp, indent=2)
+
 
 def save_monitoring_info(train_path: str, label: str, output_path: str):
     """Persist URIs of training file(s) for model monitoring in batch predictions.
@@ -0,0 +1,74 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark getting a BigQuery client with and without the client cache.
+
+The client constructor and the parsing of the service account info are stubbed
+with a fixed delay, standing in for resolving credentials and opening a session,
+so no project or network is needed. Run from the package folder:
+
+    poetry run python -m benchmarks.client_cache --calls 200 --construct-ms 50
+"""
+import argparse
+import json
+import time
+from unittest import mock
+
+from package import BigQuery, ClientCache
+
+SA_INFO = json.dumps({"project_id": "my-project-id", "private_key": "..."})
+
+
+def time_calls(bq: BigQuery, n_calls: int, **kwargs) -> float:
+    """Seconds per `_client` call, the client lookup done by every query."""
+    start = time.perf_counter()
+    for _ in range(n_calls):
+        bq._client(**kwargs)
+    return (time.perf_counter() - start) / n_calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument(
+        "--construct-ms",
+        type=float,
+        default=50,
+        help="delay of the stubbed client constructor and credentials parsing",
+    )
+    args = parser.parse_args()
+    delay = args.construct_ms / 1000
+
+    def construct(*args, **kwargs):
+        time.sleep(delay)
+        return mock.Mock()
+
+    with mock.patch("package.gcp_utils.bigquery.Client", construct), mock.patch(
+        "package.gcp_utils.service_account.Credentials.from_service_account_info",
+        construct,
+    ):
+        for name, kwargs in [("default", {}), ("sa_info", {"sa_info": SA_INFO})]:
+            uncached = time_calls(
+                BigQuery(client_cache=ClientCache(max_size=0)), args.calls, **kwargs
+            )
+            cached = time_calls(
+                BigQuery(client_cache=ClientCache()), args.calls, **kwargs
+            )
+            print(
+                f"{name:8} uncached {uncached * 1000:8.3f} ms/call, "
+                f"cached {cached * 1000:8.3f} ms/call ({uncached / cached:,.0f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
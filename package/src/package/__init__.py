@@ -1,7 +1,10 @@
 # Funcitons made available:
-from .gcp_utils import BigQuery
+from .gcp_utils import BigQuery, ClientCache, QueryCache, QueryResult
 
 __version__ = "0.0.1"
 __all__ = [
     "BigQuery",
+    "ClientCache",
+    "QueryCache",
+    "QueryResult",
 ]
\ No newline at end of file
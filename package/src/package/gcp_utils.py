@@ -1,16 +1,332 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import NamedTuple
+
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from google.cloud import bigquery
 from google.oauth2 import service_account
 
 import json
 
+# rows per batch yielded by bq_iter_batches
+DEFAULT_BATCH_SIZE = 100_000
+# queries run at the same time by bq_to_dfs
+DEFAULT_MAX_CONCURRENCY = 8
+
+
+class ClientCache:
+    """Thread-safe LRU cache of BigQuery clients.
+
+    Creating a client resolves the credentials (parsing service account info,
+    looking up the default credentials) and opens a new HTTP session, a reused
+    client keeps its connections and access token.
+
+    Args:
+        max_size: Maximum number of cached clients, 0 disables caching.
+        ttl: (Optional) Seconds after which a client is created again.
+    """
+
+    def __init__(self, max_size: int = 16, ttl: float = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        # one lock per key while its client is created
+        self._creating = {}
+
+    def _lookup(self, key):
+        """Cached client for `key` or None, the caller holds `_lock`."""
+        entry = self._clients.get(key)
+        if entry is None or (
+            self.ttl is not None and time.monotonic() - entry[0] >= self.ttl
+        ):
+            return None
+        self._clients.move_to_end(key)
+        return entry[1]
+
+    def get(self, key, create):
+        """Cached client for `key`, created with `create()` if missing or expired.
+
+        `create()` runs outside of the cache-wide lock, so that a slow client
+        creation does not block the other keys. Concurrent callers of the same key
+        wait for it and share one client.
+        """
+        if self.max_size <= 0:
+            return create()
+        with self._lock:
+            client = self._lookup(key)
+            if client is not None:
+                return client
+            key_lock = self._creating.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                client = self._lookup(key)
+            if client is not None:
+                return client
+            client = create()
+            with self._lock:
+                self._clients[key] = (time.monotonic(), client)
+                self._clients.move_to_end(key)
+                while len(self._clients) > self.max_size:
+                    self._clients.popitem(last=False)
+                self._creating.pop(key, None)
+            return client
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clients.clear()
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+
+# shared by all BigQuery instances which are not given their own cache
+CLIENT_CACHE = ClientCache()
+
+# quoted strings and identifiers, kept as they are, or runs of whitespace
+_SQL_TOKENS = re.compile(r"('(?:\\.|[^'\\])*'|\"(?:\\.|[^\"\\])*\"|`[^`]*`)|\s+")
+
+
+def normalize_query(query: str) -> str:
+    """Query text with whitespace collapsed outside of quotes and no trailing
+    semicolon, so that formatting differences do not change the cache key."""
+    query = _SQL_TOKENS.sub(lambda m: m.group(1) or " ", query)
+    return query.strip().rstrip(";").rstrip()
+
+
+class QueryCache:
+    """Local cache of query results, stored as Parquet files.
+
+    Results are keyed by the normalized query text, the query parameters, the
+    project and the credentials they were queried with, so that results are not
+    shared between identities with different access. They expire `ttl` seconds
+    after the query ran, and the least recently used results are evicted once the
+    files take more than `max_bytes`. Cached results are read with memory mapping.
+
+    Args:
+        cache_dir: Directory of the Parquet files, created if missing. Defaults to
+            ~/.cache/bigquery_results.
+        max_bytes: Maximum total size of the cached results.
+        ttl: Seconds for which a result is reused, None to keep it until evicted.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = None,
+        max_bytes: int = 1024**3,
+        ttl: float = 24 * 3600,
+    ) -> None:
+        if cache_dir is None:
+            cache_dir = os.path.expanduser("~/.cache/bigquery_results")
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(
+        query: str,
+        query_parameters: list = None,
+        project: str = None,
+        identity: tuple = None,
+    ) -> str:
+        """Cache key of a query, `identity` is the credentials component of the
+        client cache key (see `BigQuery._cache_key`)."""
+        params = [p.to_api_repr() for p in query_parameters or []]
+        return hashlib.sha256(
+            json.dumps(
+                [normalize_query(query), params, project, identity], sort_keys=True
+            ).encode()
+        ).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.parquet")
+
+    def get(self, key: str):
+        """Cached DataFrame for `key`, None if missing or expired."""
+        path = self._path(key)
+        try:
+            stat = os.stat(path)
+            if self.ttl is not None and time.time() - stat.st_mtime >= self.ttl:
+                os.remove(path)
+                return None
+            table = pq.read_table(path, memory_map=True)
+            # the access time orders the results for eviction, mtime is kept
+            os.utime(path, (time.time(), stat.st_mtime))
+        except FileNotFoundError:
+            return None
+        logging.info(f"Query result read from cache: {path}")
+        return table.to_pandas()
+
+    def put(self, key: str, df: pd.DataFrame) -> None:
+        """Store a result, then evict the least recently used ones above max_bytes."""
+        path = self._path(key)
+        # written to a temporary file first, so that readers never see a partial one
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        pq.write_table(pa.Table.from_pandas(df), tmp_path)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self) -> None:
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith(".parquet"):
+                    stat = entry.stat()
+                    entries.append((stat.st_atime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def clear(self) -> None:
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".parquet"):
+                os.remove(entry.path)
+
+
+def _rebatch(batches, batch_size: int):
+    """Split and merge Arrow record batches into batches of batch_size rows.
+
+    Only the last batch may be smaller. Splitting is zero-copy, merging copies the
+    (small) batches which are merged.
+    """
+    pending, n_pending = [], 0
+    for batch in batches:
+        while batch.num_rows:
+            n_take = min(batch_size - n_pending, batch.num_rows)
+            pending.append(batch.slice(0, n_take))
+            n_pending += n_take
+            batch = batch.slice(n_take)
+            if n_pending == batch_size:
+                yield _concat_batches(pending)
+                pending, n_pending = [], 0
+    if n_pending:
+        yield _concat_batches(pending)
+
+
+def _concat_batches(batches: list) -> pa.RecordBatch:
+    if len(batches) == 1:
+        return batches[0]
+    return pa.Table.from_batches(batches).combine_chunks().to_batches()[0]
+
+
+def compact_dataframe(batch) -> pd.DataFrame:
+    """Convert an Arrow record batch or table to pandas with compact dtypes.
+
+    Strings become categoricals and float64 becomes float32, which typically
+    takes a fraction of the memory of object and float64 columns.
+    """
+    df = batch.to_pandas(strings_to_categorical=True)
+    float64_cols = df.select_dtypes("float64").columns
+    return df.astype({col: "float32" for col in float64_cols})
+
+
+class QueryResult(NamedTuple):
+    """Result of one of the queries run by `BigQuery.bq_to_dfs`."""
+
+    name: object
+    df: pd.DataFrame
+    seconds: float
+    # None if the result was read from the query cache
+    total_bytes_processed: int = None
+    cache_hit: bool = False
+
+
 class BigQuery:
-    def __init__(self, project_id: str=None) -> None:
+    def __init__(
+        self,
+        project_id: str = None,
+        client_cache: ClientCache = None,
+        query_cache: QueryCache = None,
+    ) -> None:
         self.project_id = project_id
-        
+        self.client_cache = client_cache if client_cache is not None else CLIENT_CACHE
+        # results are only cached if a query cache is given
+        self.query_cache = query_cache
+
+    def _client(self, credentials=None, sa_info: str = None) -> bigquery.Client:
+        """BigQuery client for the credentials, service account info or default
+        credentials, reused from the client cache.
+
+        Clients are cached by credentials object, by hash of the service account
+        info or by project for the default credentials.
+        """
+        return self.client_cache.get(
+            self._cache_key(credentials, sa_info),
+            lambda: self._create_client(credentials, sa_info),
+        )
+
+    def _read_client(self, credentials=None, sa_info: str = None):
+        """BigQuery Storage `BigQueryReadClient` for the same credentials as
+        `_client`, reused from the client cache.
+
+        Raises:
+            ImportError: if google-cloud-bigquery-storage is not installed.
+        """
+        from google.cloud import bigquery_storage
+
+        return self.client_cache.get(
+            ("bqstorage",) + self._cache_key(credentials, sa_info),
+            lambda: bigquery_storage.BigQueryReadClient(
+                credentials=self._credentials(credentials, sa_info)
+            ),
+        )
+
+    def _cache_key(self, credentials=None, sa_info: str = None) -> tuple:
+        if credentials:
+            # the cached client references the credentials, so their id is unique
+            return ("credentials", id(credentials))
+        elif sa_info:
+            return ("sa_info", hashlib.sha256(sa_info.encode()).hexdigest())
+        else:
+            return ("default", self.project_id)
+
+    @staticmethod
+    def _credentials(credentials=None, sa_info: str = None):
+        """Credentials object to create a client with, None for the default
+        credentials."""
+        if credentials:
+            return credentials
+        elif sa_info:
+            return service_account.Credentials.from_service_account_info(
+                json.loads(sa_info)
+            )
+        return None
+
+    def _create_client(self, credentials=None, sa_info: str = None):
+        credentials = self._credentials(credentials, sa_info)
+        if credentials:
+            return bigquery.Client(
+                credentials=credentials, project=credentials.project_id
+            )
+        else:
+            return bigquery.Client(project=self.project_id)
+
     def bq_to_df(
-        self, query: str, credentials=None, sa_info: str = None, 
+        self,
+        query: str,
+        credentials=None,
+        sa_info: str = None,
+        query_parameters: list = None,
+        bypass_cache: bool = False,
     ):
         """
         Run a BQ query and place the results in a pandas dataframe.
@@ -21,27 +337,185 @@ class BigQuery:
            object directly.
         2. **Default Credentials:** Attempt to use the default Google Cloud credentials.
 
+        For results which do not fit into memory, see `bq_iter_batches`.
+
+        If the instance has a `query_cache`, results of identical queries are read
+        from the cache instead of running the query again.
+
         Args:
             project_id: Google Cloud project ID.
             query: SQL query to execute.
             credentials: (Optional) Existing `google.oauth2.service_account.Credentials` object.
+            query_parameters: (Optional) Parameters of the query, e.g.
+                `bigquery.ScalarQueryParameter` objects.
+            bypass_cache: Run the query without reading or writing the query cache.
 
         Returns:
             pandas.DataFrame: DataFrame containing the results of the query.
         """
-        if credentials:
-            bq_client = bigquery.Client(
-                credentials=credentials, project=credentials.project_id
+        bq_client = self._client(credentials, sa_info)
+        df, _ = self._query_df(
+            bq_client,
+            query,
+            query_parameters,
+            bypass_cache,
+            identity=self._cache_key(credentials, sa_info),
+        )
+        return df
+
+    def _query_df(
+        self,
+        bq_client,
+        query,
+        query_parameters=None,
+        bypass_cache=False,
+        identity: tuple = None,
+    ):
+        """DataFrame of the query result and its job, None if read from the cache.
+
+        `identity` identifies the credentials of `bq_client` in the cache key.
+        """
+        use_cache = self.query_cache is not None and not bypass_cache
+        if use_cache:
+            key = QueryCache.key(query, query_parameters, bq_client.project, identity)
+            df = self.query_cache.get(key)
+            if df is not None:
+                return df, None
+
+        job_config = None
+        if query_parameters:
+            job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+        job = bq_client.query(query, job_config=job_config)
+        df = job.to_dataframe()
+        if use_cache:
+            self.query_cache.put(key, df)
+        return df, job
+
+    def bq_to_dfs(
+        self,
+        queries,
+        credentials=None,
+        sa_info: str = None,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        bypass_cache: bool = False,
+    ):
+        """
+        Run several BQ queries concurrently and yield their results as they complete.
+
+        Up to `max_concurrency` queries run at the same time in a thread pool,
+        sharing one client, so independent queries take about as long as the
+        slowest of them instead of the sum. The query cache is used like in
+        `bq_to_df`. If a query fails its error is raised, and the queries which
+        have not started yet are cancelled.
+
+        Authentication works as in `bq_to_df`.
+
+        Args:
+            queries: SQL queries to execute, as a dict of name to query or a list
+                (the names are then the positions in the list).
+            credentials: (Optional) Existing `google.oauth2.service_account.Credentials` object.
+            sa_info: (Optional) Service account info as a JSON string.
+            max_concurrency: Maximum number of queries running at the same time.
+            bypass_cache: Run the queries without reading or writing the query cache.
+
+        Yields:
+            QueryResult: name, DataFrame, duration in seconds and bytes processed of
+                the next query to complete.
+        """
+        if not isinstance(queries, dict):
+            queries = dict(enumerate(queries))
+        bq_client = self._client(credentials, sa_info)
+        identity = self._cache_key(credentials, sa_info)
+
+        def run(name, query):
+            start = time.perf_counter()
+            df, job = self._query_df(
+                bq_client, query, bypass_cache=bypass_cache, identity=identity
             )
-        elif sa_info:
-            credentials = service_account.Credentials.from_service_account_info(
-                json.loads(sa_info)
+            result = QueryResult(
+                name=name,
+                df=df,
+                seconds=time.perf_counter() - start,
+                total_bytes_processed=job.total_bytes_processed if job else None,
+                cache_hit=job is None,
             )
-            bq_client = bigquery.Client(
-                credentials=credentials, project=credentials.project_id
+            logging.info(
+                f"Query {name}: {len(df)} rows in {result.seconds:.1f}s, "
+                f"{result.total_bytes_processed} bytes processed"
             )
-        else:
-            bq_client = bigquery.Client(project=self.project_id)
+            return result
+
+        executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        try:
+            futures = [
+                executor.submit(run, name, query) for name, query in queries.items()
+            ]
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def bq_iter_batches(
+        self,
+        query: str,
+        credentials=None,
+        sa_info: str = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        to_pandas: bool = False,
+        compact: bool = False,
+        use_storage_api: bool = True,
+        bq_client=None,
+        bqstorage_client=None,
+    ):
+        """
+        Run a BQ query and stream the results in batches of bounded size.
+
+        Only about one batch is held in memory at a time, instead of the whole
+        result as in `bq_to_df`. The rows are downloaded as Arrow record batches
+        through the BigQuery Storage Read API (parallel streams over gRPC) when
+        google-cloud-bigquery-storage is installed, otherwise through the paged
+        REST API. The batches are re-cut to `batch_size` rows, except the last one.
+
+        Authentication works as in `bq_to_df`.
+
+        Args:
+            query: SQL query to execute.
+            credentials: (Optional) Existing `google.oauth2.service_account.Credentials` object.
+            sa_info: (Optional) Service account info as a JSON string.
+            batch_size: Maximum number of rows per batch.
+            to_pandas: Yield pandas DataFrames instead of `pyarrow.RecordBatch`.
+            compact: Convert to pandas with compact dtypes, strings as categoricals
+                and floats as float32 (see `compact_dataframe`). Categories are
+                per batch.
+            use_storage_api: Download through the Storage Read API if available.
+            bq_client: (Optional) Client to run the query with, e.g. a fake client
+                in tests, instead of one created from the credentials.
+            bqstorage_client: (Optional) Existing `BigQueryReadClient`.
+
+        Yields:
+            pyarrow.RecordBatch or pandas.DataFrame: the next rows of the result.
+        """
+        if compact and not to_pandas:
+            raise ValueError("compact is only supported with to_pandas=True")
+
+        bq_client = bq_client or self._client(credentials, sa_info)
+        if use_storage_api and bqstorage_client is None:
+            try:
+                bqstorage_client = self._read_client(credentials, sa_info)
+            except ImportError:
+                logging.warning(
+                    "google-cloud-bigquery-storage is not installed, "
+                    "downloading the results through the REST API"
+                )
 
-        df = bq_client.query(query).to_dataframe()
-        return df
\ No newline at end of file
+        rows = bq_client.query(query).result(page_size=batch_size)
+        batches = rows.to_arrow_iterable(
+            bqstorage_client=bqstorage_client if use_storage_api else None
+        )
+        for batch in _rebatch(batches, batch_size):
+            if compact:
+                yield compact_dataframe(batch)
+            elif to_pandas:
+                yield batch.to_pandas()
+            else:
+                yield batch
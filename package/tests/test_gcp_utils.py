@@ -1,10 +1,392 @@
+import json
+import os
+import sys
+import threading
+from unittest import mock
+
+import pandas as pd
+import pyarrow as pa
 import pytest
 
-from package import BigQuery
+from google.cloud import bigquery
+
+from package import BigQuery, ClientCache, QueryCache
+from package.gcp_utils import normalize_query
+
 
 def test_bigquery_instantiation():
     """
     Simply tests if the BigQuery class can be instantiated without errors.
     """
-    bq = BigQuery("my-project-id") 
-    assert isinstance(bq, BigQuery)  # Check if it's an instance of the class
\ No newline at end of file
+    bq = BigQuery("my-project-id")
+    assert isinstance(bq, BigQuery)  # Check if it's an instance of the class
+
+
+class FakeRowIterator:
+    def __init__(self, batches):
+        self.batches = batches
+
+    def to_arrow_iterable(self, bqstorage_client=None):
+        return iter(self.batches)
+
+
+class FakeClient:
+    """Stands in for bigquery.Client, returns the given Arrow batches."""
+
+    def __init__(self, batches):
+        self.batches = batches
+        self.page_size = None
+
+    def query(self, query):
+        return self
+
+    def result(self, page_size=None):
+        self.page_size = page_size
+        return FakeRowIterator(self.batches)
+
+
+@pytest.fixture
+def table():
+    n = 1000
+    return pa.table(
+        {
+            "id": pa.array(range(n), pa.int64()),
+            "fare": pa.array([i / 4 for i in range(n)], pa.float64()),
+            "company": pa.array([f"Company {i % 3}" for i in range(n)]),
+        }
+    )
+
+
+def test_bq_iter_batches_bounded(table):
+    """Uneven batches from the download are re-cut to batch_size rows."""
+    batches = [table.slice(0, 10), table.slice(10, 700), table.slice(710)]
+    client = FakeClient([b for t in batches for b in t.to_batches()])
+
+    result = list(
+        BigQuery().bq_iter_batches(
+            "SELECT 1", batch_size=300, use_storage_api=False, bq_client=client
+        )
+    )
+
+    assert client.page_size == 300
+    assert [batch.num_rows for batch in result] == [300, 300, 300, 100]
+    assert all(isinstance(batch, pa.RecordBatch) for batch in result)
+    assert pa.Table.from_batches(result).equals(table)
+
+
+def test_bq_iter_batches_compact(table):
+    client = FakeClient(table.to_batches())
+
+    result = list(
+        BigQuery().bq_iter_batches(
+            "SELECT 1",
+            batch_size=400,
+            to_pandas=True,
+            compact=True,
+            use_storage_api=False,
+            bq_client=client,
+        )
+    )
+
+    assert [len(df) for df in result] == [400, 400, 200]
+    df = result[0]
+    assert df["id"].dtype == "int64"
+    assert df["fare"].dtype == "float32"
+    assert df["company"].dtype == "category"
+    expected = table.slice(0, 400).to_pandas()
+    pd.testing.assert_frame_equal(df.astype(expected.dtypes.to_dict()), expected)
+
+
+def test_bq_iter_batches_compact_requires_pandas():
+    with pytest.raises(ValueError):
+        next(BigQuery().bq_iter_batches("SELECT 1", compact=True))
+
+
+@pytest.fixture
+def client_class():
+    """Stub for bigquery.Client and the service account credentials parsing."""
+    with mock.patch("package.gcp_utils.bigquery.Client") as client_class, mock.patch(
+        "package.gcp_utils.service_account.Credentials.from_service_account_info"
+    ) as from_info:
+        client_class.side_effect = lambda **kwargs: mock.Mock(kwargs=kwargs)
+        from_info.side_effect = lambda info: mock.Mock(project_id=info["project_id"])
+        yield client_class
+
+
+def test_client_cache_reuses_clients(client_class):
+    bq = BigQuery("my-project-id", client_cache=ClientCache())
+    sa_info = json.dumps({"project_id": "sa-project"})
+
+    client = bq._client(sa_info=sa_info)
+    assert bq._client(sa_info=sa_info) is client
+    assert client.kwargs["project"] == "sa-project"
+    assert bq._client() is bq._client()
+    assert bq._client() is not client
+    assert bq._client(sa_info=json.dumps({"project_id": "other"})) is not client
+    assert client_class.call_count == 3
+
+
+def test_read_client_cached_with_credentials(client_class):
+    bigquery_storage = mock.Mock()
+    bigquery_storage.BigQueryReadClient.side_effect = lambda **kwargs: mock.Mock(
+        kwargs=kwargs
+    )
+    bq = BigQuery("my-project-id", client_cache=ClientCache())
+    sa_info = json.dumps({"project_id": "sa-project"})
+
+    with mock.patch.dict(
+        sys.modules, {"google.cloud.bigquery_storage": bigquery_storage}
+    ):
+        read_client = bq._read_client(sa_info=sa_info)
+        assert bq._read_client(sa_info=sa_info) is read_client
+        assert bq._client(sa_info=sa_info) is not read_client
+        assert read_client.kwargs["credentials"].project_id == "sa-project"
+        assert bq._read_client().kwargs["credentials"] is None
+    assert bigquery_storage.BigQueryReadClient.call_count == 2
+
+
+def test_client_cache_lru_and_ttl():
+    cache = ClientCache(max_size=2)
+    a = cache.get("a", object)
+    cache.get("b", object)
+    assert cache.get("a", object) is a
+    cache.get("c", object)  # evicts b, the least recently used
+    assert len(cache) == 2
+    assert cache.get("a", object) is a
+
+    cache = ClientCache(max_size=2, ttl=0)
+    assert cache.get("a", object) is not cache.get("a", object)
+
+    cache = ClientCache(max_size=0)
+    assert cache.get("a", object) is not cache.get("a", object)
+    assert len(cache) == 0
+
+
+def test_client_cache_thread_safe(client_class):
+    bq = BigQuery(client_cache=ClientCache())
+    clients = []
+    threads = [
+        threading.Thread(target=lambda: clients.append(bq._client())) for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(map(id, clients))) == 1
+    assert client_class.call_count == 1
+
+
+def test_client_cache_creates_outside_lock():
+    cache = ClientCache()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow_create():
+        calls.append("a")
+        started.set()
+        release.wait(5)
+        return "slow"
+
+    threads = [
+        threading.Thread(target=cache.get, args=("a", slow_create)) for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    started.wait(5)
+    # another key is not blocked while the client of "a" is created
+    assert cache.get("b", lambda: "fast") == "fast"
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert cache.get("a", object) == "slow"
+    assert calls == ["a"]
+
+
+class FakeQueryClient:
+    """Stands in for bigquery.Client in bq_to_df, counting the queries run."""
+
+    project = "my-project-id"
+
+    def __init__(self):
+        self.queries = []
+
+    def query(self, query, job_config=None):
+        self.queries.append(query)
+        return mock.Mock(
+            to_dataframe=lambda: pd.DataFrame(
+                {"n": [len(self.queries)], "company": ["Company 1"]}
+            )
+        )
+
+
+@pytest.fixture
+def cached_bq(tmp_path):
+    client = FakeQueryClient()
+    bq = BigQuery(query_cache=QueryCache(str(tmp_path)))
+    with mock.patch.object(bq, "_client", return_value=client):
+        yield bq, client
+
+
+def test_normalize_query():
+    assert normalize_query("SELECT  a,\n\tb FROM t ;\n") == "SELECT a, b FROM t"
+    assert normalize_query("SELECT 'a  b', `my  col`") == "SELECT 'a  b', `my  col`"
+
+
+def test_query_cache_hit(cached_bq):
+    bq, client = cached_bq
+
+    df = bq.bq_to_df("SELECT n FROM t")
+    cached = bq.bq_to_df("SELECT n\n  FROM t;")
+
+    assert len(client.queries) == 1
+    pd.testing.assert_frame_equal(cached, df)
+
+
+def test_query_cache_key_and_bypass(cached_bq):
+    bq, client = cached_bq
+    param = bigquery.ScalarQueryParameter("day", "STRING", "2024-01-01")
+    other_param = bigquery.ScalarQueryParameter("day", "STRING", "2024-01-02")
+
+    bq.bq_to_df("SELECT n FROM t WHERE day = @day", query_parameters=[param])
+    bq.bq_to_df("SELECT n FROM t WHERE day = @day", query_parameters=[other_param])
+    bq.bq_to_df("SELECT n FROM t WHERE day = @day", query_parameters=[param])
+    assert len(client.queries) == 2
+
+    df = bq.bq_to_df(
+        "SELECT n FROM t WHERE day = @day", query_parameters=[param], bypass_cache=True
+    )
+    assert len(client.queries) == 3
+    assert df["n"].tolist() == [3]
+
+
+def test_query_cache_key_per_identity(cached_bq):
+    bq, client = cached_bq
+
+    bq.bq_to_df("SELECT n FROM t", sa_info='{"client_email": "a@p.iam"}')
+    bq.bq_to_df("SELECT n FROM t", sa_info='{"client_email": "b@p.iam"}')
+    bq.bq_to_df("SELECT n FROM t")
+    assert len(client.queries) == 3
+
+    bq.bq_to_df("SELECT n FROM t", sa_info='{"client_email": "a@p.iam"}')
+    assert len(client.queries) == 3
+
+
+def test_query_cache_default_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+
+    cache = QueryCache()
+
+    assert cache.cache_dir == str(tmp_path / ".cache" / "bigquery_results")
+    assert os.path.isdir(cache.cache_dir)
+
+
+def test_query_cache_ttl_and_lru(tmp_path):
+    df = pd.DataFrame({"x": range(1000)})
+    cache = QueryCache(str(tmp_path), ttl=0)
+    cache.put("a", df)
+    assert cache.get("a") is None
+
+    cache = QueryCache(str(tmp_path), ttl=None)
+    cache.put("a", df)
+    stat = (tmp_path / "a.parquet").stat()
+    cache.max_bytes = 2 * stat.st_size
+    os.utime(tmp_path / "a.parquet", (1, stat.st_mtime))
+    cache.put("b", df)
+    pd.testing.assert_frame_equal(cache.get("b"), df)
+    cache.put("c", df)  # evicts a, the least recently used
+
+    assert cache.get("a") is None
+    assert cache.get("b") is not None and cache.get("c") is not None
+
+
+class FakeBlockingClient:
+    """Stands in for bigquery.Client, the query "SELECT <name>" blocks until the
+    test releases <name>, "SELECT fail" raises.
+
+    With `in_flight`, each query also waits until that many queries are running at
+    the same time, and fails with BrokenBarrierError if they never are.
+    """
+
+    project = "my-project-id"
+
+    def __init__(self, in_flight: int = None):
+        self.barrier = threading.Barrier(in_flight, timeout=5) if in_flight else None
+        self.events = {}
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def _event(self, name):
+        with self.lock:
+            return self.events.setdefault(name, threading.Event())
+
+    def release(self, *names):
+        for name in names:
+            self._event(name).set()
+
+    def query(self, query, job_config=None):
+        name = query.split()[1]
+        if name == "fail":
+            raise RuntimeError("query failed")
+
+        def to_dataframe():
+            with self.lock:
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            try:
+                if self.barrier:
+                    self.barrier.wait()
+                if not self._event(name).wait(timeout=5):
+                    raise TimeoutError(f"query {name} was not released")
+            finally:
+                with self.lock:
+                    self.running -= 1
+            return pd.DataFrame({"name": [name]})
+
+        return mock.Mock(to_dataframe=to_dataframe, total_bytes_processed=100)
+
+
+def test_bq_to_dfs_concurrent():
+    client = FakeBlockingClient(in_flight=3)
+    bq = BigQuery()
+    queries = {"slow": "SELECT slow", "fast": "SELECT fast", "medium": "SELECT medium"}
+
+    with mock.patch.object(bq, "_client", return_value=client):
+        # all three queries pass the barrier, then complete in the order released
+        client.release("fast")
+        results = bq.bq_to_dfs(queries, max_concurrency=3)
+        completed = [next(results)]
+        for name in ["medium", "slow"]:
+            client.release(name)
+            completed.append(next(results))
+        assert next(results, None) is None
+
+    assert [r.name for r in completed] == ["fast", "medium", "slow"]
+    assert client.max_running == 3
+    for result in completed:
+        assert result.df["name"][0] == result.name
+        assert result.seconds >= 0
+        assert result.total_bytes_processed == 100
+        assert not result.cache_hit
+
+
+def test_bq_to_dfs_max_concurrency_and_errors(tmp_path):
+    client = FakeBlockingClient(in_flight=2)
+    client.release("a")
+    bq = BigQuery(query_cache=QueryCache(str(tmp_path)))
+
+    with mock.patch.object(bq, "_client", return_value=client):
+        results = list(bq.bq_to_dfs(["SELECT a"] * 4, max_concurrency=2))
+        assert client.max_running == 2
+        assert sorted(r.name for r in results) == [0, 1, 2, 3]
+
+        cached = next(bq.bq_to_dfs(["SELECT a"]))
+        assert cached.cache_hit and cached.total_bytes_processed is None
+
+    client = FakeBlockingClient()
+    client.release("a")
+    with mock.patch.object(bq, "_client", return_value=client):
+        with pytest.raises(RuntimeError):
+            list(bq.bq_to_dfs(["SELECT a", "SELECT fail"], bypass_cache=True))
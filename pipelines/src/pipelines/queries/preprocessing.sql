@@ -4,32 +4,47 @@ CREATE SCHEMA IF NOT EXISTS `{{ dataset }}`
     description = 'Chicago Taxi Trips with Turbo Template',
     location = '{{ location }}');
 
--- Create (or replace) table with preprocessed data
-DROP TABLE IF EXISTS `{{ dataset }}.{{ table }}`;
-CREATE TABLE `{{ dataset }}.{{ table }}` AS (
-WITH start_timestamps AS (
-SELECT
-	IF('{{ start_timestamp }}' = '',
-	CURRENT_DATETIME(),
-	CAST('{{ start_timestamp }}' AS DATETIME)) AS start_timestamp
-)
--- Ingest data between 2 and 3 months ago
-,filtered_data AS (
-    SELECT
-    *
-    FROM `{{ source }}`, start_timestamps
-    WHERE
-         DATE(trip_start_timestamp) BETWEEN
-         DATE_SUB(DATE(CAST(start_timestamps.start_timestamp AS DATETIME)), INTERVAL 3 MONTH) AND
-         DATE_SUB(DATE(start_timestamp), INTERVAL 2 MONTH)
-)
--- Use the average trip_seconds as a replacement for NULL or 0 values
-,mean_time AS (
-    SELECT CAST(avg(trip_seconds) AS INT64) as avg_trip_seconds
-    FROM filtered_data
-)
+{#
+  The ingestion window is [start_date, end_date), between 3 and 2 months before
+  start_timestamp. Its bounds are constant expressions of start_timestamp and the
+  source is filtered on the raw trip_start_timestamp, so that BigQuery can prune
+  its partitions.
+#}
+{% macro start_datetime() -%}
+IF('{{ start_timestamp }}' = '', CURRENT_DATETIME(), CAST('{{ start_timestamp }}' AS DATETIME))
+{%- endmacro %}
 
-SELECT
+{% macro window_start() -%}
+DATE_SUB(DATE({{ start_datetime() }}), INTERVAL 3 MONTH)
+{%- endmacro %}
+
+{% macro window_end() -%}
+DATE_ADD(DATE_SUB(DATE({{ start_datetime() }}), INTERVAL 2 MONTH), INTERVAL 1 DAY)
+{%- endmacro %}
+
+{% macro in_window() %}
+        trip_start_timestamp >= TIMESTAMP({{ window_start() }})
+        AND trip_start_timestamp < TIMESTAMP({{ window_end() }})
+{% endmacro %}
+
+{# only the source columns used below are read #}
+{% macro source_columns() %}
+    trip_start_timestamp,
+    pickup_longitude,
+    pickup_latitude,
+    dropoff_longitude,
+    dropoff_latitude,
+    trip_miles,
+    trip_seconds,
+    fare,
+    tips,
+    tolls,
+    extras,
+    payment_type,
+    company
+{% endmacro %}
+
+{% macro preprocessed_columns() %}
     CAST(EXTRACT(DAYOFWEEK FROM trip_start_timestamp) AS FLOAT64) AS dayofweek,
     CAST(EXTRACT(HOUR FROM trip_start_timestamp) AS FLOAT64) AS hourofday,
     ST_DISTANCE(
@@ -45,12 +60,124 @@ SELECT
     {% if label %}
     (fare + tips + tolls + extras) AS `{{ label }}`,
     {% endif %}
-FROM filtered_data AS t, mean_time AS m
-WHERE
+{% endmacro %}
+
+{% macro valid_trips() %}
     trip_miles > 0 AND fare > 0 AND fare < 1500
     {% for field in [
         'fare', 'trip_start_timestamp', 'pickup_longitude', 'pickup_latitude',
         'dropoff_longitude', 'dropoff_latitude','payment_type','company' ] %}
         AND `{{ field }}` IS NOT NULL
     {% endfor %}
+{% endmacro %}
+
+{% if not incremental %}
+-- Create (or replace) table with preprocessed data
+DROP TABLE IF EXISTS `{{ dataset }}.{{ table }}`;
+CREATE TABLE `{{ dataset }}.{{ table }}` AS (
+-- Ingest data between 2 and 3 months ago
+WITH filtered_data AS (
+    SELECT
+{{ source_columns() }}
+    FROM `{{ source }}`
+    WHERE
+{{ in_window() }}
+)
+-- Use the average trip_seconds as a replacement for NULL or 0 values
+,mean_time AS (
+    SELECT CAST(avg(trip_seconds) AS INT64) as avg_trip_seconds
+    FROM filtered_data
+)
+
+SELECT
+{{ preprocessed_columns() }}
+FROM filtered_data AS t, mean_time AS m
+WHERE
+{{ valid_trips() }}
+);
+{% else %}
+-- Incremental mode: the preprocessed trips are kept per day in a partitioned
+-- table, and only the days of the window that are not in it yet are read from
+-- the source. Per-day sums of trip_seconds in a side table give the mean used
+-- for imputation without reading the previous days again. Rows keep the mean
+-- of the window they were added in.
+CREATE TABLE IF NOT EXISTS `{{ dataset }}.{{ table }}_daily` (
+    dayofweek FLOAT64,
+    hourofday FLOAT64,
+    trip_distance FLOAT64,
+    trip_miles FLOAT64,
+    trip_seconds FLOAT64,
+    payment_type STRING,
+    company STRING,
+    {% if label %}
+    `{{ label }}` FLOAT64,
+    {% endif %}
+    trip_date DATE
+)
+PARTITION BY trip_date
+CLUSTER BY payment_type, company;
+
+CREATE TABLE IF NOT EXISTS `{{ dataset }}.{{ table }}_stats` (
+    trip_date DATE NOT NULL,
+    sum_trip_seconds FLOAT64,
+    count_trip_seconds INT64
 );
+
+-- Ingest data between 2 and 3 months ago, of the days not preprocessed yet
+CREATE TEMP TABLE date_range AS
+SELECT {{ window_start() }} AS start_date, {{ window_end() }} AS end_date;
+
+CREATE TEMP TABLE new_trips AS
+SELECT
+    DATE(trip_start_timestamp) AS trip_date,
+{{ source_columns() }}
+FROM `{{ source }}`
+WHERE
+{{ in_window() }}
+    AND DATE(trip_start_timestamp) NOT IN (
+        SELECT trip_date FROM `{{ dataset }}.{{ table }}_stats`);
+
+BEGIN TRANSACTION;
+
+MERGE `{{ dataset }}.{{ table }}_stats` AS s
+USING (
+    SELECT
+        trip_date,
+        SUM(trip_seconds) AS sum_trip_seconds,
+        COUNT(trip_seconds) AS count_trip_seconds
+    FROM new_trips
+    GROUP BY trip_date
+) AS n
+ON s.trip_date = n.trip_date
+WHEN NOT MATCHED THEN
+    INSERT (trip_date, sum_trip_seconds, count_trip_seconds)
+    VALUES (n.trip_date, n.sum_trip_seconds, n.count_trip_seconds);
+
+-- Drop the days which are no longer in the window
+DELETE FROM `{{ dataset }}.{{ table }}_stats`
+WHERE trip_date < (SELECT start_date FROM date_range)
+    OR trip_date >= (SELECT end_date FROM date_range);
+DELETE FROM `{{ dataset }}.{{ table }}_daily`
+WHERE trip_date < (SELECT start_date FROM date_range)
+    OR trip_date >= (SELECT end_date FROM date_range);
+
+-- Use the average trip_seconds of the window as a replacement for NULL or 0 values
+INSERT INTO `{{ dataset }}.{{ table }}_daily`
+SELECT
+{{ preprocessed_columns() }}
+    trip_date
+FROM new_trips AS t, (
+    SELECT
+        CAST(SUM(sum_trip_seconds) / SUM(count_trip_seconds) AS INT64)
+        AS avg_trip_seconds
+    FROM `{{ dataset }}.{{ table }}_stats`
+) AS m
+WHERE
+{{ valid_trips() }};
+
+COMMIT TRANSACTION;
+
+-- Table with the same columns as in full mode, read by the extract step
+CREATE OR REPLACE TABLE `{{ dataset }}.{{ table }}` AS
+SELECT * EXCEPT (trip_date) FROM `{{ dataset }}.{{ table }}_daily`;
+{% endif %}
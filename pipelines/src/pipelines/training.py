@@ -51,6 +51,12 @@ def train(
     test_data: Output[Dataset],
     model: Output[Model],
     metrics: Output[Metrics],
+    model_format: str = "joblib",
+    input_format: str = "auto",
+    split_format: str = "csv",
+    engine: str = "sklearn",
+    search: str = "none",
+    n_trials: int = 16,
 ):
     return dsl.ContainerSpec(
         image=TRAINING_IMAGE,
@@ -75,6 +81,18 @@ def train(
             model.path,
             "--output_metrics",
             metrics.path,
+            "--model_format",
+            model_format,
+            "--input_format",
+            input_format,
+            "--split_format",
+            split_format,
+            "--engine",
+            engine,
+            "--search",
+            search,
+            "--n_trials",
+            n_trials,
         ],
     )
 
@@ -89,6 +107,9 @@ def pipeline(
     dataset: str = "turbo_templates",
     timestamp: str = "2022-12-01 00:00:00",
     test_data_gcs_uri: str = "",
+    destination_format: str = "CSV",
+    compression: str = "NONE",
+    input_format: str = "auto",
 ):
     """
     Training pipeline which:
@@ -110,6 +131,12 @@ def pipeline(
             (YYYY-MM-DDThh:mm:ss.sss±hh:mm or YYYY-MM-DDThh:mm:ss).
             If any time part is missing, it will be regarded as zero.
         test_data_gcs_uri (str): Optional. GCS URI of static held-out test dataset.
+        destination_format (str): format the training table is extracted to,
+            "CSV", "AVRO" or "PARQUET" (the formats the training step can read)
+        compression (str): compression of the extracted files, "NONE", "GZIP",
+            "DEFLATE" (Avro) or "SNAPPY" (Avro & Parquet)
+        input_format (str): "auto", "csv", "parquet" or "avro", the format the
+            training step reads the extracted files as. "auto" detects it per file.
     """
 
     table = f"prep_training_{SUFFIX}_{RESOURCE_SUFFIX}"
@@ -136,6 +163,8 @@ def pipeline(
             project=project,
             location=bq_location,
             table=f"{project}:{dataset}.{table}",
+            destination_format=destination_format,
+            compression=compression,
         )
         .after(prep_op)
         .set_display_name("Extract data")
@@ -145,6 +174,7 @@ def pipeline(
         input_data=data_op.outputs["data"],
         input_test_path=test_data_gcs_uri,
         hparams=HPARAMS,
+        input_format=input_format,
     ).set_display_name("Train model")
 
     upload_model(